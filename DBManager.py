@@ -1,23 +1,67 @@
 import sqlite3
-from threading import Thread
-from queue import Queue
+import time
+import atexit
+from datetime import datetime
+from threading import Thread, Event, Condition
+from queue import Queue, Empty
+from collections import deque
+from collections.abc import Mapping
 
-from DBModels import Beatmap, DownloadedBeatmapset, Model
+from DBModels import Beatmap, DownloadedBeatmapset, CrawlerState, SchemaVersion, DirectoryEntry, BackfillCheckpoint, Model
+from metrics import Metrics
+from utils import iter_chunks, tokenize_search_text
 
-from typing import List, Tuple, Dict, Any, Union
+from typing import List, Tuple, Dict, Any, Callable, Union, Set, Iterable, Iterator
+
+
+metrics = Metrics._get_default()
 
 
 dict_factory = lambda cursor, row: {col[0]:row[i] for i, col in enumerate(cursor.description)}
 
 
+def apply_profile(connection: sqlite3.Connection, profile: Dict[str, Any] = None):
+    """Applies a connection profile, a mapping of PRAGMA names to values, e.g. {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}."""
+    for pragma, value in (profile or {}).items():
+        if not pragma.isidentifier() or not str(value).replace('-', '', 1).isalnum():
+            raise ValueError("Invalid database profile entry: {}={!r}".format(pragma, value))
+        connection.execute("PRAGMA {}={}".format(pragma, value)).fetchall()
+
+
+def make_fts_queries(table: str, fts_table: str, fields: List[str]) -> List[str]:
+    """
+    Full-text index over fields of table, keyed by its rowid and kept in sync by triggers, then filled with the existing rows.
+    Triggers clear the rowid before indexing it, as INSERT OR REPLACE does not fire delete triggers.
+    """
+    columns = ", ".join(fields)
+    make_values = lambda row: ", ".join("{}.{}".format(row, field) for field in fields)
+    delete = 'DELETE FROM "{}" WHERE rowid={{}}.rowid;'.format(fts_table)
+    index = 'INSERT INTO "{0}"(rowid, {1}) VALUES ({{0}}.rowid, {{1}});'.format(fts_table, columns)
+    return ['CREATE VIRTUAL TABLE IF NOT EXISTS "{}" USING fts5({})'.format(fts_table, columns),
+            'CREATE TRIGGER IF NOT EXISTS "{0}_insert" AFTER INSERT ON "{1}" BEGIN {2} {3} END'.format(fts_table, table, delete.format('NEW'), index.format('NEW', make_values('NEW'))),
+            'CREATE TRIGGER IF NOT EXISTS "{0}_update" AFTER UPDATE ON "{1}" BEGIN {2} {3} END'.format(fts_table, table, delete.format('OLD'), index.format('NEW', make_values('NEW'))),
+            'CREATE TRIGGER IF NOT EXISTS "{0}_delete" AFTER DELETE ON "{1}" BEGIN {2} END'.format(fts_table, table, delete.format('OLD')),
+            'DELETE FROM "{}"'.format(fts_table),
+            'INSERT INTO "{0}"(rowid, {1}) SELECT rowid, {1} FROM "{2}"'.format(fts_table, columns, table)]
+
+
 class osuDB:
-    TABLES = {'beatmaps': Beatmap, 'downloaded': DownloadedBeatmapset}
+    TABLES = {'beatmaps': Beatmap, 'downloaded': DownloadedBeatmapset, 'state': CrawlerState, 'directory': DirectoryEntry, 'backfill': BackfillCheckpoint, 'schema': SchemaVersion}
+    # Bump SCHEMA_VERSION whenever the models change. Columns missing from existing tables are added automatically,
+    # anything else that has to happen on upgrade goes into MIGRATIONS under the version introducing it.
+    SCHEMA_VERSION = 6
+    FTS_TABLE = 'beatmaps_fts'
+    FTS_FIELDS = ['artist', 'artist_unicode', 'title', 'title_unicode', 'creator', 'source', 'tags']
+    MIGRATIONS: Dict[int, List[str]] = {5: make_fts_queries(Beatmap.table_name, FTS_TABLE, FTS_FIELDS)}
     
-    def __init__(self, database: str, *, initialize=True):
+    def __init__(self, database: str, *, initialize=True, profile: Dict[str, Any] = None):
         self.database = database
+        self.profile = profile
         self.connection = sqlite3.connect(database=self.database)
+        apply_profile(self.connection, self.profile)
         self.connection.row_factory = dict_factory
         self.cursor = self.connection.cursor()
+        self._downloaded_index: Set[int] = None
         
         if initialize:
             self._init()
@@ -28,67 +72,177 @@ class osuDB:
     def _init(self):
         for table in self.TABLES.values():
             self.cursor.execute(table.make_query())
-            self.connection.commit()
+        self.migrate()
+        for table in self.TABLES.values():
+            for index_query in table.make_index_queries():
+                self.cursor.execute(index_query)
+        self.connection.commit()
     
-    def insert(self, obj: Model, **insertKw):
-        self.cursor.execute(*obj.make_insert_args(**insertKw))
+    def get_schema_version(self):
+        self.cursor.execute("SELECT MAX(version) AS version FROM {0[schema].table_name}".format(self.TABLES))
+        return self.cursor.fetchone()['version'] or 0
+    
+    def migrate(self):
+        current_version = self.get_schema_version()
+        if current_version >= self.SCHEMA_VERSION:
+            return
+        
+        for table in self.TABLES.values():
+            self.cursor.execute("PRAGMA table_info(\"{}\")".format(table.table_name))
+            existing_columns = [column['name'] for column in self.cursor.fetchall()]
+            for query in table.make_add_column_queries(existing_columns):
+                self.cursor.execute(query)
+        
+        for version in range(current_version+1, self.SCHEMA_VERSION+1):
+            for query in self.MIGRATIONS.get(version, []):
+                self.cursor.execute(query)
+            self.cursor.execute(*SchemaVersion({'version': version, 'applied_at': datetime.now().isoformat(' ')}).make_insert_args())
         self.connection.commit()
     
-    def insert_many(self, list_of_obj: List[Model], **insertKw):
+    def write(self, query: str, values: Union[Dict, Tuple, List] = (), *, many: bool = False, on_error: Callable[[Exception], None] = None):
+        """Executes a write statement and commits it. on_error is called with the exception when it fails."""
+        with metrics.time('db_commit_seconds', writer='direct'):
+            try:
+                if many:
+                    self.cursor.executemany(query, values)
+                else:
+                    self.cursor.execute(query, values)
+                self.connection.commit()
+            except sqlite3.Error as exc:
+                self.connection.rollback()
+                if on_error is not None:
+                    on_error(exc)
+                raise
+        metrics.increment('db_rows_written_total', len(values) if many else 1, writer='direct')
+    
+    def flush(self):
+        """Barrier for pending writes, reads issued after it see every write issued before it."""
+        self.connection.commit()
+    
+    def close(self):
+        self.flush()
+        self.connection.close()
+    
+    def insert(self, obj: Model, *, on_error: Callable[[Exception], None] = None, **insertKw):
+        self.write(*obj.make_insert_args(**insertKw), on_error=on_error)
+    
+    def insert_many(self, list_of_obj: List[Model], *, on_error: Callable[[Exception], None] = None, **insertKw):
         # Groups each model
         model_groups = {}
         for obj in list_of_obj:
-            model_groups[obj.__class__] = model_groups.get(obj.__class__, []) + [obj]
+            model_groups.setdefault(obj.__class__, []).append(obj)
         
         # Groups query string with its execute_many values
         query_groups = {table.make_insert_query(**insertKw) : [obj.make_insert_values() for obj in objs] for table, objs in model_groups.items()}
         
         # Do the execute many process
         for query_string, execute_many_values in query_groups.items():
-            self.cursor.executemany(query_string, execute_many_values)
-            self.connection.commit() # Commit for every model.
+            self.write(query_string, execute_many_values, many=True, on_error=on_error) # Commit for every model.
     
     def select(self, obj: Model, **selectKw):
-        self.cursor.execute(obj.make_selector_query(**selectKw))
+        self.cursor.execute(*obj.make_selector_query(**selectKw))
         return self.cursor.fetchall()
     
-    def add_beatmap(self, beatmap:Union[Beatmap, dict], **insertKw):
-        if isinstance(beatmap, dict):
+    def add_beatmap(self, beatmap:Union[Beatmap, Mapping], **insertKw):
+        if isinstance(beatmap, Mapping):
             beatmap = Beatmap(beatmap)
         self.insert(beatmap, **insertKw)
     
-    def add_beatmaps(self, beatmap_list: List[Union[Beatmap, dict]], **insertKw):
-        self.insert_many([Beatmap(beatmap) if isinstance(beatmap, dict) else beatmap for beatmap in beatmap_list], **insertKw)
+    def add_beatmaps(self, beatmap_list: List[Union[Beatmap, Mapping]], **insertKw):
+        self.insert_many([Beatmap(beatmap) if isinstance(beatmap, Mapping) else beatmap for beatmap in beatmap_list], **insertKw)
     
     def flag_as_downloaded(self, beatmap_descriptor: Union[Beatmap, DownloadedBeatmapset, dict, int], **insertKw):
         if isinstance(beatmap_descriptor, Beatmap):
-            downloaded_object = DownloadedBeatmapset(beatmap_descriptor.data)
+            downloaded_object = DownloadedBeatmapset({'beatmapset_id':beatmap_descriptor.data['beatmapset_id'], 'downloaded': True})
         elif isinstance(beatmap_descriptor, DownloadedBeatmapset):
             downloaded_object = beatmap_descriptor
-        elif isinstance(beatmap_descriptor, dict):
+        elif isinstance(beatmap_descriptor, Mapping):
             downloaded_object = DownloadedBeatmapset({'beatmapset_id':beatmap_descriptor['beatmapset_id'], 'downloaded': True})
         else:
             downloaded_object = DownloadedBeatmapset({'beatmapset_id': int(beatmap_descriptor), 'downloaded': True})
-        self.insert(downloaded_object, **insertKw)
+        previous = self._update_downloaded_index([downloaded_object])
+        self.insert(downloaded_object, on_error=lambda exc: self._restore_downloaded_index(previous), **insertKw)
 
     def bulk_flag_as_downloaded(self, beatmap_descriptors: List[Union[Beatmap, DownloadedBeatmapset, dict, int]], **insertKw):
         downloaded_beatmapset_objects = []
         for beatmap_descriptor in beatmap_descriptors:
             if isinstance(beatmap_descriptor, Beatmap):
-                downloaded_object = DownloadedBeatmapset(beatmap_descriptor.data)
+                downloaded_object = DownloadedBeatmapset({'beatmapset_id':beatmap_descriptor.data['beatmapset_id'], 'downloaded': True})
             elif isinstance(beatmap_descriptor, DownloadedBeatmapset):
                 downloaded_object = beatmap_descriptor
-            elif isinstance(beatmap_descriptor, dict):
+            elif isinstance(beatmap_descriptor, Mapping):
                 downloaded_object = DownloadedBeatmapset({'beatmapset_id':beatmap_descriptor['beatmapset_id'], 'downloaded': True})
             else:
                 downloaded_object = DownloadedBeatmapset({'beatmapset_id': int(beatmap_descriptor), 'downloaded': True})
             downloaded_beatmapset_objects.append(downloaded_object)
-        self.insert_many(downloaded_beatmapset_objects, **insertKw)
+        previous = self._update_downloaded_index(downloaded_beatmapset_objects)
+        self.insert_many(downloaded_beatmapset_objects, on_error=lambda exc: self._restore_downloaded_index(previous), **insertKw)
         
     def get_all_beatmaps(self):
         self.cursor.execute("SELECT * FROM {0[beatmaps].table_name}".format(self.TABLES))
         return self.cursor.fetchall()
     
+    def iter_beatmaps(self, batch_size: int = 1000) -> Iterator[Dict]:
+        """Yields every beatmap, fetching batch_size rows at a time from a cursor of its own."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT * FROM {0[beatmaps].table_name} ORDER BY beatmap_id".format(self.TABLES))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    
+    def import_beatmaps(self, beatmaps: Iterable[Mapping], batch_size: int = 1000, **insertKw) -> int:
+        """
+        Adds beatmaps batch_size at a time, each batch in a transaction of its own, so memory stays constant for any amount of beatmaps.
+        On MultiThreadedOsuDB, batches wait for the writer once its queue is full, see CursorProxy.
+        Conflicts with existing beatmaps follow make_insert_query, e.g. replace=True or ignore=True. Returns the number of beatmaps read.
+        """
+        count = 0
+        for chunk in iter_chunks(beatmaps, batch_size):
+            self.add_beatmaps(chunk, **insertKw)
+            count += len(chunk)
+        return count
+    
+    def get_beatmapsets_where(self, conditions: List[Tuple[str, List]] = []):
+        """
+        Returns one beatmap per beatmapset, the one with the highest beatmap_id among the beatmaps matching every condition.
+        Conditions are (clause, params) pairs, like ("mode = ?", [0]).
+        """
+        where_clause = " AND ".join(["({})".format(clause) for clause, _ in conditions]) or "1"
+        where_params = [param for _, params in conditions for param in params]
+        self.cursor.execute("SELECT * FROM {0[beatmaps].table_name} WHERE beatmap_id IN "
+                            "(SELECT MAX(beatmap_id) FROM {0[beatmaps].table_name} WHERE {1} GROUP BY beatmapset_id)".format(self.TABLES, where_clause), where_params)
+        return self.cursor.fetchall()
+    
+    @staticmethod
+    def make_fts_query(text: str) -> str:
+        """FTS5 query matching beatmaps with every word of text as a word prefix, search syntax in text is matched literally."""
+        return " ".join('"{}"*'.format(token) for token in tokenize_search_text(text))
+    
+    @classmethod
+    def match_beatmap_text(cls, text: str, beatmap: Mapping) -> bool:
+        """make_fts_query evaluated on a beatmap outside the database, e.g. one fetched from the api."""
+        beatmap_tokens = tokenize_search_text(" ".join(str(beatmap.get(field) or '') for field in cls.FTS_FIELDS))
+        return all(any(beatmap_token.startswith(token) for beatmap_token in beatmap_tokens) for token in tokenize_search_text(text))
+    
+    def search_beatmap_ids(self, text: str) -> List[int]:
+        """beatmap_ids of the beatmaps matching text, through the full-text index."""
+        fts_query = self.make_fts_query(text)
+        if not fts_query:
+            self.cursor.execute("SELECT beatmap_id FROM {0[beatmaps].table_name}".format(self.TABLES))
+        else:
+            self.cursor.execute('SELECT rowid AS beatmap_id FROM "{0}" WHERE "{0}" MATCH ?'.format(self.FTS_TABLE), (fts_query,))
+        return [row['beatmap_id'] for row in self.cursor.fetchall()]
+    
+    def get_beatmaps_by_ids(self, beatmap_ids: Iterable[int]) -> List[Dict]:
+        rows = []
+        # Chunked below SQLite's default limit of 999 bound parameters.
+        for chunk in iter_chunks(beatmap_ids, 900):
+            self.cursor.execute("SELECT * FROM {0[beatmaps].table_name} WHERE beatmap_id IN ({1})".format(self.TABLES, ','.join('?'*len(chunk))), chunk)
+            rows += self.cursor.fetchall()
+        return rows
+    
     def get_beatmaps(self, beatmap_descriptor: Union[Beatmap, int], **selectKw):
         if isinstance(beatmap_descriptor, int):
             beatmap_descriptor = Beatmap({'beatmap_id':beatmap_descriptor})
@@ -99,34 +253,164 @@ class osuDB:
         return self.cursor.fetchall()
 
     def get_beatmapset_downloaded(self, beatmapset_descriptor: Union[Beatmap,DownloadedBeatmapset,int]):
-        if not isinstance(beatmapset_descriptor, int):
-            beatmapset_descriptor = beatmapset_descriptor['beatmapset_id']
-        self.cursor.execute("SELECT * FROM {0[downloaded].table_name} WHERE beatmapset_id={1}".format(self.TABLES, beatmapset_descriptor))
+        self.cursor.execute(self.TABLES['downloaded'].make_select_by_key_query(), (self.get_beatmapset_id(beatmapset_descriptor),))
         return self.cursor.fetchone()
     
-    def check_exists_in_downloaded(self, beatmapset_descriptor: Union[Beatmap,DownloadedBeatmapset,int]):
-        return self.get_beatmapset_downloaded(beatmapset_descriptor=beatmapset_descriptor) is not None
+    @staticmethod
+    def get_beatmapset_id(beatmapset_descriptor: Union[Beatmap,DownloadedBeatmapset,dict,int]) -> int:
+        if isinstance(beatmapset_descriptor, Model):
+            return int(beatmapset_descriptor.data['beatmapset_id'])
+        if isinstance(beatmapset_descriptor, Mapping):
+            return int(beatmapset_descriptor['beatmapset_id'])
+        return int(beatmapset_descriptor)
+    
+    @property
+    def downloaded_index(self) -> Set[int]:
+        """Set of downloaded beatmapset ids, loaded from the database once and kept in sync by the flag_as_downloaded methods."""
+        if self._downloaded_index is None:
+            self.flush()
+            self.cursor.execute("SELECT beatmapset_id FROM {0[downloaded].table_name} WHERE downloaded=1".format(self.TABLES))
+            self._downloaded_index = {row['beatmapset_id'] for row in self.cursor.fetchall()}
+        return self._downloaded_index
+    
+    def _update_downloaded_index(self, downloaded_objects: List[DownloadedBeatmapset]) -> Dict[int, bool]:
+        """
+        Updates the index as the write of downloaded_objects is queued, so reads see it right away.
+        Returns whether every beatmapset was in the index before, for _restore_downloaded_index when the write fails.
+        """
+        if self._downloaded_index is None:
+            return {}
+        previous = {}
+        for downloaded_object in downloaded_objects:
+            beatmapset_id = self.get_beatmapset_id(downloaded_object)
+            previous.setdefault(beatmapset_id, beatmapset_id in self._downloaded_index)
+            if downloaded_object.data.get('downloaded'):
+                self._downloaded_index.add(beatmapset_id)
+            else:
+                self._downloaded_index.discard(beatmapset_id)
+        return previous
+    
+    def _restore_downloaded_index(self, previous: Dict[int, bool]):
+        if self._downloaded_index is None:
+            return
+        for beatmapset_id, downloaded in previous.items():
+            if downloaded:
+                self._downloaded_index.add(beatmapset_id)
+            else:
+                self._downloaded_index.discard(beatmapset_id)
+    
+    def check_exists_in_downloaded(self, beatmapset_descriptor: Union[Beatmap,DownloadedBeatmapset,dict,int]):
+        return self.get_beatmapset_id(beatmapset_descriptor) in self.downloaded_index
+    
+    def get_missing_beatmapsets(self, beatmapset_descriptors: Iterable[Union[Beatmap,DownloadedBeatmapset,dict,int]]) -> list:
+        """Returns the descriptors whose beatmapset is not downloaded yet, in their original order."""
+        downloaded_index = self.downloaded_index
+        return [descriptor for descriptor in beatmapset_descriptors if self.get_beatmapset_id(descriptor) not in downloaded_index]
+
+    def unflag_as_downloaded(self, beatmapset_descriptors: Iterable[Union[Beatmap,DownloadedBeatmapset,dict,int]]):
+        """Marks beatmapsets as not downloaded, keeping the rest of their records."""
+        beatmapset_ids = [self.get_beatmapset_id(descriptor) for descriptor in beatmapset_descriptors]
+        previous = self._update_downloaded_index([DownloadedBeatmapset({'beatmapset_id': beatmapset_id, 'downloaded': False}) for beatmapset_id in beatmapset_ids])
+        self.write("UPDATE {0[downloaded].table_name} SET downloaded=0 WHERE beatmapset_id=?".format(self.TABLES), [(beatmapset_id,) for beatmapset_id in beatmapset_ids], many=True,
+                   on_error=lambda exc: self._restore_downloaded_index(previous))
+    
+    def record_download_failure(self, beatmapset_descriptor: Union[Beatmap,DownloadedBeatmapset,dict,int]):
+        """Counts a failed download attempt of a beatmapset that is not downloaded, its record is created if needed."""
+        self.write("INSERT INTO {0[downloaded].table_name}(beatmapset_id, downloaded, failures) VALUES (?, 0, 1) "
+                   "ON CONFLICT(beatmapset_id) DO UPDATE SET failures=COALESCE(failures, 0)+1".format(self.TABLES), (self.get_beatmapset_id(beatmapset_descriptor),))
+    
+    def get_download_failures(self) -> Dict[int, int]:
+        """Failed download attempts by beatmapset id, for beatmapsets that failed at least once."""
+        self.flush()
+        self.cursor.execute("SELECT beatmapset_id, failures FROM {0[downloaded].table_name} WHERE failures > 0".format(self.TABLES))
+        return {row['beatmapset_id']: row['failures'] for row in self.cursor.fetchall()}
+    
+    def get_downloaded_size_stats(self) -> List[Dict]:
+        """Downloaded bytes and beatmap seconds of recorded downloads, split by whether the beatmapset has a video."""
+        self.flush()
+        self.cursor.execute("SELECT beatmaps.video AS video, COUNT(*) AS count, SUM(downloaded.size) AS size, SUM(beatmaps.total_length) AS total_length "
+                            "FROM {0[downloaded].table_name} AS downloaded JOIN "
+                            "(SELECT beatmapset_id, MAX(video) AS video, MAX(total_length) AS total_length FROM {0[beatmaps].table_name} GROUP BY beatmapset_id) AS beatmaps "
+                            "ON downloaded.beatmapset_id = beatmaps.beatmapset_id WHERE downloaded.downloaded=1 AND downloaded.size IS NOT NULL "
+                            "GROUP BY beatmaps.video".format(self.TABLES))
+        return self.cursor.fetchall()
+    
+    def get_directory_entries(self) -> Dict[str, Dict]:
+        """Cached download directory entries by filename, see indexer.DirectoryIndexer."""
+        self.flush()
+        self.cursor.execute("SELECT * FROM {0[directory].table_name}".format(self.TABLES))
+        return {row['filename']: row for row in self.cursor.fetchall()}
+    
+    def remove_directory_entries(self, filenames: Iterable[str]):
+        self.write("DELETE FROM {0[directory].table_name} WHERE filename=?".format(self.TABLES), [(filename,) for filename in filenames], many=True)
+
+    def get_state(self, key: str, default: str = None):
+        self.flush()
+        self.cursor.execute("SELECT value FROM {0[state].table_name} WHERE key=?".format(self.TABLES), (key,))
+        row = self.cursor.fetchone()
+        return row['value'] if row is not None else default
+
+    def set_state(self, key: str, value: str):
+        self.insert(CrawlerState({'key': key, 'value': value}), replace=True)
+
+    def get_backfill_checkpoints(self, job: str) -> List[Dict]:
+        self.flush()
+        self.cursor.execute("SELECT * FROM {0[backfill].table_name} WHERE job=? ORDER BY shard".format(self.TABLES), (job,))
+        return self.cursor.fetchall()
+    
+    def set_backfill_checkpoints(self, checkpoints: List[Union[BackfillCheckpoint, Mapping]]):
+        self.insert_many([BackfillCheckpoint(checkpoint) if isinstance(checkpoint, Mapping) else checkpoint for checkpoint in checkpoints], replace=True)
 
 
 class CursorTask:
-    def __init__(self, target_method:str, args: Tuple, kwargs: Dict):
+    def __init__(self, target_method:str, args: Tuple, kwargs: Dict, on_error: Callable[[Exception], None] = None):
         self.target_method = target_method
         self.args = args
         self.kwargs = kwargs
+        self.on_error = on_error # Called from the writer thread when the task fails to commit.
     
     def __repr__(self):
         return "<{} object targetMethod={} argsCount={} kwargsCount={}>".format(self.__class__.__name__, self.target_method, self.args.__len__(), self.kwargs.__len__())
+    
+    @property
+    def row_count(self):
+        if self.target_method == 'executemany' and len(self.args) >= 2 and hasattr(self.args[1], '__len__'):
+            return len(self.args[1])
+        return 1
+
+
+class CursorBarrier:
+    """Queued behind pending tasks, it is set once every task before it is committed."""
+    def __init__(self):
+        self.event = Event()
+    
+    def __repr__(self):
+        return "<{} object is_set={}>".format(self.__class__.__name__, self.event.is_set())
 
 
 class CursorProxy:
-    def __init__(self, database:str, cursor: sqlite3.Cursor = None):
+    """
+    Proxies cursor methods to a background writer thread with its own connection.
+    Queued tasks are group committed, one transaction for every `batch_size` rows or `batch_interval` seconds, whichever comes first.
+    The queue holds at most `max_queue_size` rows until they are committed, proxied calls block when it is full.
+    """
+    STOP = None
+    
+    def __init__(self, database:str, cursor: sqlite3.Cursor = None, *, batch_size: int = 500, batch_interval: float = 0.05, max_queue_size: int = 10000, profile: Dict[str, Any] = None):
         self.database = database
+        self.profile = profile
         self.connection: sqlite3.Connection = None
         self.cursor: sqlite3.Cursor = cursor
         self.proxy_connection: sqlite3.Connection = None
         self.proxy_cursor: sqlite3.Cursor = None
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.errors: List[Tuple[CursorTask, Exception]] = []
         self.daemon: Thread = Thread(target=self.run_queued_task, name='CursorProxy Daemon Thread', daemon=True)
         self.queue: Queue = Queue()
+        self.max_queue_size = max_queue_size
+        self.queued_rows = 0
+        self._queued_rows_condition = Condition()
         self._proxy_map = {}
         self._init()
         
@@ -150,20 +434,92 @@ class CursorProxy:
         return self.cursor.__call__(*args, **kwds)
 
     def __repr__(self):
-        return "<{} object for cursor={}>".format(self.__class__.__name__, self.cursor)
+        return "<{} object for cursor={} queued={}>".format(self.__class__.__name__, self.cursor, self.queue.qsize())
 
     def run_queued_task(self):
+        self.proxy_connection = sqlite3.connect(self.database)
+        apply_profile(self.proxy_connection, self.profile)
+        self.proxy_cursor = self.proxy_connection.cursor()
         try:
-            self.proxy_connection = sqlite3.connect(self.database)
-            self.proxy_cursor = self.proxy_connection.cursor()
-            while True:
-                task: CursorTask = self.queue.get(True)
-                self.proxy_cursor.__getattribute__(task.target_method)(*task.args, **task.kwargs)
+            running = True
+            while running:
+                tasks, barriers, running = self.collect_batch()
+                try:
+                    self.commit_batch(tasks)
+                finally:
+                    self.release_rows(tasks)
+                for barrier in barriers:
+                    barrier.event.set()
         finally:
             self.proxy_cursor.close()
+            self.proxy_connection.close()
+    
+    def collect_batch(self):
+        """Blocks for the first task, then keeps collecting until the batch is full, its interval passed, or a barrier shows up."""
+        tasks, barriers, rows = [], [], 0
+        task = self.queue.get(True)
+        deadline = time.monotonic()+self.batch_interval
+        while True:
+            if task is self.STOP:
+                return tasks, barriers, False
+            if isinstance(task, CursorBarrier):
+                barriers.append(task)
+                break
+            tasks.append(task)
+            rows += task.row_count
+            timeout = deadline-time.monotonic()
+            if rows >= self.batch_size or timeout <= 0:
+                break
+            try:
+                task = self.queue.get(True, timeout)
+            except Empty:
+                break
+        return tasks, barriers, True
+    
+    def run_task(self, task: CursorTask):
+        return self.proxy_cursor.__getattribute__(task.target_method)(*task.args, **task.kwargs)
+    
+    def commit_batch(self, tasks: List[CursorTask]):
+        if not tasks:
+            return
+        metrics.set_gauge('db_write_queue_depth', self.queue.qsize())
+        commit_start = time.perf_counter()
+        try:
+            for task in tasks:
+                self.run_task(task)
+            self.proxy_connection.commit()
+            rows = sum(task.row_count for task in tasks)
+            metrics.observe('db_commit_seconds', time.perf_counter()-commit_start, writer='proxy')
+            metrics.observe('db_commit_batch_rows', rows)
+            metrics.increment('db_rows_written_total', rows, writer='proxy')
+        except sqlite3.Error:
+            self.proxy_connection.rollback()
+            # Replays the batch one task per transaction, so one bad task does not lose the others.
+            for task in tasks:
+                try:
+                    self.run_task(task)
+                    self.proxy_connection.commit()
+                except sqlite3.Error as exc:
+                    self.proxy_connection.rollback()
+                    self.errors.append((task, exc))
+                    metrics.increment('db_write_errors_total')
+                    print("CursorProxy Error: {!r} failed with {!r}".format(task, exc))
+                    if task.on_error is not None:
+                        task.on_error(exc)
     
-    def enqueue_task(self, method_name: str, args: Tuple, kwargs: Dict):
-        return self.queue.put(CursorTask(method_name, args, kwargs))
+    def enqueue_task(self, method_name: str, args: Tuple, kwargs: Dict, on_error: Callable[[Exception], None] = None):
+        task = CursorTask(method_name, args, kwargs, on_error)
+        with self._queued_rows_condition:
+            # A task with more rows than the whole queue still goes through, once the queue is empty.
+            self._queued_rows_condition.wait_for(lambda: not self.queued_rows or self.queued_rows+task.row_count <= self.max_queue_size)
+            self.queued_rows += task.row_count
+        return self.queue.put(task)
+    
+    def release_rows(self, tasks: List[CursorTask]):
+        """Frees the room taken by committed (or failed) tasks in the queue, waking up blocked proxied calls."""
+        with self._queued_rows_condition:
+            self.queued_rows -= sum(task.row_count for task in tasks)
+            self._queued_rows_condition.notify_all()
 
     def make_proxy(self, method_name: str):
         def prxy(*args, **kwargs):
@@ -174,10 +530,49 @@ class CursorProxy:
         if immediate:
             return self.cursor.__getattribute__(method_name)(*args, **kwargs)
         return self.enqueue_task(method_name, args=args, kwargs=kwargs)
+    
+    def flush(self):
+        """Blocks until every task queued before this call is committed."""
+        if not self.daemon.is_alive():
+            return
+        barrier = CursorBarrier()
+        self.queue.put(barrier)
+        barrier.event.wait()
+    
+    def close(self):
+        if not self.daemon.is_alive():
+            return
+        self.flush()
+        self.queue.put(self.STOP)
+        self.daemon.join()
 
 
 class MultiThreadedOsuDB(osuDB):
-    def __init__(self, *args, **kwargs):
+    """
+    osuDB whose writes go through a group committing CursorProxy, reads stay on this thread's connection.
+    The on_error callbacks of failed writes run on this thread too, at the next flush, as they touch state like the downloaded index.
+    """
+    def __init__(self, *args, batch_size: int = 500, batch_interval: float = 0.05, max_queue_size: int = 10000, **kwargs):
         super().__init__(*args, **kwargs)
-        self._cursor = self.cursor
-        self.cursor: CursorProxy = CursorProxy(self.database, self._cursor)
+        self.cursor_proxy: CursorProxy = CursorProxy(self.database, self.cursor, batch_size=batch_size, batch_interval=batch_interval, max_queue_size=max_queue_size, profile=self.profile)
+        self._failed_writes = deque()
+        atexit.register(self.close)
+    
+    def write(self, query: str, values: Union[Dict, Tuple, List] = (), *, many: bool = False, on_error: Callable[[Exception], None] = None):
+        # The writer thread only reports the failure, see run_failed_write_callbacks.
+        report_error = (lambda exc: self._failed_writes.append((on_error, exc))) if on_error is not None else None
+        self.cursor_proxy.enqueue_task('executemany' if many else 'execute', (query, values), {}, report_error)
+    
+    def run_failed_write_callbacks(self):
+        """Calls the on_error callbacks of the writes the writer thread failed to commit, on the calling thread."""
+        while self._failed_writes:
+            on_error, exc = self._failed_writes.popleft()
+            on_error(exc)
+    
+    def flush(self):
+        self.cursor_proxy.flush()
+        self.run_failed_write_callbacks()
+    
+    def close(self):
+        self.cursor_proxy.close()
+        super().close()
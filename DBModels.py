@@ -1,11 +1,11 @@
 
 from datetime import datetime
 from collections import namedtuple
-from msilib.schema import Property
 from types import NoneType
 
 
 ForeignKey = namedtuple('ForeignKey', ('key', 'referenced_table', 'referenced_key'))
+Index = namedtuple('Index', ('name', 'fields', 'unique'), defaults=(False,))
 BLOB = blob = type('BLOB')
 INT = Int = int
 STR = Str = str
@@ -18,31 +18,35 @@ class Field:
     """SQLITE3 Based Field Syntax"""
     # datetime: ISO8601 strings ("YYYY-MM-DD HH:MM:SS.SSS")
     TYPE_MAPPING = {int:'INTEGER', str:'TEXT', blob:'BLOB', float:'REAL', datetime:'TEXT', bool:'INTEGER', NoneType:'NULL'}
-    VALUE_CONVERTER = {int: int, str: lambda _s: '"{}"'.format(_s), float:float, 
-                               datetime: lambda dt:'"{}"'.format(dt.isoformat()), 
-                               bool: lambda _bool:1 if _bool else 0, -1: str} # -1 is default converter
+    # Converts values of the types sqlite3 does not bind as they are, the others are bound unchanged.
+    PARAM_CONVERTER = {datetime: lambda dt: dt.isoformat(' '), bool: lambda _bool: 1 if _bool else 0}
     
-    def __init__(self, name, _type, default=None, *, not_null: bool = False, primary_key: bool = False, auto_increment: bool = False, unique: bool = False, foreign_key: ForeignKey = None):
+    def __init__(self, name, _type, default=None, *, not_null: bool = False, primary_key: bool = False, auto_increment: bool = False, unique: bool = False, foreign_key: ForeignKey = None, index: bool = False):
         self.name = name
         self.type = _type
         self.settings = {'NOT NULL':not_null, 'PRIMARY KEY':primary_key, 'AUTO INCREMENT':auto_increment, 'UNIQUE':unique}
         self.default = default
         self.foreign_key = foreign_key
-    
-    @property
-    def value_converter(self):
-        return self.VALUE_CONVERTER.get(self.type, self.VALUE_CONVERTER[-1])
+        self.index = index
     
     def get_type_str(self):
         return self.TYPE_MAPPING.get(self.type)
     
     def get_default_value(self):
-        return self.value_converter(self.default) if self.default is not None else None
+        """Default as a statement parameter."""
+        if self.default is None:
+            return None
+        return self.PARAM_CONVERTER.get(self.type, lambda value: value)(self.default)
+    
+    def get_default_literal(self):
+        """Default as an SQL literal, for table definitions, where it can not be a parameter."""
+        value = self.get_default_value()
+        return "'{}'".format(value.replace("'", "''")) if isinstance(value, str) else str(value)
     
     def make_query(self):
         type_str = self.get_type_str()
         settings_str = " ".join([phrase for phrase, checked in self.settings.items() if checked])
-        default_str = "Default {}".format(self.get_default_value()) if self.default is not None else ''
+        default_str = "Default {}".format(self.get_default_literal()) if self.default is not None else ''
         # self.foreign_key = ('KEY_IN_THIS_TABLE', 'OTHER_TABLE', 'KEY_IN_OTHER_TABLE')
         foreign_key_str = (""",\nFOREIGN KEY({0.key}) REFERENCES "{0.referenced_table}"("{0.referenced_key}")""".format(self.foreign_key)) if self.foreign_key is not None and len(self.foreign_key) >= 3 else ""
         
@@ -51,6 +55,11 @@ class Field:
         entries = [self.name, type_str, settings_str, default_str]
         sub_strings = [phrase for phrase in entries if phrase.strip()]
         return (" ".join(sub_strings), foreign_key_str)
+    
+    def make_add_column_query(self):
+        # ALTER TABLE can not add PRIMARY KEY or UNIQUE columns, nor NOT NULL columns without a default.
+        entries = [self.name, self.get_type_str(), "Default {}".format(self.get_default_literal()) if self.default is not None else '']
+        return " ".join([phrase for phrase in entries if phrase.strip()])
 
 
 
@@ -67,16 +76,60 @@ class ModelMeta(type):
         queries = " ".join([field_queries, modifier_queries])
         return _s.format(table_name=cls.table_name, queries=queries)
 
-    def make_insert_query(cls, replace=False, ignore=False):
-        command = "INSERT " +("INTO OR IGNORE" if ignore else "OR REPLACE INTO" if replace else "INTO")
-        _s = "{command} {table_name} VALUES ({values_placeholder})".format(command=command, table_name=cls.table_name, 
-                                                                           values_placeholder=','.join([':{}'.format(field.name) for field in cls.FIELDS]))
-        return _s
+    @property
+    def indexes(cls):
+        """Secondary indexes declared with Field(index=True) and in INDEXES."""
+        field_indexes = [Index('ix_{}_{}'.format(cls.table_name, field.name), (field.name,)) for field in cls.FIELDS if field.index]
+        return field_indexes + list(cls.INDEXES)
+
+    def make_index_queries(cls):
+        _s = """CREATE {unique}INDEX IF NOT EXISTS "{name}" ON "{table_name}"({fields})"""
+        return [_s.format(unique='UNIQUE ' if index.unique else '', name=index.name, table_name=cls.table_name, fields=", ".join(index.fields)) for index in cls.indexes]
+
+    def make_add_column_queries(cls, existing_columns: list):
+        _s = """ALTER TABLE "{table_name}" ADD COLUMN {column}"""
+        return [_s.format(table_name=cls.table_name, column=field.make_add_column_query()) for field in cls.FIELDS if field.name not in existing_columns]
+
+    @property
+    def primary_keys(cls):
+        return [field.name for field in cls.FIELDS if field.settings['PRIMARY KEY']]
+
+    def compile_query(cls, key: tuple, build):
+        """Builds a query once per model class and key, later calls get the same string so sqlite3 reuses its prepared statement."""
+        compiled_queries = cls.__dict__.get('_compiled_queries')
+        if compiled_queries is None:
+            compiled_queries = {}
+            setattr(cls, '_compiled_queries', compiled_queries) # Per class, subclasses do not share their parent's queries
+        if key not in compiled_queries:
+            compiled_queries[key] = build()
+        return compiled_queries[key]
+
+    def make_insert_query(cls, replace=False, ignore=False, upsert=False):
+        """Insert with named parameters for every field. upsert updates every other field of an existing row in place."""
+        def build():
+            command = "INSERT " +("OR IGNORE INTO" if ignore else "OR REPLACE INTO" if replace else "INTO")
+            _s = "{command} {table_name} VALUES ({values_placeholder})".format(command=command, table_name=cls.table_name, 
+                                                                               values_placeholder=','.join([':{}'.format(field.name) for field in cls.FIELDS]))
+            if upsert:
+                updated_fields = [field.name for field in cls.FIELDS if field.name not in cls.primary_keys]
+                _s += " ON CONFLICT({}) DO UPDATE SET {}".format(", ".join(cls.primary_keys), ", ".join("{0}=excluded.{0}".format(name) for name in updated_fields))
+            return _s
+        return cls.compile_query(('insert', bool(replace), bool(ignore), bool(upsert)), build)
+
+    def make_select_by_key_query(cls):
+        """Select of one row, with positional parameters for the primary keys in FIELDS order."""
+        return cls.compile_query(('select_by_key',), lambda: "SELECT * FROM {} WHERE {}".format(cls.table_name, " AND ".join("{}=?".format(name) for name in cls.primary_keys)))
+
+    def make_select_by_fields_query(cls, field_names: tuple):
+        """Select of the rows matching every field in field_names, with named parameters."""
+        return cls.compile_query(('select_by_fields', tuple(field_names)),
+                                 lambda: "SELECT * FROM {} WHERE {}".format(cls.table_name, " AND ".join("{0}=:{0}".format(name) for name in field_names) or "1"))
 
 
 class Model(metaclass=ModelMeta):
     __TABLE_NAME__ = None
     FIELDS=[]
+    INDEXES=[]
     
     def __init__(self, data: dict):
         self.data = data
@@ -108,27 +161,22 @@ class Model(metaclass=ModelMeta):
                 entry_data[field.name] = field.get_default_value()
         return entry_data
         
-    def make_insert_args(self, replace=False, ignore=False):
-        query = self.__class__.make_insert_query()
+    def make_insert_args(self, replace=False, ignore=False, upsert=False):
+        query = self.__class__.make_insert_query(replace=replace, ignore=ignore, upsert=upsert)
         values = self.make_insert_values()
         return (query, values)
 
     def make_selector_query(self):
-        _s = "SELECT * FROM {table_name} WHERE {conditions}"
-        conditions = []
-        for field in self.FIELDS:
-            try:
-                conditions.append("{0}={1}".format(field.name, field.value_converter(self.data[field.name])))
-            except KeyError:
-                pass
-        return _s.format(table_name=self.__class__.table_name, conditions=" AND ".join(conditions))
+        """(query, params) selecting the rows matching every field present in data."""
+        params = {field.name: self.data[field.name] for field in self.FIELDS if field.name in self.data}
+        return (self.__class__.make_select_by_fields_query(tuple(params)), params)
 
 
 class Beatmap(Model):
     __TABLE_NAME__ = 'beatmaps'
     FIELDS = [Field('beatmap_id', int, not_null=True, primary_key=True, unique=True), 
-              Field('beatmapset_id', int, not_null=True), 
-              Field('approved', int, not_null=True),
+              Field('beatmapset_id', int, not_null=True, index=True), 
+              Field('approved', int, not_null=True), # Indexed by ix_beatmaps_approved_mode_difficultyrating
               Field('total_length', int, not_null=True),
               Field('hit_length', int, not_null=True),
               Field('version', str, not_null=True),
@@ -137,12 +185,12 @@ class Beatmap(Model):
               Field('diff_overall', int, not_null=True),
               Field('diff_approach', int, not_null=True),
               Field('diff_drain', int, not_null=True),
-              Field('mode', int, not_null=True),
+              Field('mode', int, not_null=True, index=True),
               Field('count_normal', int, not_null=True),
               Field('count_slider', int, not_null=True),
               Field('count_spinner', int, not_null=True),
               Field('submit_date', datetime, not_null=True),
-              Field('approved_date', datetime),
+              Field('approved_date', datetime, index=True),
               Field('last_update', datetime),
               Field('artist', str, not_null=True),
               Field('artist_unicode', str, not_null=True),
@@ -167,8 +215,9 @@ class Beatmap(Model):
               Field('max_combo', int),
               Field('diff_aim', float),
               Field('diff_speed', float),
-              Field('difficultyrating', float)
+              Field('difficultyrating', float, index=True)
               ]
+    INDEXES = [Index('ix_beatmaps_approved_mode_difficultyrating', ('approved', 'mode', 'difficultyrating'))]
     
     def __repr__(self) -> str:
         return "<{0} object beatmap_id={1[beatmap_id]} beatmapset_id={1[beatmapset_id]} approved={1[approved]} is_valid={2}>".format(self.__class__.__name__, self.data, self.valid)
@@ -178,5 +227,46 @@ class DownloadedBeatmapset(Model):
     __TABLE_NAME__ = 'downloaded_beatmapsets'
     FIELDS = [Field('beatmapset_id', int, not_null=True, primary_key=True, unique=True, 
                     foreign_key=ForeignKey(key='beatmapset_id', referenced_table=Beatmap.__TABLE_NAME__, referenced_key='beatmapset_id')),
-              Field('downloaded', bool, default=False)
+              Field('downloaded', bool, default=False),
+              Field('size', int),
+              Field('sha256', str),
+              Field('verified', bool, default=False), # Whether the zip structure was checked when it was downloaded
+              Field('downloaded_at', datetime),
+              Field('failures', int, default=0) # Failed download attempts, see osuDB.record_download_failure
+              ]
+
+
+class CrawlerState(Model):
+    __TABLE_NAME__ = 'crawler_state'
+    FIELDS = [Field('key', str, not_null=True, primary_key=True, unique=True),
+              Field('value', str)
+              ]
+
+
+class SchemaVersion(Model):
+    __TABLE_NAME__ = 'schema_version'
+    FIELDS = [Field('version', int, not_null=True, primary_key=True, unique=True),
+              Field('applied_at', datetime, not_null=True)
+              ]
+
+
+class DirectoryEntry(Model):
+    __TABLE_NAME__ = 'download_directory'
+    FIELDS = [Field('filename', str, not_null=True, primary_key=True, unique=True),
+              Field('beatmapset_id', int, index=True), # None when the filename does not follow formattable_beatmap_filename
+              Field('size', int, not_null=True),
+              Field('mtime', float, not_null=True)
+              ]
+
+
+class BackfillCheckpoint(Model):
+    __TABLE_NAME__ = 'backfill_checkpoints'
+    FIELDS = [Field('shard_key', str, not_null=True, primary_key=True, unique=True), # '{job}#{shard}'
+              Field('job', str, not_null=True, index=True),
+              Field('shard', int, not_null=True),
+              Field('since', datetime, not_null=True), # Exclusive, like the api's since
+              Field('until', datetime, not_null=True), # Inclusive
+              Field('checkpoint', datetime), # Latest approved_date recorded for the shard
+              Field('done', bool, default=False),
+              Field('updated_at', datetime)
               ]
@@ -1,7 +1,11 @@
 
 
 from enum import Enum
-from typing import Any
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Any, Iterator
+
+from DBModels import Beatmap as BeatmapModel
 
 
 __all__ = ['Config', 'Credential', 'Beatmap', 'User']
@@ -54,8 +58,71 @@ class ApprovedEnum(Enum):
     Graveyard = -2
 
 
-class Beatmap(BaseOsuObject):
+def coerce_number(value):
+    # INTEGER fields of the api may still carry decimals, e.g. diff_overall="8.5" or rating="9.12".
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def coerce_bool(value):
+    return bool(int(value)) if isinstance(value, str) else bool(value)
+
+
+FIELD_TYPE_COERCERS = {int: coerce_number, float: float, bool: coerce_bool, str: str, datetime: str}
+
+
+class Beatmap(Mapping):
+    """
+    Compact beatmap record, with one slot per DBModels.Beatmap field and values coerced to their field type once, on construction.
+    It is a read-only mapping, so Url and filename formatting, filters and DBModels.Beatmap insertion use it like the api's dict.
+    Dates are kept as their ISO8601 strings, the way they are stored in the database.
+    """
     REQUIRED_FIELDS = ['beatmap_id', 'beatmapset_id', 'approved', 'title', 'version']
+    FIELD_COERCERS = {field.name: FIELD_TYPE_COERCERS.get(field.type, str) for field in BeatmapModel.FIELDS}
+    __slots__ = tuple(FIELD_COERCERS) + ('_extra',)
+    
+    def __init__(self, data: Mapping = {}, **kw):
+        self._extra = None
+        for key, value in (dict(data, **kw) if kw else data).items():
+            self.__setitem__(key, value)
+    
+    def __setitem__(self, key: str, value: Any):
+        coercer = self.FIELD_COERCERS.get(key)
+        if coercer is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        else:
+            object.__setattr__(self, key, coercer(value) if value is not None else None)
+    
+    def __getitem__(self, key: str):
+        if key in self.FIELD_COERCERS:
+            try:
+                return object.__getattribute__(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+    
+    def __iter__(self) -> Iterator[str]:
+        for key in self.FIELD_COERCERS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+    
+    def __len__(self):
+        return sum(1 for _ in self.__iter__())
+    
+    @property
+    def valid(self):
+        return all(map(lambda key:self.__contains__(key), self.REQUIRED_FIELDS))
+    
     def __repr__(self):
         return "<{} object id={} beatmapset_id={} approved={} version={}>".format(self.__class__.__name__, self.beatmap_id, self.beatmapset_id, ApprovedEnum(int(self.approved)).name, self.version)
     def __str__(self):
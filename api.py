@@ -1,19 +1,42 @@
 import os
 import time
 import io
+import json
+import hashlib
+from threading import Lock, local
+from datetime import datetime, timedelta
+from collections import namedtuple
+from urllib.parse import urlsplit
+from http.client import HTTPException
 
 import requests
+import urllib3
 
 from utils import *
 from WrappedObjects import Config, Credential, Beatmap, User
+from DBModels import DownloadedBeatmapset
+from progress import ProgressReporter, make_progress_reporter
+from ratelimit import RateLimiter, backoff_delay, get_retry_after
+from cache import ResponseCache
+from metrics import Metrics
+from sources import DownloadSource, DownloadSources
 from constants import BASE_URL, TEMPORARY_FILE_SUFFIX, BEATMAPSET_EXTENSION, Url, Endpoint
 
 
 printer = PrettyPrinter._get_default()
+metrics = Metrics._get_default()
+
+
+# Returned by osuAPI.download for a complete download, size is the byte count and sha256 its hex digest.
+DownloadResult = namedtuple('DownloadResult', ('size', 'sha256'))
+# Returned by osuAPI.open_download_stream, first_chunk is read while racing the sources.
+DownloadStream = namedtuple('DownloadStream', ('response', 'first_chunk', 'source'))
+# Raised by the readinto of a streamed download body when a connection breaks off mid-body.
+DOWNLOAD_READ_ERRORS = (OSError, HTTPException, urllib3.exceptions.HTTPError)
 
 
 class osuAPI:
-    def __init__(self, api_key: str, credentials: Credential, config: Config, *, initialize=True):
+    def __init__(self, api_key: str, credentials: Credential, config: Config, *, initialize=True, rate_limiter: RateLimiter = None):
         self.api_key = api_key
         self.credentials = credentials
 
@@ -23,6 +46,15 @@ class osuAPI:
         self.session = requests.Session()
         self.session.headers = {'user-agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.75 Safari/537.36'}
         self._logged_in = False
+        self._login_lock = Lock()
+        self._login_time = 0.0
+        self.progress_reporter = make_progress_reporter(self.config.progress_mode, refresh_interval=self.config.progress_refresh_interval, 
+                                                        bar_length=self.config.download_progress_bar_length)
+        # Shared by every request of this api, including the ones made from download worker sessions.
+        self.rate_limiter = rate_limiter or RateLimiter(self.config.rate_limits)
+        self._cache: ResponseCache = None
+        self.sources = DownloadSources.from_config(self.config)
+        self._download_buffers = local()
         
         if initialize:
             self._init()
@@ -32,8 +64,10 @@ class osuAPI:
             os.makedirs(self.config.download_dir)
         except FileExistsError:
             pass
+        self.resolve_partial_downloads()
         
-        self._logged_in = self.login()
+        # A persisted session is trusted until a download fails to authenticate, see relogin.
+        self._logged_in = self.load_session() or self.login()
         
     @property
     def headers(self):
@@ -46,96 +80,432 @@ class osuAPI:
     def __repr__(self):
         return "<osuAPI LoggedIn={} Username={}>".format(self._logged_in, self.credentials.username)
     
-    def get_csrf_token(self):
-        resp = self.session.get(Url.home)
-        self._cached_last_resp['get_csrf_token'] = resp
-        if resp.status_code == 200:
-            homepage_content = resp.text
-            match = CSRF_TOKEN_REGEX.match(homepage_content)
+    @property
+    def cache(self):
+        """Response cache for the metadata endpoints, opened on first use. None when config.use_cache is off."""
+        if self._cache is None and self.config.use_cache:
+            self._cache = ResponseCache(self.config.cache_database, ttls=self.config.cache_ttls, max_size=self.config.cache_max_size, 
+                                        max_entry_size=self.config.cache_max_entry_size)
+        return self._cache
+    
+    def make_session(self):
+        """Makes a new session with this api's headers and cookies, so another worker gets its own connection pool."""
+        session = requests.Session()
+        session.headers = dict(self.session.headers)
+        session.cookies.update(self.session.cookies)
+        return session
+    
+    def send(self, method: str, url: str, category: str = 'api', *, session: requests.Session = None, max_retries: int = None, **kw):
+        """
+        Sends a request within the rate budget of its category ('api', 'download' or a mirror's).
+        429s, 5xx responses and connection errors are retried up to max_retries times, config.max_retries by default, after Retry-After or a jittered exponential backoff.
+        A 429 pauses the whole category, so every worker sharing the rate limiter backs off together.
+        """
+        session = session or self.session
+        max_retries = self.config.max_retries if max_retries is None else max_retries
+        if url.startswith(BASE_URL) and self.config.base_url != BASE_URL:
+            # Lets the api run against another host, e.g. the local stand-in server of bench.py.
+            url = self.config.base_url+url[len(BASE_URL):]
+        endpoint = self.get_endpoint_name(url, category)
+        for attempt in range(max_retries+1):
+            metrics.observe('rate_limiter_wait_seconds', self.rate_limiter.acquire(category), category=category)
+            request_start = time.perf_counter()
             try:
-                return match.group(1)
-            except AttributeError:
+                resp = session.request(method, url, **kw)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                metrics.increment('api_request_errors_total', endpoint=endpoint, error=exc.__class__.__name__)
+                if attempt >= max_retries:
+                    raise
+                metrics.increment('api_retries_total', endpoint=endpoint)
+                delay = backoff_delay(attempt, self.config.retry_backoff_base, self.config.retry_backoff_cap)
+                printer.print_debug('Send Retry', {'Url': url, 'Attempt': attempt+1, 'Error': repr(exc), 'Delay': delay})
+                time.sleep(delay)
+                continue
+            
+            # Streamed responses are timed up to their headers, the body is read later by the caller.
+            metrics.observe('api_request_seconds', time.perf_counter()-request_start, endpoint=endpoint)
+            metrics.increment('api_requests_total', endpoint=endpoint, status=resp.status_code)
+            if resp.status_code == 429:
+                metrics.increment('api_rate_limited_total', endpoint=endpoint)
+            if (resp.status_code != 429 and resp.status_code < 500) or attempt >= max_retries:
+                return resp
+            metrics.increment('api_retries_total', endpoint=endpoint)
+            retry_after = get_retry_after(resp)
+            delay = retry_after if retry_after is not None else backoff_delay(attempt, self.config.retry_backoff_base, self.config.retry_backoff_cap)
+            printer.print_debug('Send Retry', {'Url': url, 'Attempt': attempt+1, 'Status Code': resp.status_code, 'Delay': delay})
+            resp.close()
+            if resp.status_code == 429:
+                self.rate_limiter.pause(category, delay)
+            else:
+                time.sleep(delay)
+        return resp
+    
+    @staticmethod
+    def get_endpoint_name(url: str, category: str = 'api'):
+        """Metrics label of a request, the category for downloads and the last part of the url path otherwise, e.g. 'get_beatmaps'."""
+        if category != 'api':
+            return category
+        return urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1] or 'home'
+    
+    def get_csrf_token(self):
+        """Streams the homepage only until the csrf-token meta tag shows up, or CSRF_TOKEN_SCAN_LIMIT bytes have been read."""
+        with self.send('GET', Url.home, stream=True) as resp:
+            self._cached_last_resp['get_csrf_token'] = resp
+            if resp.status_code == 200:
+                homepage_content = ''
+                for chunk in resp.iter_content(8192, decode_unicode=True):
+                    # Rescans a little of the previous chunks, in case the tag is split between chunks.
+                    search_start = max(len(homepage_content)-256, 0)
+                    homepage_content += chunk if isinstance(chunk, str) else chunk.decode('utf-8', 'ignore')
+                    match = CSRF_TOKEN_REGEX.search(homepage_content, search_start)
+                    if match is not None:
+                        return match.group(1)
+                    if len(homepage_content) >= CSRF_TOKEN_SCAN_LIMIT:
+                        break
                 print("CSRF Token Error: Could not find CSRF token in the page.")
-        elif resp.status_code == 429:
-            print("CSRF Token Error: 429 Too Many Requests.")
+            elif resp.status_code == 429:
+                print("CSRF Token Error: 429 Too Many Requests.")
     
     def login(self):
         data = dict(self.credentials)
         data['_token'] = self.get_csrf_token()
         headers = {'referer': Url.home}
         
-        resp = self.session.post(Url.session, data=data, headers=headers)
+        resp = self.send('POST', Url.session, data=data, headers=headers)
         self._cached_last_resp['login'] = resp
+        self._login_time = time.monotonic()
         
         printer.print_debug('Login Process', 
                             {'Data': data, 'Headers': headers, 'Status Code': resp.status_code})
+        if resp.ok:
+            self.save_session()
         return resp.ok
     
-    def request(self, url: str, *, params: dict = {}, **kw):
+    def relogin(self, session: requests.Session = None, min_interval: float = 30.0):
+        """
+        Logs in again after an authentication failure, then copies the new cookies into session (a worker's session).
+        Workers failing together only log in once, a login less than min_interval seconds ago is reused.
+        """
+        with self._login_lock:
+            if time.monotonic()-self._login_time >= min_interval:
+                self._logged_in = self.login()
+        if session is not None and session is not self.session:
+            session.cookies.update(self.session.cookies)
+        return self._logged_in
+    
+    def save_session(self):
+        """Persists the session cookies to config.session_file, readable by the current user only."""
+        if not self.config.session_file:
+            return
+        cookies = [{'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path, 
+                    'expires': cookie.expires, 'secure': cookie.secure} for cookie in self.session.cookies]
+        file_descriptor = os.open(self.config.session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(self.config.session_file, 0o600)
+        with open(file_descriptor, 'w', encoding='utf-8') as file:
+            json.dump({'username': self.credentials.get('username'), 'saved_at': time.time(), 'cookies': cookies}, file)
+    
+    def load_session(self):
+        """Restores cookies saved by save_session for the same username. Returns whether an unexpired session was restored."""
+        if not self.config.session_file or not os.path.isfile(self.config.session_file):
+            return False
+        try:
+            saved_session = load_json(self.config.session_file)
+        except ValueError:
+            return False
+        if saved_session.get('username') != self.credentials.get('username'):
+            return False
+        
+        now = time.time()
+        cookies = [cookie for cookie in saved_session.get('cookies', []) if cookie['expires'] is None or cookie['expires'] > now]
+        if not cookies or (self.config.session_max_age is not None and now-saved_session.get('saved_at', 0) > self.config.session_max_age):
+            return False
+        for cookie in cookies:
+            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'], expires=cookie['expires'], secure=cookie['secure'])
+        
+        printer.print_debug('Load Session Process', 
+                            {'Session File': self.config.session_file, 'Cookies': [cookie['name'] for cookie in cookies]})
+        return True
+    
+    def request(self, url: str, *, params: dict = {}, use_cache: bool = True, **kw):
+        """
+        GET on the api. Responses are served from and stored into the response cache, unless use_cache is False or config.refresh_cache is set.
+        Streamed responses are stored once their body has been read to the end, see ResponseCache.tee.
+        """
         url = url if url.startswith(BASE_URL) else BASE_URL+(url if url.startswith('/') else '/{}'.format(url))
-        params.update({'k': self.api_key})
+        cache = self.cache if use_cache else None
         
-        resp = self.session.get(url=url, params=params, **kw)
+        resp = cache.get(url, params) if cache is not None and not self.config.refresh_cache else None
+        if resp is None:
+            resp = self.send('GET', url, params=dict(params, k=self.api_key), **kw)
+            if cache is not None and kw.get('stream'):
+                cache.tee(url, params, resp)
+            elif cache is not None:
+                cache.put(url, params, resp)
         self._cached_last_resp['request'] = resp
         
         printer.print_debug('Request Process', 
-                            {'Url':url, 'Params': params, 'Status Code': resp.status_code})
+                            {'Url':url, 'Params': params, 'Status Code': resp.status_code, 'From Cache': getattr(resp, 'from_cache', False)})
         return resp
     
-    def download(self, beatmap: Beatmap, pipe_handler: io.BytesIO, params={}, retry=False):
-        beatmapset_url = Url.formattable_beatmapset.format(beatmap)
-        beatmapset_download_url = Url.formattable_beatmapset_download.format(beatmap)
+    def get_chunk_size(self, content_length: int):
+        """Chunk size grows with the download, from config.download_chunk_size up to config.download_max_chunk_size."""
+        return max(self.config.download_chunk_size, min(content_length//256, self.config.download_max_chunk_size))
+    
+    def get_download_buffer(self) -> memoryview:
+        """Buffer downloads are read into, allocated once per thread and reused by every download made from it."""
+        size = self.config.download_buffer_size or self.config.download_max_chunk_size
+        buffer = getattr(self._download_buffers, 'buffer', None)
+        if buffer is None or len(buffer) != size:
+            buffer = self._download_buffers.buffer = memoryview(bytearray(size))
+        return buffer
+    
+    def open_download_stream(self, beatmap: Beatmap, *, session: requests.Session = None, params={}, headers={}) -> DownloadStream:
+        """
+        Requests the beatmapset from the best ranked download source, racing and failing over to the others as described in DownloadSources.
+        A source wins once its first chunk arrives. When every source failed, the response of the best ranked one is returned.
+        """
+        session = session or self.session
+        sources = self.sources.rank(beatmap)
+        def attempt(source: DownloadSource):
+            # A source with others to fail over to is not retried, failing over is quicker.
+            resp = self.send('GET', source.make_url(beatmap), source.category, session=session, max_retries=0 if len(sources) > 1 else None,
+                             params=params, headers=dict(source.make_headers(beatmap), **headers), allow_redirects=True, stream=True)
+            if not resp.ok:
+                return DownloadStream(resp, b'', source)
+            return DownloadStream(resp, resp.raw.read(self.config.download_chunk_size, decode_content=False), source)
+        # 416 is about the partial file rather than the source, download handles it.
+        should_fail_over = lambda stream: stream.response.status_code >= 400 and stream.response.status_code != 416
+        return self.sources.race(sources, attempt, should_fail_over, discard=lambda stream: stream.response.close())
+    
+    def download(self, beatmap: Beatmap, pipe_handler: io.BytesIO, params={}, retry=False, *, session: requests.Session = None, reporter: ProgressReporter = None, resume: bool = False, relogin: bool = True):
+        session = session or self.session
+        reporter = reporter or self.progress_reporter
         
-        headers = {'referer': beatmapset_url}
+        # Content-Length, Range and the hash all count the bytes of the .osz, which an encoded body would not be.
+        headers = {'accept-encoding': 'identity'}
+        # When resuming, pipe_handler is positioned at the end of the partial bytes.
+        offset = pipe_handler.tell() if resume else 0
+        if offset:
+            headers['range'] = 'bytes={}-'.format(offset)
         
-        with self.session.get(url=beatmapset_download_url, params=params, headers=headers, allow_redirects=True, stream=True) as download_stream:
-            start_time = time.time()
-            # progress = 0
-            max_progress = int(download_stream.headers['Content-Length'])
+        position = expected_size = None
+        download_stream, chunk, source = self.open_download_stream(beatmap, session=session, params=params, headers=headers)
+        with download_stream:
+            # A 206 starting anywhere but at the end of the partial bytes would be spliced onto them.
+            misplaced = download_stream.status_code == 206 and get_content_range_start(download_stream.headers.get('Content-Range')) != offset
+            if offset and (download_stream.status_code in (200, 416) or misplaced):
+                # Server ignored, rejected or misplaced the range, the partial bytes are rewritten from the start.
+                pipe_handler.seek(0)
+                pipe_handler.truncate()
+                offset = 0
             
-            for chunk in download_stream.iter_content(self.config.download_chunk_size):
-                if not chunk:
-                    break
-                pipe_handler.write(chunk)
-                elapsed_time = time.time()-start_time+0.001 # +1ms, prevent div by 0 error
-                suffix = " | {curr} of {max}    {speed} ({elapsed_time}s)"
-                suffix = suffix.format(curr=metric_size_formatter(pipe_handler.tell()), max=metric_size_formatter(max_progress), 
-                                       speed=metric_size_formatter(round(pipe_handler.tell()/elapsed_time, 2), suffix='bps'), elapsed_time=round(elapsed_time,2))
-                print(make_progress_bar(pipe_handler.tell(), length=self.config.download_progress_bar_length, vmax=max_progress, suffix=suffix), end=' '*5)
-            print('\nDownloaded Beatmap.')
+            if download_stream.ok and not misplaced:
+                content_length = int(download_stream.headers['Content-Length'])
+                expected_size = offset+content_length
+                # Only the partial bytes of a resumed download are read back, the rest is hashed as it is written.
+                hasher = make_file_hasher(pipe_handler, offset) if offset else hashlib.sha256()
+                position = offset
+                preallocated = self.config.preallocate_downloads and preallocate_file(pipe_handler, offset, content_length)
+                # Every read lands in the same buffer, chunks are views of it written out before the next read.
+                readinto = download_stream.raw.readinto
+                buffer = self.get_download_buffer()
+                buffer = buffer[:min(len(buffer), self.config.download_buffer_size or self.get_chunk_size(content_length))]
+                download_start = time.perf_counter()
+                reporter.start(beatmap['beatmapset_id'], expected_size, offset)
+                try:
+                    while chunk:
+                        pipe_handler.write(chunk)
+                        hasher.update(chunk)
+                        position += len(chunk)
+                        reporter.update(beatmap['beatmapset_id'], position)
+                        try:
+                            chunk = buffer[:readinto(buffer)]
+                        except DOWNLOAD_READ_ERRORS as exc:
+                            printer.print_debug('Download Read Error', {'Beatmapset Id': beatmap['beatmapset_id'], 'Position': position, 'Error': repr(exc)})
+                            break
+                finally:
+                    if preallocated and position < expected_size:
+                        # Drops the reserved bytes past the prefix, interrupted or not, as a resumed download appends from the end of the file.
+                        pipe_handler.truncate(position)
+                reporter.finish(beatmap['beatmapset_id'], position == expected_size)
+                if position == expected_size:
+                    # Read to the end outside of iter_content, which is what lets requests hand the connection back to the pool.
+                    download_stream.raw.release_conn()
+                download_time = time.perf_counter()-download_start
+                metrics.increment('download_bytes_total', position-offset)
+                metrics.observe('download_seconds', download_time)
+                metrics.observe('download_throughput_bytes_per_second', (position-offset)/max(download_time, 1e-6))
+                source.record_throughput((position-offset)/max(download_time, 1e-6))
         
         printer.print_debug('Download Process', 
-                            {'Beatmap Info':beatmap, 'Download Url':beatmapset_download_url, 'Beatmapset Url': beatmapset_url, 
-                             'Target File Stream': repr(pipe_handler), 'Params': params, 'Status Code': download_stream.status_code})
-        if download_stream.ok:
-            return True
+                            {'Beatmap Info':beatmap, 'Download Url':download_stream.url, 'Source': source.name, 
+                             'Target File Stream': repr(pipe_handler), 'Params': params, 'Resumed From': offset, 'Status Code': download_stream.status_code,
+                             'Size': position, 'Expected Size': expected_size})
+        if misplaced:
+            metrics.increment('download_misplaced_ranges_total')
+            print("Download Error: Beatmapset {} was sent from another position than requested.".format(beatmap['beatmapset_id']))
+            if resume:
+                # The partial file has been truncated above, the download restarts without a range.
+                return self.download(beatmap, pipe_handler, params=params, retry=retry, session=session, reporter=reporter)
+        elif download_stream.ok and position == expected_size:
+            return DownloadResult(position, hasher.hexdigest())
+        elif download_stream.ok:
+            metrics.increment('download_incomplete_total')
+            print("Download Error: Received {} of {} bytes for beatmapset {}.".format(position, expected_size, beatmap['beatmapset_id']))
+            if position > expected_size:
+                # More bytes than announced, none of them can be trusted.
+                pipe_handler.seek(0)
+                pipe_handler.truncate()
+            # A connection closed early leaves a prefix, which a retry resumes from.
+            resume = position < expected_size
+        if download_stream.status_code in (401, 403) and relogin and self.relogin(session):
+            return self.download(beatmap, pipe_handler, params=params, retry=retry, session=session, reporter=reporter, resume=resume, relogin=False)
+        if download_stream.status_code == 416 and resume:
+            # The partial file is not a prefix of the beatmapset anymore, and has been truncated above.
+            return self.download(beatmap, pipe_handler, params=params, retry=retry, session=session, reporter=reporter)
         if retry:
-            return self.download(beatmap, pipe_handler, retry)
+            # retry is how many more times to try, True counts as once.
+            time.sleep(backoff_delay(0, self.config.retry_backoff_base, self.config.retry_backoff_cap))
+            return self.download(beatmap, pipe_handler, params=params, retry=int(retry)-1, session=session, reporter=reporter, resume=resume)
 
-    def download_to_file(self, beatmap: Beatmap, filename: str = None, params={}):
+    def download_to_file(self, beatmap: Beatmap, filename: str = None, params={}, **downloadKw):
+        """
+        Downloads a beatmapset into the download directory, through a temporary file renamed once the download is complete.
+        With config.download_direct_to_file it is written to its final filename instead, and removed when the download fails.
+        Returns its DownloadedBeatmapset record with size, sha256 and whether the zip structure was verified, or None when it failed.
+        """
         filename = (filename or self.config.formattable_beatmap_filename).format(beatmap)
         filename = filename if filename.endswith(BEATMAPSET_EXTENSION) else filename+BEATMAPSET_EXTENSION
         filename = remove_illegal_name_characters(filename)
         
         filepath = os.path.join(self.config.download_dir, filename)
+        direct = self.config.download_direct_to_file
+        temp_filepath = filepath if direct else filepath+TEMPORARY_FILE_SUFFIX
+        # A file at the final filename is a complete beatmapset, only temporary files are resumed.
+        resume = not direct and self.config.resume_downloads and os.path.isfile(temp_filepath)
+        
+        verified = opened = False
+        try:
+            with open(temp_filepath, 'r+b' if resume else 'w+b') as file_handler:
+                opened = True
+                if resume:
+                    # A process killed mid-download leaves the rest of its preallocated bytes as zeros.
+                    trim_trailing_zeros(file_handler)
+                else:
+                    file_handler.seek(0, os.SEEK_END)
+                result = self.download(beatmap, file_handler, params=params, resume=resume, **downloadKw)
+                file_handler.flush()
+                if result and self.config.verify_downloads:
+                    verified = check_zip_structure(file_handler)
+        except BaseException:
+            if direct and opened and os.path.isfile(filepath):
+                # Interrupted, e.g. by a KeyboardInterrupt, the partial file must not be taken for a downloaded beatmapset either.
+                os.remove(filepath)
+            raise
         
-        success = False
-        with open(filepath+TEMPORARY_FILE_SUFFIX, 'wb') as file_handler:
-            success = self.download(beatmap, file_handler, params=params)
-            file_handler.flush()
-        if success:
+        if result and self.config.verify_downloads and not verified:
+            # Complete but not a zip archive, e.g. an error page served with a 200. Resuming it would not help.
+            os.remove(temp_filepath)
+            print("Download Error: Beatmapset {} is not a valid .osz archive.".format(beatmap['beatmapset_id']))
+            metrics.increment('download_verification_failures_total')
+            result = None
+        if not result and direct and os.path.isfile(filepath):
+            # Left in place, a partial file would be taken for a downloaded beatmapset by reconcile_download_dir.
+            os.remove(filepath)
+        if result and not direct:
             try:
-                os.rename(filepath+TEMPORARY_FILE_SUFFIX, filepath)
+                os.rename(temp_filepath, filepath)
             except FileExistsError:
-                os.replace(filepath+TEMPORARY_FILE_SUFFIX, filepath)
+                os.replace(temp_filepath, filepath)
                 pass
+        metrics.increment('downloads_total', result='success' if result else 'failed', resumed=resume)
+        if not result:
+            return None
+        return DownloadedBeatmapset({'beatmapset_id': int(beatmap['beatmapset_id']), 'downloaded': True, 'size': result.size, 'sha256': result.sha256, 
+                                     'verified': verified, 'downloaded_at': datetime.now().isoformat(' ', 'seconds')})
     
-    def get_beatmaps(self, params: dict):
-        resp = self.request(url=Endpoint.get_beatmaps, params=params)
+    def resolve_partial_downloads(self):
+        """
+        Looks for partial downloads left in the download directory by interrupted runs.
+        Empty partials, partials whose beatmapset has been completed and partials older than config.partial_download_max_age are removed,
+        the rest are kept to be resumed by download_to_file.
+        """
+        resolved = {'resumable': [], 'removed': []}
+        max_age = self.config.partial_download_max_age
+        now = time.time()
+        with os.scandir(self.config.download_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(TEMPORARY_FILE_SUFFIX) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                completed = os.path.exists(entry.path[:-len(TEMPORARY_FILE_SUFFIX)])
+                expired = max_age is not None and now-stat.st_mtime > max_age
+                if stat.st_size == 0 or completed or expired or not self.config.resume_downloads:
+                    os.remove(entry.path)
+                    resolved['removed'].append(entry.name)
+                else:
+                    resolved['resumable'].append(entry.name)
+        
+        printer.print_debug('Resolve Partial Downloads Process', 
+                            {'Resumable': resolved['resumable'], 'Removed': resolved['removed']})
+        return resolved
+    
+    @staticmethod
+    def iter_response_objects(resp: requests.Response, object_type: type, chunk_size: int = 64*1024):
+        """Decodes a streamed json array response into object_type objects while it is still arriving."""
+        chunks = resp.iter_content(chunk_size)
+        try:
+            for entry in iter_json_array(chunks, encoding=resp.encoding or 'utf-8'):
+                yield object_type(entry)
+            # Reads past the closing bracket to the end of the body, so a response cache teeing it can store it.
+            for _ in chunks:
+                pass
+        finally:
+            resp.close()
+    
+    def get_beatmaps(self, params: dict, stream: bool = False):
+        """Returns a list of beatmaps, or with stream, a generator yielding them as the response is decoded."""
+        resp = self.request(url=Endpoint.get_beatmaps, params=params, stream=stream)
         if resp.ok:
+            if stream:
+                return self.iter_response_objects(resp, Beatmap)
             return [Beatmap(entry) for entry in resp.json()]
     
-    def get_users(self, params: dict):
-        resp = self.request(url=Endpoint.get_user, params=params)
+    @staticmethod
+    def get_watermark(beatmaps: list):
+        """Returns the latest approved_date in beatmaps, or None if none of them are approved."""
+        approved_dates = [str(beatmap['approved_date']) for beatmap in beatmaps if beatmap['approved_date']]
+        return max(approved_dates) if approved_dates else None
+    
+    def iter_beatmap_pages(self, params: dict, page_size: int = 500, *, until: str = None, strict: bool = False):
+        """
+        Pages forward through get_beatmaps by approved_date, yielding every page, up to the page reaching until when it is given.
+        The api filters with approved_date > since, so every page after the first starts one second before the previous watermark,
+        rows on the boundary are fetched twice rather than lost.
+        A failed request ends the paging, or raises a RuntimeError with strict, so callers can tell it from the end of the beatmaps.
+        """
+        params = dict(params, limit=page_size)
+        while True:
+            page = self.get_beatmaps(params)
+            if page is None and strict:
+                raise RuntimeError("get_beatmaps failed for since={}".format(params.get('since')))
+            if not page:
+                return
+            yield page
+            
+            watermark = self.get_watermark(page)
+            if len(page) < page_size or watermark is None or (until is not None and watermark >= until):
+                return
+            since = (datetime.strptime(watermark, '%Y-%m-%d %H:%M:%S')-timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S')
+            if params.get('since') is not None and str(params['since']) >= since:
+                # Whole page shares one approved_date, paging further would return this page again.
+                print("Crawler Warning: more than {} beatmaps approved at {}, some may be skipped.".format(page_size, watermark))
+                return
+            params['since'] = since
+    
+    def get_users(self, params: dict, stream: bool = False):
+        resp = self.request(url=Endpoint.get_user, params=params, stream=stream)
         if resp.ok:
+            if stream:
+                return self.iter_response_objects(resp, User)
             return [User(entry) for entry in resp.json()]
@@ -0,0 +1,155 @@
+import time
+import multiprocessing
+from queue import Empty
+from datetime import datetime, timedelta
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from WrappedObjects import Config, Credential
+from DBManager import osuDB
+from api import osuAPI
+from metrics import Metrics
+
+from typing import Dict, List, Tuple
+
+
+__all__ = ['make_shards', 'run_shard', 'Backfill']
+
+
+metrics = Metrics._get_default()
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+OSU_EPOCH = datetime(2007, 1, 1)
+
+
+def make_shards(since: datetime, until: datetime, count: int) -> List[Tuple[str, str]]:
+    """Splits (since, until] into count consecutive (since, until] ranges of equal length, as datetime strings."""
+    step = (until-since)/count
+    bounds = [(since+step*i).strftime(DATETIME_FORMAT) for i in range(count)] + [until.strftime(DATETIME_FORMAT)]
+    return [(bounds[i], bounds[i+1]) for i in range(count) if bounds[i] < bounds[i+1]]
+
+
+def run_shard(api_key: str, credentials: Credential, config: Config, params: Dict, shard: int, since: str, until: str, messages) -> int:
+    """
+    Runs in a pool process. Pages through get_beatmaps over (since, until] with an osuAPI of its own, sending every page to the parent
+    through messages as ('page', shard, beatmaps, watermark), then ('done', shard, count). Nothing is written to the database here.
+    """
+    api = osuAPI(api_key, credentials, config, initialize=False)
+    count = 0
+    for page in api.iter_beatmap_pages(dict(params, since=since), until=until, strict=True):
+        # Beatmaps past until belong to the next shard.
+        beatmaps = [dict(beatmap) for beatmap in page if beatmap['approved_date'] and str(beatmap['approved_date']) <= until]
+        watermark = osuAPI.get_watermark(beatmaps)
+        messages.put(('page', shard, beatmaps, watermark))
+        count += len(beatmaps)
+    messages.put(('done', shard, count))
+    return count
+
+
+class Backfill:
+    """
+    Fetches every beatmap approved in a date range, split into shards crawled in parallel by a pool of processes.
+    Each process gets an equal share of the api rate budget, so together they stay within config.rate_limits.
+    Pages are sent back to this process, the only one writing to the database, along with a checkpoint of their shard,
+    so a killed backfill resumes every shard from its last recorded page when it is run again with the same range.
+    """
+    def __init__(self, db: osuDB, api_key: str, credentials: Credential, config: Config, params: Dict = {}, *, shards: int = 16, processes: int = 4):
+        self.db = db
+        self.api_key = api_key
+        self.credentials = credentials
+        self.config = config
+        self.params = {key: val for key, val in params.items() if key not in ('since', 'limit')}
+        self.shards = max(int(shards), 1)
+        self.processes = max(int(processes), 1)
+        self.checkpoints: Dict[int, Dict] = {}
+
+    def __repr__(self):
+        return "<{} object shards={} processes={} params={}>".format(self.__class__.__name__, self.shards, self.processes, self.params)
+
+    def make_job(self, since: datetime, until: datetime) -> str:
+        return "since={} until={}{}".format(since.strftime(DATETIME_FORMAT), until.strftime(DATETIME_FORMAT),
+                                           ''.join(' {}={}'.format(key, self.params[key]) for key in sorted(self.params)))
+
+    def make_worker_config(self) -> Config:
+        """Config for the pool processes: their share of the rate budget, without the response cache and progress output."""
+        rate_limits = {category: (rate/self.processes, max(int(burst)//self.processes, 1)) for category, (rate, burst) in self.config.rate_limits.items()}
+        return Config(self.config, rate_limits=rate_limits, use_cache=False, progress_mode='quiet')
+
+    def plan(self, since: datetime, until: datetime) -> List[Dict]:
+        """Checkpoints of every shard of the job, the ones recorded by a previous run of the same range when there are any."""
+        job = self.make_job(since, until)
+        checkpoints = self.db.get_backfill_checkpoints(job)
+        if not checkpoints:
+            checkpoints = [{'shard_key': '{}#{}'.format(job, shard), 'job': job, 'shard': shard, 'since': shard_since, 'until': shard_until,
+                            'checkpoint': None, 'done': False, 'updated_at': None}
+                           for shard, (shard_since, shard_until) in enumerate(make_shards(since, until, self.shards))]
+            self.db.set_backfill_checkpoints(checkpoints)
+            self.db.flush()
+        self.checkpoints = {checkpoint['shard']: dict(checkpoint) for checkpoint in checkpoints}
+        return checkpoints
+
+    @staticmethod
+    def get_resume_since(checkpoint: Dict) -> str:
+        if checkpoint['checkpoint'] is None:
+            return checkpoint['since']
+        # One second back, like osuAPI.iter_beatmap_pages, as the api filters with approved_date > since.
+        resume_since = (datetime.strptime(checkpoint['checkpoint'], DATETIME_FORMAT)-timedelta(seconds=1)).strftime(DATETIME_FORMAT)
+        return max(checkpoint['since'], resume_since)
+
+    def handle_message(self, message: Tuple):
+        kind, shard = message[:2]
+        checkpoint = self.checkpoints[shard]
+        if kind == 'page':
+            beatmaps, watermark = message[2:]
+            if beatmaps:
+                self.db.add_beatmaps(beatmaps, replace=True)
+                metrics.increment('backfill_beatmaps_total', len(beatmaps))
+            if watermark is not None and (checkpoint['checkpoint'] is None or watermark > checkpoint['checkpoint']):
+                checkpoint['checkpoint'] = watermark
+        elif kind == 'done':
+            checkpoint['done'] = True
+            print("Backfill Shard #{} Done: {} Beatmaps approved in ({}, {}].".format(shard, message[2], checkpoint['since'], checkpoint['until']))
+        checkpoint['updated_at'] = datetime.now().isoformat(' ', 'seconds')
+        # Queued after the page's beatmaps on the same writer, so a checkpoint is never committed before its beatmaps.
+        self.db.set_backfill_checkpoints([checkpoint])
+
+    def run(self, since: datetime = None, until: datetime = None) -> Dict[str, List[int]]:
+        """Backfills (since, until], by default from the first osu! beatmaps up to the start of today. Returns the done and failed shards."""
+        since = since or OSU_EPOCH
+        until = until or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        pending = [checkpoint for checkpoint in self.plan(since, until) if not checkpoint['done']]
+        result = {'done': [shard for shard, checkpoint in self.checkpoints.items() if checkpoint['done']], 'failed': []}
+        if not pending:
+            print("Nothing to Backfill, every Shard of {} is done.".format(self.make_job(since, until)))
+            return result
+        print("Backfilling {} of {} Shards with {} Processes, {}...".format(len(pending), len(self.checkpoints), self.processes, self.make_job(since, until)))
+
+        start = time.perf_counter()
+        worker_config = self.make_worker_config()
+        # Spawned, as forking would copy the database writer and metrics threads of this process.
+        context = multiprocessing.get_context('spawn')
+        with context.Manager() as manager, ProcessPoolExecutor(max_workers=self.processes, mp_context=context) as executor:
+            messages = manager.Queue(maxsize=self.processes*4)
+            futures: Dict[Future, int] = {executor.submit(run_shard, self.api_key, self.credentials, worker_config, self.params, checkpoint['shard'],
+                                                          self.get_resume_since(checkpoint), checkpoint['until'], messages): checkpoint['shard']
+                                          for checkpoint in pending}
+            while futures:
+                try:
+                    self.handle_message(messages.get(timeout=0.1))
+                    continue
+                except Empty:
+                    pass
+                for future in [future for future in futures if future.done()]:
+                    shard = futures.pop(future)
+                    if future.exception() is not None:
+                        print("Backfill Shard #{} Failed: {}".format(shard, future.exception()))
+                        result['failed'].append(shard)
+            # Shards put every message before finishing, anything left is already in the queue.
+            while not messages.empty():
+                self.handle_message(messages.get())
+        self.db.flush()
+
+        result['done'] = [shard for shard, checkpoint in self.checkpoints.items() if checkpoint['done']]
+        metrics.increment('backfill_shards_total', len(result['done']), result='done')
+        metrics.increment('backfill_shards_total', len(result['failed']), result='failed')
+        print("Finished Backfilling in {:.2f}s. {} Shards Done, {} Failed.".format(time.perf_counter()-start, len(result['done']), len(result['failed'])))
+        return result
@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import contextlib
+from argparse import ArgumentParser
+
+from WrappedObjects import Config, Credential, Beatmap
+from DBManager import osuDB, MultiThreadedOsuDB
+from interface import Interface
+from columnar import ColumnarSnapshot, is_available as is_columnar_available
+from fake_server import FakeOsuServer, make_fake_beatmaps
+
+from typing import Callable, Dict, List
+
+
+__all__ = ['BENCHMARKS', 'run_benchmarks', 'compare_results']
+
+
+BENCHMARKS: Dict[str, Callable[[Dict], Dict]] = {}
+
+
+def benchmark(function: Callable[[Dict], Dict]):
+    BENCHMARKS[function.__name__[len('bench_'):]] = function
+    return function
+
+
+def result(value: float, unit: str, higher_is_better: bool = True):
+    return {'value': round(value, 4), 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def make_bench_config(directory: str, base_url: str = None, **kw):
+    """Config keeping every file in directory, without persisted sessions and without rate limits."""
+    from config import config
+    return Config(config, base_url=base_url or config.base_url, database=os.path.join(directory, 'database.db'),
+                  cache_database=os.path.join(directory, 'cache.db'), download_dir=os.path.join(directory, 'Downloads'),
+                  session_file=None, rate_limits={}, progress_mode='quiet', **kw)
+
+
+@contextlib.contextmanager
+def silenced_stdout():
+    """Silences stdout down to its file descriptor, progress reporters keep the sys.stdout they were made with."""
+    sys.stdout.flush()
+    stdout_descriptor = os.dup(1)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(stdout_descriptor, 1)
+            os.close(stdout_descriptor)
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@benchmark
+def bench_startup(options: Dict):
+    """Seconds from starting the interpreter to a parsed command line, the first run without bytecode caches."""
+    with tempfile.TemporaryDirectory() as directory:
+        script = ("from interface import Interface; from WrappedObjects import Credential; from bench import make_bench_config; "
+                  "Interface(make_bench_config({!r}), '', Credential()).make_parser().parse_args(['download'])".format(directory))
+        def run(environment):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', script], check=True, env=environment, cwd=os.path.dirname(os.path.abspath(__file__)))
+            return time.perf_counter()-start
+
+        cold = run(dict(os.environ, PYTHONDONTWRITEBYTECODE='1', PYTHONPYCACHEPREFIX=os.path.join(directory, 'pycache')))
+        warm = min(run(dict(os.environ)) for _ in range(options['repeat']))
+    return {'startup.cold': result(cold, 's', False), 'startup.warm': result(warm, 's', False)}
+
+
+@benchmark
+def bench_downloader(options: Dict):
+    """Interface.cli_downloader against the fake server, from fetching beatmaps to the last downloaded beatmapset."""
+    results = {}
+    beatmaps = make_fake_beatmaps(options['beatmaps'])
+    for workers in options['workers']:
+        with tempfile.TemporaryDirectory() as directory, \
+             FakeOsuServer(beatmaps, latency=options['latency'], bandwidth=options['bandwidth'], payload_size=options['payload_size'],
+                           rate_limit_every=options['rate_limit_every']) as server:
+            interface = Interface(make_bench_config(directory, server.base_url), 'bench-api-key', Credential(username='bench', password='bench'))
+            start = time.perf_counter()
+            with silenced_stdout():
+                interface.start(['download', '-w', str(workers), '-l', str(options['download_limit'])])
+            elapsed = time.perf_counter()-start
+            interface.db.close()
+
+            downloaded = len(os.listdir(interface.config.download_dir))
+            results['downloader.w{}.beatmapsets_per_second'.format(workers)] = result(downloaded/elapsed, 'beatmapsets/s')
+            results['downloader.w{}.bytes_per_second'.format(workers)] = result(server.stats['bytes_sent']/elapsed, 'B/s')
+    return results
+
+
+@benchmark
+def bench_database(options: Dict):
+    """osuDB insert rate through the group committing writer, and downloaded lookups and filtered queries on the result."""
+    beatmaps = [Beatmap(beatmap) for beatmap in make_fake_beatmaps(options['beatmaps'])]
+    beatmapset_ids = sorted({beatmap['beatmapset_id'] for beatmap in beatmaps})
+    with tempfile.TemporaryDirectory() as directory:
+        config = make_bench_config(directory)
+        db = MultiThreadedOsuDB(config.database, profile=config.database_profile, batch_size=config.database_write_batch_size)
+
+        start = time.perf_counter()
+        for i in range(0, len(beatmaps), 500):
+            db.add_beatmaps(beatmaps[i:i+500], replace=True)
+        db.flush()
+        insert_time = time.perf_counter()-start
+
+        db.bulk_flag_as_downloaded(beatmapset_ids[::2])
+        db.flush()
+        start = time.perf_counter()
+        for beatmapset_id in beatmapset_ids:
+            db.check_exists_in_downloaded(beatmapset_id)
+        lookup_time = time.perf_counter()-start
+
+        start = time.perf_counter()
+        for _ in range(options['repeat']):
+            db.get_beatmapsets_where([("mode = ?", [0]), ("difficultyrating BETWEEN ? AND ?", [2.0, 5.0])])
+        query_time = (time.perf_counter()-start)/options['repeat']
+
+        columnar_results = {}
+        if is_columnar_available():
+            snapshot = ColumnarSnapshot(db, os.path.join(directory, 'snapshot'))
+            start = time.perf_counter()
+            snapshot.refresh()
+            columnar_results['database.columnar_rebuild'] = result(time.perf_counter()-start, 's', False)
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                snapshot.select_beatmapsets([('mode', '=', 0), ('difficultyrating', 'between', [2.0, 5.0])])
+            columnar_results['database.columnar_filtered_query'] = result((time.perf_counter()-start)/options['repeat'], 's', False)
+        db.close()
+
+        plain_db = osuDB(os.path.join(directory, 'plain.db'), profile=config.database_profile)
+        start = time.perf_counter()
+        for i in range(0, len(beatmaps), 500):
+            plain_db.add_beatmaps(beatmaps[i:i+500], replace=True)
+        plain_insert_time = time.perf_counter()-start
+        plain_db.close()
+    return {'database.insert_per_second': result(len(beatmaps)/insert_time, 'beatmaps/s'),
+            'database.plain_insert_per_second': result(len(beatmaps)/plain_insert_time, 'beatmaps/s'),
+            'database.lookup_per_second': result(len(beatmapset_ids)/lookup_time, 'lookups/s'),
+            'database.filtered_query': result(query_time, 's', False), **columnar_results}
+
+
+@benchmark
+def bench_filters(options: Dict):
+    """Interface.filter_beatmaps over api beatmaps with every filter option set."""
+    beatmaps = [Beatmap(beatmap) for beatmap in make_fake_beatmaps(options['beatmaps'])]
+    with tempfile.TemporaryDirectory() as directory:
+        interface = Interface(make_bench_config(directory), '', Credential())
+        interface.parsed_args = vars(interface.make_parser().parse_args(['download', '-q', '1', '-q', '4', '--diff', '2-6', '-f', '10', '-r', '2']))
+        interface.process_args()
+
+        start = time.perf_counter()
+        for _ in range(options['repeat']):
+            interface.filter_beatmaps(beatmaps)
+        elapsed = time.perf_counter()-start
+    return {'filters.beatmaps_per_second': result(len(beatmaps)*options['repeat']/elapsed, 'beatmaps/s')}
+
+
+def run_benchmarks(names: List[str], options: Dict):
+    return {'commit': get_commit(), 'created_at': time.time(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'options': options, 'results': {key: value for name in names for key, value in BENCHMARKS[name](options).items()}}
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float = 0.05):
+    """Lines comparing every result present in both runs, changes beyond threshold in the wrong direction are marked as regressions."""
+    lines = ["Comparing {} against {}".format(current.get('commit'), baseline.get('commit'))]
+    baseline_options = baseline.get('options', {})
+    for key, value in current.get('options', {}).items():
+        if baseline_options.get(key) != value:
+            lines.append("Option {} differs: {} -> {}, results may not be comparable".format(key, baseline_options.get(key), value))
+    regressions = 0
+    for key, entry in current['results'].items():
+        if key not in baseline['results']:
+            continue
+        before, after = baseline['results'][key]['value'], entry['value']
+        change = (after-before)/before if before else 0.0
+        regressed = (change < -threshold) if entry['higher_is_better'] else (change > threshold)
+        regressions += regressed
+        lines.append("{:<45} {:>14.4f} -> {:>14.4f} {:<13} {:+7.1%}{}".format(key, before, after, entry['unit'], change, '  REGRESSION' if regressed else ''))
+    return lines, regressions
+
+
+def main(args: list = sys.argv[1:]):
+    parser = ArgumentParser(description="Benchmarks osu-map-downloader against a local stand-in osu! server.")
+    parser.add_argument('benchmarks', metavar='BENCHMARK', nargs='*', help="Benchmarks to run: {}. Default=all".format(', '.join(BENCHMARKS)))
+    parser.add_argument('-o', '--output', metavar='PATH', help="Writes the results as json to PATH.")
+    parser.add_argument('-c', '--compare', metavar='PATH', help="Compares the results with a previous --output, exits with 1 on regressions.")
+    parser.add_argument('--threshold', type=float, default=0.05, help="Relative change counted as a regression. Default=0.05")
+    parser.add_argument('--beatmaps', type=int, default=20000, help="Beatmaps served by the fake server and used by the database and filter benchmarks. Default=20000")
+    parser.add_argument('--download-limit', type=int, default=200, help="Beatmaps requested per downloader run. Default=200")
+    parser.add_argument('--workers', type=int, action='append', default=None, help="Download workers to benchmark, can be stacked. Default=1 and 8")
+    parser.add_argument('--latency', type=float, default=0.005, help="Seconds the fake server waits before every response. Default=0.005")
+    parser.add_argument('--bandwidth', type=float, default=None, help="Bytes per second the fake server sends per response. Default=unlimited")
+    parser.add_argument('--rate-limit-every', metavar='N', type=int, default=0, help="Answers every Nth request of the fake server with a 429. Default=0, never")
+    parser.add_argument('--payload-size', type=int, default=256*1024, help="Bytes per downloaded beatmapset. Default=256KB")
+    parser.add_argument('--repeat', type=int, default=5, help="Repeats of the shorter measurements. Default=5")
+    namespace = parser.parse_args(args)
+    unknown_benchmarks = [name for name in namespace.benchmarks if name not in BENCHMARKS]
+    if unknown_benchmarks:
+        parser.error("unknown benchmarks: {}".format(', '.join(unknown_benchmarks)))
+
+    options = {'beatmaps': namespace.beatmaps, 'download_limit': namespace.download_limit, 'workers': namespace.workers or [1, 8],
+               'latency': namespace.latency, 'bandwidth': namespace.bandwidth, 'payload_size': namespace.payload_size,
+               'rate_limit_every': namespace.rate_limit_every, 'repeat': namespace.repeat}
+    results = run_benchmarks(namespace.benchmarks or list(BENCHMARKS), options)
+    for key, entry in results['results'].items():
+        print("{:<45} {:>14.4f} {}".format(key, entry['value'], entry['unit']))
+    if namespace.output:
+        with open(namespace.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+    if namespace.compare:
+        with open(namespace.compare, encoding='utf-8') as file:
+            lines, regressions = compare_results(json.load(file), results, namespace.threshold)
+        print("\n".join(lines))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
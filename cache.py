@@ -0,0 +1,127 @@
+import json
+import time
+import sqlite3
+from threading import Lock
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from typing import Dict, Optional
+
+
+__all__ = ['ResponseCache']
+
+
+class ResponseCache:
+    """
+    Persistent cache of successful metadata responses, stored in its own SQLite file.
+    Entries are keyed on the url and its params without the api key, expire after the ttl of their endpoint
+    and are evicted least recently used first once the bodies take more than max_size bytes.
+    Bodies larger than max_entry_size (max_size by default) are not stored.
+    """
+    def __init__(self, database: str, ttls: Dict[str, float] = {}, max_size: int = 64*1024*1024, max_entry_size: int = None):
+        self.database = database
+        self.ttls = ttls
+        self.max_size = max_size
+        self.max_entry_size = max_size if max_entry_size is None else min(max_entry_size, max_size)
+        self._lock = Lock()
+        self.connection = sqlite3.connect(self.database, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS "responses"(key TEXT PRIMARY KEY, url TEXT, status_code INTEGER, headers TEXT, body BLOB, size INTEGER, created_at REAL, accessed_at REAL)""")
+        self.connection.execute("""CREATE INDEX IF NOT EXISTS "ix_responses_accessed_at" ON "responses"(accessed_at)""")
+        self.connection.commit()
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def __repr__(self):
+        return "<{} database='{}' size={} max_size={}>".format(self.__class__.__name__, self.database, self.size, self.max_size)
+
+    @staticmethod
+    def make_key(url: str, params: Dict):
+        return json.dumps([url, sorted([str(key), str(value)] for key, value in params.items() if key != 'k')])
+
+    def get_ttl(self, url: str):
+        """ttls are keyed on the endpoint name, the last part of its url, e.g. 'get_beatmaps'."""
+        return self.ttls.get(url.rstrip('/').rsplit('/', 1)[-1], 0)
+
+    def get(self, url: str, params: Dict) -> Optional[requests.Response]:
+        ttl = self.get_ttl(url)
+        if not ttl:
+            return None
+        key = self.make_key(url, params)
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute("SELECT status_code, headers, body FROM responses WHERE key=? AND created_at>=?", (key, now-ttl)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET accessed_at=? WHERE key=?", (now, key))
+            self.connection.commit()
+
+        resp = requests.Response()
+        resp.url = url
+        resp.status_code, headers, resp._content = row
+        resp._content_consumed = True
+        resp.headers = CaseInsensitiveDict(json.loads(headers))
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.from_cache = True
+        return resp
+
+    def put(self, url: str, params: Dict, resp: requests.Response, body: bytes = None):
+        """Stores a 200 response. Its body is read whole here unless given, see tee for streamed responses."""
+        if resp.status_code != 200 or not self.get_ttl(url):
+            return
+        key = self.make_key(url, params)
+        body = resp.content if body is None else body
+        if len(body) > self.max_entry_size:
+            return
+        now = time.time()
+        with self._lock:
+            previous = self.connection.execute("SELECT size FROM responses WHERE key=?", (key,)).fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?,?)",
+                                    (key, url, resp.status_code, json.dumps(dict(resp.headers)), body, len(body), now, now))
+            self.size += len(body)-(previous[0] if previous is not None else 0)
+            self.evict()
+            self.connection.commit()
+
+    def tee(self, url: str, params: Dict, resp: requests.Response) -> requests.Response:
+        """
+        Stores a streamed 200 response once its body has been read to the end, without reading ahead of the caller.
+        resp.iter_content keeps a copy of the bytes it yields, dropped as soon as they grow past max_entry_size.
+        A body left unfinished, e.g. by a closed response, is not stored.
+        """
+        if resp.status_code != 200 or not self.get_ttl(url):
+            return resp
+        iter_content = resp.iter_content
+        def tee_content(chunk_size=1, decode_unicode=False):
+            body = bytearray() if not decode_unicode else None
+            for chunk in iter_content(chunk_size, decode_unicode):
+                if body is not None and len(body)+len(chunk) > self.max_entry_size:
+                    body = None
+                elif body is not None:
+                    body += chunk
+                yield chunk
+            if body is not None:
+                self.put(url, params, resp, bytes(body))
+        resp.iter_content = tee_content
+        return resp
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits max_size. Called with the lock held."""
+        while self.size > self.max_size:
+            rows = self.connection.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 64").fetchall()
+            if not rows:
+                self.size = 0
+                return
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.connection.execute("DELETE FROM responses WHERE key=?", (key,))
+                self.size -= size
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM responses")
+            self.connection.commit()
+            self.size = 0
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import uuid
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from DBManager import osuDB
+from utils import PrettyPrinter, iter_chunks
+
+from typing import Any, Dict, List, Tuple
+
+
+__all__ = ['ColumnarSnapshot', 'is_available']
+
+
+printer = PrettyPrinter._get_default()
+
+
+def is_available():
+    """The columnar engine needs numpy, which is an optional dependency."""
+    return np is not None
+
+
+class ColumnarSnapshot:
+    """
+    Numeric columns of the beatmaps table as numpy arrays sorted by beatmap_id, saved as memory-mapped .npy files in directory.
+    Filters are evaluated as vectorized boolean masks over every beatmap at once.
+    Triggers log every changed beatmap_id into a changelog table, refreshing the snapshot only reloads those rows.
+    """
+    VERSION = 1
+    CHANGELOG_TABLE = 'beatmaps_changelog'
+    STATE_KEY = 'columnar.snapshot_id'
+    # column: (SQL expression, dtype). Nullable integers get a sentinel, approved_date is kept as epoch seconds.
+    COLUMNS = {'beatmap_id': ("beatmap_id", 'int64'),
+               'beatmapset_id': ("beatmapset_id", 'int64'),
+               'approved': ("IFNULL(approved, -128)", 'int8'),
+               'mode': ("IFNULL(mode, -1)", 'int8'),
+               'difficultyrating': ("difficultyrating", 'float64'),
+               'favourite_count': ("IFNULL(favourite_count, -1)", 'int64'),
+               'rating': ("rating", 'float64'),
+               'total_length': ("IFNULL(total_length, -1)", 'int64'),
+               'video': ("IFNULL(video, 0)", 'bool'),
+               'approved_date': ("IFNULL(CAST(strftime('%s', approved_date) AS INTEGER), -9223372036854775807)", 'int64')}
+    DATE_COLUMNS = ['approved_date']
+
+    def __init__(self, db: osuDB, directory: str):
+        if not is_available():
+            raise ImportError("The columnar engine needs numpy, install it with: pip install numpy")
+        self.db = db
+        self.directory = directory
+        self.meta: Dict[str, Any] = None
+        self.columns: Dict[str, 'np.ndarray'] = {}
+
+    def __repr__(self):
+        return "<{} object directory='{}' rows={}>".format(self.__class__.__name__, self.directory, len(self))
+
+    def __len__(self):
+        return len(self.columns['beatmap_id']) if self.columns else 0
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.directory, 'meta.json')
+
+    def get_column_path(self, column: str):
+        return os.path.join(self.directory, '{}.npy'.format(column))
+
+    def ensure_changelog(self):
+        table = self.db.TABLES['beatmaps'].table_name
+        queries = ['CREATE TABLE IF NOT EXISTS "{}"(seq INTEGER PRIMARY KEY AUTOINCREMENT, beatmap_id INTEGER NOT NULL)'.format(self.CHANGELOG_TABLE)]
+        for event, row_ids in [('INSERT', ['NEW']), ('UPDATE', ['OLD', 'NEW']), ('DELETE', ['OLD'])]:
+            inserts = " ".join('INSERT INTO "{}"(beatmap_id) VALUES ({}.beatmap_id);'.format(self.CHANGELOG_TABLE, row_id) for row_id in row_ids)
+            queries.append('CREATE TRIGGER IF NOT EXISTS "{0}_{1}" AFTER {1} ON "{2}" BEGIN {3} END'.format(self.CHANGELOG_TABLE, event.lower(), table, inserts))
+        for query in queries:
+            self.db.write(query)
+        self.db.flush()
+
+    def get_changelog_seq(self) -> int:
+        """Last seq handed out by the changelog, which keeps growing after pruned rows thanks to AUTOINCREMENT."""
+        self.db.cursor.execute("SELECT IFNULL(MAX(seq), 0) AS seq FROM sqlite_sequence WHERE name=?", (self.CHANGELOG_TABLE,))
+        return self.db.cursor.fetchone()['seq']
+
+    def fetch_rows(self, condition: str = "1", params: List = []) -> Dict[str, 'np.ndarray']:
+        cursor = self.db.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute("SELECT {} FROM {} WHERE {} ORDER BY beatmap_id".format(', '.join(expression for expression, _ in self.COLUMNS.values()),
+                                                                             self.db.TABLES['beatmaps'].table_name, condition), params)
+        rows = cursor.fetchall()
+        values = list(zip(*rows)) if rows else [()]*len(self.COLUMNS)
+        return {column: np.array(column_values, dtype=dtype) for (column, (_, dtype)), column_values in zip(self.COLUMNS.items(), values)}
+
+    def load(self) -> bool:
+        """Maps a saved snapshot, returns False when there is none or it was made for another database or layout."""
+        try:
+            with open(self.meta_path, encoding='utf-8') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if meta.get('version') != self.VERSION or meta.get('columns') != list(self.COLUMNS) or meta.get('snapshot_id') != self.db.get_state(self.STATE_KEY):
+            return False
+        try:
+            self.columns = {column: np.load(self.get_column_path(column), mmap_mode='r') for column in self.COLUMNS}
+        except (OSError, ValueError):
+            self.columns = {}
+            return False
+        self.meta = meta
+        return True
+
+    def save(self, columns: Dict[str, 'np.ndarray'], changelog_seq: int, snapshot_id: str):
+        """Writes every column next to the current files before replacing them, then maps the new files."""
+        os.makedirs(self.directory, exist_ok=True)
+        for column, values in columns.items():
+            with open(self.get_column_path(column)+'.tmp', 'wb') as file:
+                np.save(file, values)
+        self.columns = {} # Unmaps the current files, they can not be replaced while mapped on some platforms.
+        for column in columns:
+            os.replace(self.get_column_path(column)+'.tmp', self.get_column_path(column))
+        self.meta = {'version': self.VERSION, 'columns': list(self.COLUMNS), 'snapshot_id': snapshot_id, 'changelog_seq': changelog_seq,
+                     'rows': len(columns['beatmap_id']), 'saved_at': time.time()}
+        with open(self.meta_path+'.tmp', 'w', encoding='utf-8') as file:
+            json.dump(self.meta, file)
+        os.replace(self.meta_path+'.tmp', self.meta_path)
+        self.columns = {column: np.load(self.get_column_path(column), mmap_mode='r') for column in self.COLUMNS}
+
+    def rebuild(self):
+        self.ensure_changelog()
+        # The changelog position is read first, rows changing while the table is read are reloaded by the next refresh.
+        changelog_seq = self.get_changelog_seq()
+        snapshot_id = uuid.uuid4().hex
+        self.db.set_state(self.STATE_KEY, snapshot_id)
+        self.db.flush()
+        self.save(self.fetch_rows(), changelog_seq, snapshot_id)
+        self.prune_changelog()
+        return self
+
+    def prune_changelog(self):
+        self.db.write('DELETE FROM "{}" WHERE seq <= ?'.format(self.CHANGELOG_TABLE), (self.meta['changelog_seq'],))
+
+    def refresh(self):
+        """Brings the snapshot up to date with the database, reloading only the beatmaps changed since it was saved."""
+        start = time.perf_counter()
+        self.db.flush()
+        if not self.columns and not self.load():
+            self.rebuild()
+            printer.print_debug('Columnar Snapshot Rebuild', {'Rows': len(self), 'Elapsed': time.perf_counter()-start})
+            return self
+        self.ensure_changelog()
+
+        self.db.cursor.execute('SELECT seq, beatmap_id FROM "{}" WHERE seq > ?'.format(self.CHANGELOG_TABLE), (self.meta['changelog_seq'],))
+        changes = self.db.cursor.fetchall()
+        if not changes:
+            if self.get_changelog_seq() < self.meta['changelog_seq']:
+                # The changelog was reset under this snapshot, the database is not the one it was made from.
+                return self.rebuild()
+            return self
+
+        changelog_seq = max(change['seq'] for change in changes)
+        changed_ids = np.unique(np.array([change['beatmap_id'] for change in changes], dtype='int64'))
+        fetched_chunks = [self.fetch_rows("beatmap_id IN ({})".format(','.join('?'*len(chunk))), chunk)
+                          for chunk in iter_chunks(changed_ids.tolist(), 900)]
+        kept = ~np.isin(self.columns['beatmap_id'], changed_ids)
+        columns = {column: np.concatenate([np.asarray(self.columns[column])[kept]]+[chunk[column] for chunk in fetched_chunks]) for column in self.COLUMNS}
+        order = np.argsort(columns['beatmap_id'], kind='stable')
+        self.save({column: values[order] for column, values in columns.items()}, changelog_seq, self.meta['snapshot_id'])
+        self.prune_changelog()
+
+        printer.print_debug('Columnar Snapshot Refresh', {'Changed': len(changed_ids), 'Rows': len(self), 'Elapsed': time.perf_counter()-start})
+        return self
+
+    def get_spec_value(self, column: str, value: Any):
+        if column in self.DATE_COLUMNS:
+            return np.datetime64(str(value), 's').astype('int64')
+        return value
+
+    def make_mask(self, specs: List[Tuple[str, str, Any]]) -> 'np.ndarray':
+        """Boolean mask of the beatmaps matching every (column, operator, value) spec, see Interface.make_filter_specs."""
+        mask = np.ones(len(self), dtype=bool)
+        for column, operator, value in specs:
+            values = self.columns.get(column)
+            if operator == 'match':
+                mask &= np.isin(self.columns['beatmap_id'], self.db.search_beatmap_ids(value))
+            elif operator == 'in':
+                mask &= np.isin(values, [self.get_spec_value(column, entry) for entry in value])
+            elif operator == 'between':
+                lower, upper = sorted(self.get_spec_value(column, entry) for entry in value)
+                mask &= (values >= lower) & (values <= upper)
+            elif operator in ('=', '>=', '>', '<=', '<'):
+                value = self.get_spec_value(column, value)
+                mask &= {'=': np.equal, '>=': np.greater_equal, '>': np.greater, '<=': np.less_equal, '<': np.less}[operator](values, value)
+            else:
+                raise ValueError("Unsupported filter operator: {}".format(operator))
+        return mask
+
+    def select_beatmapsets(self, specs: List[Tuple[str, str, Any]]) -> List[int]:
+        """beatmap_ids of one beatmap per beatmapset, the highest matching one, like osuDB.get_beatmapsets_where."""
+        mask = self.make_mask(specs)
+        beatmap_ids, beatmapset_ids = self.columns['beatmap_id'][mask], self.columns['beatmapset_id'][mask]
+        # Rows are sorted by beatmap_id, so the first of every beatmapset in reverse order is its highest beatmap.
+        _, first_indexes = np.unique(beatmapset_ids[::-1], return_index=True)
+        return beatmap_ids[::-1][first_indexes].tolist()
@@ -1,14 +1,60 @@
 
 
 from WrappedObjects import Config
+from constants import BASE_URL
 
 
 config = Config(debug=False,
+                base_url=BASE_URL,
                 database='./database.db',
+                database_profile={'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536, 'mmap_size': 268435456, 'temp_store': 'MEMORY'},
+                database_write_batch_size=500,
+                database_write_batch_interval=0.05, # seconds
+                database_write_queue_size=10000, # rows waiting to be committed, writes block once the queue is full
                 json_config='./config.json',
+                session_file='./session.json', # None disables persisting the login session
+                session_max_age=7*24*60*60, # seconds, None trusts a saved session until its cookies expire
                 download_dir='./Downloads',
-                download_chunk_size=512,
+                download_chunk_size=512, # minimum, chunks grow with the download size
+                download_max_chunk_size=1024*1024,
+                download_buffer_size=None, # bytes read at once into a buffer reused by a thread's downloads, None grows reads like chunks
+                preallocate_downloads=True, # reserves the size announced by the server on disk before writing, where supported
+                download_direct_to_file=False, # writes to the final filename instead of a temporary file, failed downloads are removed rather than resumed
+                download_workers=1,
+                download_order=['failed-last'], # applied in turn, from: newest, favourites, smallest, failed-last
+                dry_run=False,
+                reconcile_download_dir=True, # flags beatmapsets found in download_dir as downloaded before downloading
+                reconcile_unflag_missing=False, # also unflags downloaded beatmapsets missing from download_dir, osu! deletes the files it imports
+                resume_downloads=True,
+                download_mirrors=[], # formattable urls tried after the official download, e.g. 'https://mirror.example/d/{0[beatmapset_id]}'
+                download_hedge_delay=None, # seconds without a first byte before also trying the next source, None disables hedging
+                verify_downloads=True, # checks the zip structure of every download before accepting it
+                partial_download_max_age=7*24*60*60, # seconds, None keeps partial downloads forever
+                rate_limits={'api': (1.0, 60), 'download': (0.5, 5)}, # category: (requests per second, burst)
+                max_retries=5,
+                retry_backoff_base=1.0, # seconds
+                retry_backoff_cap=60.0, # seconds
+                use_cache=True,
+                refresh_cache=False,
+                cache_database='./cache.db',
+                cache_ttls={'get_beatmaps': 10*60, 'get_user': 5*60}, # seconds by endpoint, endpoints not listed are not cached
+                cache_max_size=64*1024*1024, # bytes
+                cache_max_entry_size=8*1024*1024, # bytes, larger responses are not cached
                 record_beatmaps=True,
+                stream_api_responses=True,
                 lookup_beatmaps_in_database=False,
+                columnar_engine=True, # filters the database lookup with numpy when it is installed
+                columnar_snapshot_dir='./snapshot',
+                backfill_shards=16, # date ranges a backfill is split into, more shards than processes balances uneven ranges
+                backfill_processes=4, # each process gets an equal share of rate_limits
+                backfill_until=None, # None backfills up to the start of today
+                transfer_file='./beatmaps.ndjson.gz', # EXPORT and IMPORT file, compressed by extension: .gz, .bz2, .xz or plain
+                transfer_batch_size=5000, # beatmaps per transaction on import
+                import_conflict='replace', # 'replace' or 'ignore' beatmaps already in the database
                 download_progress_bar_length=20,
+                progress_mode='auto', # 'auto', 'bar' or 'quiet', auto only draws progress on a terminal
+                progress_refresh_interval=0.1, # seconds
+                metrics_file=None, # .prom files get Prometheus text, anything else json
+                metrics_interval=60.0, # seconds
+                profile_file=None,
                 formattable_beatmap_filename="{0[beatmapset_id]} {0[artist]} - {0[title]}")
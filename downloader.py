@@ -0,0 +1,62 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from WrappedObjects import Beatmap
+from DBModels import DownloadedBeatmapset
+from api import osuAPI
+from progress import ProgressReporter, make_progress_reporter
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class ConcurrentDownloader:
+    """
+    Runs osuAPI downloads in a pool of worker threads, each with its own requests.Session.
+    Results are yielded back to the calling thread, so database writes stay on the thread that owns the connection.
+    """
+    def __init__(self, api: osuAPI, workers: int = 4, params: Dict = {}, reporter: ProgressReporter = None):
+        self.api = api
+        self.workers = max(int(workers), 1)
+        self.params = params
+        self.reporter = reporter or make_progress_reporter(api.config.progress_mode, concurrent=True, refresh_interval=api.config.progress_refresh_interval)
+        self._local = threading.local()
+        self._sessions: List[requests.Session] = []
+        self._sessions_lock = threading.Lock()
+
+    def __repr__(self):
+        return "<{} object workers={} sessions={}>".format(self.__class__.__name__, self.workers, self._sessions.__len__())
+
+    def get_session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.api.make_session()
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def close(self):
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions.clear()
+
+    def _download(self, beatmap: Beatmap) -> Tuple[Beatmap, Optional[DownloadedBeatmapset]]:
+        try:
+            return beatmap, self.api.download_to_file(beatmap, params=self.params, session=self.get_session(), reporter=self.reporter)
+        except Exception as exc:
+            # Whatever goes wrong with one beatmapset, e.g. a malformed Content-Length, must not stop the others.
+            self.reporter.finish(beatmap['beatmapset_id'], success=False)
+            self.reporter.log("Failed to download {}: {!r}".format(beatmap, exc))
+            return beatmap, None
+
+    def download_all(self, beatmaps: Iterable[Beatmap]) -> Iterator[Tuple[Beatmap, Optional[DownloadedBeatmapset]]]:
+        """Yields (beatmap, downloaded) pairs in completion order, downloaded is the record from download_to_file or None if it failed."""
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Downloader') as executor:
+                futures = [executor.submit(self._download, beatmap) for beatmap in beatmaps]
+                for future in as_completed(futures):
+                    yield future.result()
+        finally:
+            self.close()
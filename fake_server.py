@@ -0,0 +1,235 @@
+import io
+import json
+import time
+import zipfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit, parse_qs
+
+from DBModels import Beatmap as BeatmapModel
+
+from typing import Callable, Dict, List, Union
+
+
+__all__ = ['FakeOsuServer', 'make_fake_beatmaps', 'make_osz_payload']
+
+
+def make_fake_beatmaps(count: int, beatmaps_per_set: int = 4, start_year: int = 2010) -> List[Dict[str, str]]:
+    """Api-like beatmaps, every value a string, approved in order a few hours apart starting from start_year."""
+    beatmaps = []
+    for beatmap_id in range(1, count+1):
+        beatmapset_id = (beatmap_id-1)//beatmaps_per_set+1
+        approved_time = time.gmtime(time.mktime((start_year, 1, 1, 0, 0, 0, 0, 0, 0))+beatmapset_id*3*60*60)
+        beatmap = {field.name: '0' for field in BeatmapModel.FIELDS}
+        beatmap.update({'beatmap_id': str(beatmap_id), 'beatmapset_id': str(beatmapset_id), 'approved': str(beatmapset_id%7-2),
+                        'mode': str(beatmapset_id%4), 'difficultyrating': str(round(beatmap_id%9+beatmap_id%7/7, 4)),
+                        'favourite_count': str(beatmapset_id*37%500), 'rating': str(round(beatmapset_id%10+beatmapset_id%3/3, 4)),
+                        'approved_date': time.strftime('%Y-%m-%d %H:%M:%S', approved_time), 'submit_date': '2009-01-01 00:00:00',
+                        'last_update': '2009-01-01 00:00:00', 'file_md5': '{:032x}'.format(beatmap_id), 'version': 'Diff {}'.format(beatmap_id),
+                        'artist': 'Artist {}'.format(beatmapset_id%50), 'artist_unicode': 'Artist {}'.format(beatmapset_id%50),
+                        'title': 'Title {}'.format(beatmapset_id), 'title_unicode': 'Title {}'.format(beatmapset_id), 'source': '',
+                        'creator': 'Mapper {}'.format(beatmapset_id%30), 'creator_id': str(beatmapset_id%30), 'bpm': '180',
+                        'tags': 'tag{} tag{}'.format(beatmapset_id%5, beatmapset_id%11), 'total_length': str(60+beatmapset_id%240),
+                        'hit_length': str(50+beatmapset_id%240), 'video': str(beatmapset_id%2), 'packs': None, 'max_combo': str(beatmap_id%1500)})
+        beatmaps.append(beatmap)
+    return beatmaps
+
+
+def make_osz_payload(size: int, seed: int = 0) -> bytes:
+    """A valid, uncompressed .osz (zip) archive of roughly size bytes."""
+    member_size = max(size-256, 0)
+    pattern = bytes((seed+i*31) % 256 for i in range(4096))
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('audio.mp3', (pattern*(member_size//len(pattern)+1))[:member_size])
+        archive.writestr('beatmap.osu', 'osu file format v14\n')
+    return buffer.getvalue()
+
+
+class FakeOsuRequestHandler(BaseHTTPRequestHandler):
+    server: 'FakeOsuHTTPServer'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type: str = 'application/json', headers: Dict[str, str] = {}, drop_after: int = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD' and drop_after is not None and drop_after < len(body):
+            # Announces the whole body but closes the connection part way through it.
+            self.close_connection = True
+            self.write_throttled(body[:drop_after])
+        elif self.command != 'HEAD':
+            self.write_throttled(body)
+
+    def write_throttled(self, body: bytes):
+        fake = self.server.fake
+        if not fake.bandwidth:
+            self.wfile.write(body)
+        else:
+            block_size = 16*1024
+            for i in range(0, len(body), block_size):
+                self.wfile.write(body[i:i+block_size])
+                time.sleep(len(body[i:i+block_size])/fake.bandwidth)
+        with fake.lock:
+            fake.stats['bytes_sent'] += len(body)
+
+    def handle_request(self):
+        fake = self.server.fake
+        path = urlsplit(self.path).path
+        with fake.lock:
+            fake.stats['requests'] += 1
+            fake.stats['paths'][path] = fake.stats['paths'].get(path, 0)+1
+            request_number = fake.stats['requests']
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.rate_limit_every and request_number % fake.rate_limit_every == 0:
+            with fake.lock:
+                fake.stats['rate_limited'] += 1
+            return self.send_body(429, b'Too Many Requests', 'text/plain', {'Retry-After': str(fake.retry_after)})
+
+        for prefix, route in fake.routes:
+            # Routes ending with a slash match every path under them, the others only match exactly.
+            if path == prefix or (prefix.endswith('/') and prefix != '/' and path.startswith(prefix)):
+                return route(self, path)
+        self.send_body(404, b'Not Found', 'text/plain')
+
+    do_GET = do_POST = do_HEAD = handle_request
+
+    @property
+    def query(self):
+        return {key: values[-1] for key, values in parse_qs(urlsplit(self.path).query).items()}
+
+    @property
+    def cookies(self):
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        return {key: morsel.value for key, morsel in cookie.items()}
+
+    def route_home(self, path: str):
+        body = '<!DOCTYPE html><html><head><meta charset="utf-8">\n<meta name="csrf-token" content="{}">\n</head><body>{}</body></html>'
+        self.send_body(200, body.format(self.server.fake.csrf_token, 'osu! '*self.server.fake.homepage_padding).encode('utf-8'), 'text/html; charset=utf-8')
+
+    def route_session(self, path: str):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[-1] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        if self.command != 'POST' or form.get('_token') != self.server.fake.csrf_token:
+            return self.send_body(403, b'{"error": "invalid csrf token"}')
+        self.send_body(200, b'{}', headers={'Set-Cookie': 'osu_session={}; Path=/'.format(self.server.fake.session_token)})
+
+    def route_get_beatmaps(self, path: str):
+        query = self.query
+        if not query.get('k'):
+            return self.send_body(401, b'{"error": "Please provide a valid API key."}')
+        since = query.get('since', '')
+        limit = min(int(query.get('limit', 500)), 500)
+        beatmaps = [beatmap for beatmap in self.server.fake.beatmaps if beatmap['approved_date'] > since
+                    and ('m' not in query or beatmap['mode'] == query['m'])][:limit]
+        self.send_body(200, json.dumps(beatmaps).encode('utf-8'))
+
+    def route_get_user(self, path: str):
+        query = self.query
+        if not query.get('k'):
+            return self.send_body(401, b'{"error": "Please provide a valid API key."}')
+        user = {'user_id': '2', 'username': query.get('u', 'peppy'), 'join_date': '2007-08-28 03:09:12', 'level': '100', 'pp_raw': '0'}
+        self.send_body(200, json.dumps([user]).encode('utf-8'))
+
+    def route_download(self, path: str):
+        fake = self.server.fake
+        parts = path.strip('/').split('/')
+        # /beatmapsets/{id}/download like osu!, or /d/{id} like most mirrors.
+        if not ((len(parts) == 3 and parts[0] == 'beatmapsets' and parts[2] == 'download') or (len(parts) == 2 and parts[0] == 'd')) or not parts[1].isdigit():
+            return self.send_body(404, b'Not Found', 'text/plain')
+        if fake.require_login and self.cookies.get('osu_session') != fake.session_token:
+            return self.send_body(401, b'Unauthorized', 'text/plain')
+        if fake.download_status is not None:
+            return self.send_body(fake.download_status, b'Unavailable', 'text/plain')
+
+        payload = fake.get_payload(int(parts[1]))
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and fake.support_range and range_header.startswith('bytes='):
+            start = int(range_header[len('bytes='):].split('-')[0] or 0)
+            if start >= len(payload):
+                return self.send_body(416, b'', 'text/plain', {'Content-Range': 'bytes */{}'.format(len(payload))})
+            return self.send_body(206, payload[start:], 'application/x-osu-beatmap-archive',
+                                  {'Content-Range': 'bytes {}-{}/{}'.format(start, len(payload)-1, len(payload)), 'Accept-Ranges': 'bytes'},
+                                  drop_after=fake.drop_downloads_after)
+        self.send_body(200, payload, 'application/x-osu-beatmap-archive', {'Accept-Ranges': 'bytes' if fake.support_range else 'none'},
+                       drop_after=fake.drop_downloads_after)
+
+
+class FakeOsuHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    fake: 'FakeOsuServer'
+
+
+class FakeOsuServer:
+    """
+    Local stand-in for osu.ppy.sh, serving the homepage with a csrf token, /session, /api/get_beatmaps, /api/get_user
+    and /beatmapsets/{id}/download with Range support, also served at /d/{id} to stand in for a mirror.
+    latency (seconds) delays every response, bandwidth (bytes per second) throttles bodies, payload_size sets the .osz size
+    (or a callable of the beatmapset id), every rate_limit_every-th request is answered with a 429 and download_status,
+    when set, answers every download with that status. drop_downloads_after closes download connections after that many body bytes.
+    """
+    def __init__(self, beatmaps: List[Dict] = None, *, latency: float = 0.0, bandwidth: float = None, payload_size: Union[int, Callable[[int], int]] = 256*1024,
+                 rate_limit_every: int = 0, retry_after: float = 0, support_range: bool = True, require_login: bool = True, download_status: int = None,
+                 drop_downloads_after: int = None, homepage_padding: int = 0, host: str = '127.0.0.1', port: int = 0):
+        self.beatmaps = sorted(beatmaps if beatmaps is not None else make_fake_beatmaps(2000), key=lambda beatmap: beatmap['approved_date'])
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.payload_size = payload_size
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.support_range = support_range
+        self.require_login = require_login
+        self.download_status = download_status
+        self.drop_downloads_after = drop_downloads_after
+        self.homepage_padding = homepage_padding
+        self.csrf_token = 'fake-csrf-token'
+        self.session_token = 'fake-session-token'
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'rate_limited': 0, 'bytes_sent': 0, 'paths': {}}
+        self.routes = [('/', FakeOsuRequestHandler.route_home), ('/home', FakeOsuRequestHandler.route_home),
+                       ('/session', FakeOsuRequestHandler.route_session), ('/api/get_beatmaps', FakeOsuRequestHandler.route_get_beatmaps),
+                       ('/api/get_user', FakeOsuRequestHandler.route_get_user), ('/beatmapsets/', FakeOsuRequestHandler.route_download),
+                       ('/d/', FakeOsuRequestHandler.route_download)]
+        self._payloads: Dict[int, bytes] = {}
+        self.httpd = FakeOsuHTTPServer((host, port), FakeOsuRequestHandler)
+        self.httpd.fake = self
+        self._thread: threading.Thread = None
+
+    def __repr__(self):
+        return "<{} base_url='{}' requests={}>".format(self.__class__.__name__, self.base_url, self.stats['requests'])
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def get_payload(self, beatmapset_id: int) -> bytes:
+        size = self.payload_size(beatmapset_id) if callable(self.payload_size) else self.payload_size
+        with self.lock:
+            if size not in self._payloads:
+                self._payloads[size] = make_osz_payload(size, seed=size)
+            return self._payloads[size]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='FakeOsuServer Thread', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,124 @@
+import os
+import re
+import time
+from string import Formatter
+from datetime import datetime
+
+from DBModels import DownloadedBeatmapset, DirectoryEntry
+from DBManager import osuDB
+from utils import PrettyPrinter, remove_illegal_name_characters
+from constants import BEATMAPSET_EXTENSION
+
+from typing import Dict, List, Optional, Pattern
+
+
+__all__ = ['make_filename_regex', 'DirectoryIndexer']
+
+
+printer = PrettyPrinter._get_default()
+
+# Names like '123 Artist - Title.osz', used by osu! itself and most mirrors.
+LEADING_ID_FILENAME_REGEX = re.compile(r'^(?P<beatmapset_id>\d+)\D.*{}$'.format(re.escape(BEATMAPSET_EXTENSION)), re.DOTALL)
+
+
+def make_filename_regex(formattable_filename: str) -> Pattern:
+    """
+    Regex matching the filenames made from formattable_filename by osuAPI.download_to_file, capturing beatmapset_id.
+    Other fields match anything. A format without beatmapset_id falls back to LEADING_ID_FILENAME_REGEX.
+    """
+    pattern = ''
+    has_beatmapset_id = False
+    for literal_text, field_name, _, _ in Formatter().parse(formattable_filename):
+        pattern += re.escape(remove_illegal_name_characters(literal_text))
+        if field_name is None:
+            continue
+        if field_name.endswith('[beatmapset_id]'):
+            pattern += r'(?P=beatmapset_id)' if has_beatmapset_id else r'(?P<beatmapset_id>\d+)'
+            has_beatmapset_id = True
+        else:
+            pattern += r'.*?'
+    if not has_beatmapset_id:
+        return LEADING_ID_FILENAME_REGEX
+    return re.compile(r'^{}{}$'.format(pattern, re.escape(BEATMAPSET_EXTENSION)), re.DOTALL)
+
+
+class DirectoryIndexer:
+    """
+    Indexes the beatmapsets in a download directory and reconciles them with the downloaded table.
+    The (size, mtime) of every file is cached in the database, so a rescan only parses the names of new or changed files.
+    """
+    def __init__(self, db: osuDB, directory: str, formattable_filename: str):
+        self.db = db
+        self.directory = directory
+        self.filename_regex = make_filename_regex(formattable_filename)
+
+    def __repr__(self):
+        return "<{} object directory='{}'>".format(self.__class__.__name__, self.directory)
+
+    def parse_beatmapset_id(self, filename: str) -> Optional[int]:
+        """Files named with an older formattable_beatmap_filename are still recognized by a leading id."""
+        match = self.filename_regex.match(filename) or LEADING_ID_FILENAME_REGEX.match(filename)
+        return int(match.group('beatmapset_id')) if match is not None else None
+
+    def scan(self) -> Dict[str, Dict]:
+        """Rescans the directory, updates the cached entries in bulk and returns every current entry by filename."""
+        cached_entries = self.db.get_directory_entries()
+        entries, changed_entries = {}, []
+        with os.scandir(self.directory) as directory_entries:
+            for directory_entry in directory_entries:
+                if not directory_entry.name.endswith(BEATMAPSET_EXTENSION) or not directory_entry.is_file():
+                    continue
+                stat = directory_entry.stat()
+                entry = cached_entries.get(directory_entry.name)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                    entry = {'filename': directory_entry.name, 'beatmapset_id': self.parse_beatmapset_id(directory_entry.name),
+                             'size': stat.st_size, 'mtime': stat.st_mtime}
+                    changed_entries.append(DirectoryEntry(entry))
+                entries[directory_entry.name] = entry
+
+        removed_filenames = [filename for filename in cached_entries if filename not in entries]
+        if changed_entries:
+            self.db.insert_many(changed_entries, replace=True)
+        if removed_filenames:
+            self.db.remove_directory_entries(removed_filenames)
+        printer.print_debug('Directory Scan Process',
+                            {'Directory': self.directory, 'Files': len(entries), 'Changed': len(changed_entries), 'Removed': len(removed_filenames)})
+        return entries
+
+    def reconcile(self, unflag_missing: bool = False) -> Dict[str, List[int]]:
+        """
+        Flags beatmapsets found in the directory as downloaded, in bulk. Downloaded beatmapsets whose file is gone are only listed as missing,
+        as osu! deletes the .osz files it imports, unflag_missing unflags them too so they are downloaded again.
+        Nothing is unflagged when the directory does not exist, as that is more likely a misconfiguration than an emptied library.
+        """
+        reconciled = {'flagged': [], 'missing': [], 'unflagged': [], 'unrecognized': []}
+        if not os.path.isdir(self.directory):
+            return reconciled
+        start = time.perf_counter()
+        entries = self.scan()
+
+        files_by_beatmapset_id = {}
+        for entry in entries.values():
+            if entry['beatmapset_id'] is None:
+                reconciled['unrecognized'].append(entry['filename'])
+            else:
+                files_by_beatmapset_id[entry['beatmapset_id']] = entry
+        downloaded_index = self.db.downloaded_index
+
+        flagged_objects = [DownloadedBeatmapset({'beatmapset_id': beatmapset_id, 'downloaded': True, 'size': entry['size'], 'verified': False,
+                                                 'downloaded_at': datetime.fromtimestamp(entry['mtime']).isoformat(' ', 'seconds')})
+                           for beatmapset_id, entry in files_by_beatmapset_id.items() if beatmapset_id not in downloaded_index]
+        reconciled['flagged'] = [downloaded_object.data['beatmapset_id'] for downloaded_object in flagged_objects]
+        reconciled['missing'] = [beatmapset_id for beatmapset_id in downloaded_index if beatmapset_id not in files_by_beatmapset_id]
+        if unflag_missing:
+            reconciled['unflagged'] = reconciled['missing']
+        if flagged_objects:
+            self.db.bulk_flag_as_downloaded(flagged_objects, replace=True)
+        if reconciled['unflagged']:
+            self.db.unflag_as_downloaded(reconciled['unflagged'])
+        self.db.flush()
+
+        printer.print_debug('Directory Reconcile Process',
+                            {'Directory': self.directory, 'Flagged': len(reconciled['flagged']), 'Missing': len(reconciled['missing']), 'Unflagged': len(reconciled['unflagged']),
+                             'Unrecognized': len(reconciled['unrecognized']), 'Elapsed': time.perf_counter()-start})
+        return reconciled
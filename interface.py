@@ -1,29 +1,44 @@
 import sys
+import time
+import cProfile
 from argparse import ArgumentParser
 
 from WrappedObjects import ObjectifiedDict, Config, Credential, Beatmap
-from utils import NULL, PrettyPrinter, inquire_params, get_date_from_string, dump_json, remove_duplicate_in_list
+from utils import NULL, PrettyPrinter, inquire_params, get_date_from_string, dump_ndjson, iter_ndjson, metric_size_formatter, iter_chunks
 
 from DBManager import osuDB, MultiThreadedOsuDB
 from api import osuAPI
+from downloader import ConcurrentDownloader
+from indexer import DirectoryIndexer
+from planner import DownloadPlan, DownloadPlanner
+from backfill import Backfill
+from metrics import Metrics
+from columnar import ColumnarSnapshot, is_available as is_columnar_available
+
+
+metrics = Metrics._get_default()
 
 
 class Interface:
+    BEATMAP_FILTERS = ['query'] # Filters given the whole beatmap instead of one of its attributes
+    
     def __init__(self, config: Config, api_key: str, credentials: Credential):
         self.config = config
         self.api_key = api_key
         self.credentials = credentials
         self.api: osuAPI = osuAPI(self.api_key, self.credentials, self.config, initialize=False)
-        self.db: osuDB = MultiThreadedOsuDB(config.database, initialize=False)
+        self.db: osuDB = MultiThreadedOsuDB(config.database, initialize=False, profile=config.database_profile, batch_size=config.database_write_batch_size, 
+                                            batch_interval=config.database_write_batch_interval, max_queue_size=config.database_write_queue_size)
         self.printer: PrettyPrinter = PrettyPrinter._get_default()
         self.printer.debug = self.config.debug
         
-        self._actions = {'DOWNLOAD':self.cli_downloader, 'INTERACTIVE':self.cli_interactive, NULL:self.cli_interactive}
+        self._actions = {'DOWNLOAD':self.cli_downloader, 'CRAWL':self.cli_crawler, 'BACKFILL':self.cli_backfiller, 'RECONCILE':self.cli_reconciler, 'EXPORT':self.cli_exporter, 'IMPORT':self.cli_importer, 'INTERACTIVE':self.cli_interactive, NULL:self.cli_interactive}
         
         self.parsed_args = {}
         self.params = {}
         self.download_params = {}
         self.filters = {}
+        self.filter_specs = []
     
     @property
     def initialized(self):
@@ -35,16 +50,56 @@ class Interface:
             self.api._init()
 
     def process_filter(self, filter_arg_entry):
-        processors = {'approved': lambda lst:(lambda lst:lambda q: q in lst)(','.join(lst)),
-                      'difficultyrating': lambda _s: (lambda matchf:lambda f: float(f) == matchf)(float(_s)) if not _s.__contains__('-') else 
-                                          lambda _s: (lambda bounds: lambda f: bounds[0] <= float(f) <= bounds[1])(sorted(map(float, _s.split('-')))),
-                      'favourite_count': lambda _s: (lambda min_count: lambda count: min_count<=int(count))(int(_s)),
-                      'rating': lambda _s: (lambda min_rating: lambda rating: min_rating<=float(rating))(float(_s))}
+        # Beatmap records and database rows are already typed, so the filters compare values as they are.
+        processors = {'approved': lambda lst:(lambda approved:lambda q: q in approved)({int(q) for q in lst}),
+                      'difficultyrating': lambda _s: (lambda matchf:lambda f: f == matchf)(float(_s)) if not _s.__contains__('-') else 
+                                          (lambda bounds: lambda f: f is not None and bounds[0] <= f <= bounds[1])(sorted(map(float, _s.split('-')))),
+                      'favourite_count': lambda _s: (lambda min_count: lambda count: min_count<=count)(int(_s)),
+                      'rating': lambda _s: (lambda min_rating: lambda rating: min_rating<=rating)(float(_s)),
+                      'query': lambda _s: lambda beatmap: osuDB.match_beatmap_text(_s, beatmap)}
+        # Same filters as (column, operator, value) specs for the beatmaps table, see make_filter_specs.
+        spec_processors = {'approved': lambda lst: ('approved', 'in', [int(q) for q in lst]),
+                           'difficultyrating': lambda _s: ('difficultyrating', '=', float(_s)) if not _s.__contains__('-') else 
+                                               ('difficultyrating', 'between', sorted(map(float, _s.split('-')))),
+                           'favourite_count': lambda _s: ('favourite_count', '>=', int(_s)),
+                           'rating': lambda _s: ('rating', '>=', float(_s)),
+                           'query': lambda _s: ('text', 'match', _s)}
         name, value = filter_arg_entry
         self.filters[name] = self.filters.get(name, []) + [processors.get(name)(value)]
+        self.filter_specs.append(spec_processors.get(name)(value))
+    
+    def make_filter_specs(self):
+        """Filters and get beatmaps params that also apply to beatmaps in the database, as (column, operator, value) specs."""
+        filter_specs = list(self.filter_specs)
+        if 'm' in self.params:
+            filter_specs.append(('mode', '=', int(self.params['m'])))
+        if 'since' in self.params:
+            filter_specs.append(('approved_date', '>', str(self.params['since'])))
+        return filter_specs
+    
+    def make_sql_filters(self):
+        """make_filter_specs as (clause, params) conditions for osuDB.get_beatmapsets_where."""
+        sql_filters = []
+        for column, operator, value in self.make_filter_specs():
+            if operator == 'match':
+                sql_filters.append(('beatmap_id IN (SELECT rowid FROM "{0}" WHERE "{0}" MATCH ?)'.format(osuDB.FTS_TABLE), [osuDB.make_fts_query(value)]))
+            elif operator == 'in':
+                sql_filters.append(("{} IN ({})".format(column, ','.join('?'*len(value))), list(value)))
+            elif operator == 'between':
+                sql_filters.append(("{} BETWEEN ? AND ?".format(column), list(value)))
+            else:
+                sql_filters.append(("{} {} ?".format(column, operator), [value]))
+        return sql_filters
+    
+    def lookup_beatmapsets(self):
+        """One beatmap per beatmapset in the database matching the filters, through the columnar snapshot when numpy is installed."""
+        if not (self.config.columnar_engine and is_columnar_available()):
+            return self.db.get_beatmapsets_where(self.make_sql_filters())
+        snapshot = ColumnarSnapshot(self.db, self.config.columnar_snapshot_dir).refresh()
+        return self.db.get_beatmaps_by_ids(snapshot.select_beatmapsets(self.make_filter_specs()))
     
     def process_args(self):
-        for key, val in [(k,v) for k,v in self.parsed_args.items() if v is not NULL]:
+        for key, val in [(k,v) for k,v in self.parsed_args.items() if v is not NULL and v is not None]:
             if key.startswith('config_'):
                 self.config[key.split('_', 1)[-1]] = val
             elif key.startswith('params_'):
@@ -56,23 +111,47 @@ class Interface:
 
     def filter_beatmap(self, beatmap: dict):
         for beatmap_attr, filters in self.filters.items():
-            if any([not filter(beatmap[beatmap_attr]) for filter in filters]):
+            value = beatmap if beatmap_attr in self.BEATMAP_FILTERS else beatmap[beatmap_attr]
+            if any([not filter(value) for filter in filters]):
                 return False
         return True
     
     def filter_beatmaps(self, beatmap_list: list):
         return [beatmap for beatmap in beatmap_list if self.filter_beatmap(beatmap)]
     
-    def start(self, args: list = sys.argv[1:]):
+    @staticmethod
+    def parse_download_order(_s: str):
+        orderings = [ordering.strip() for ordering in _s.split(',') if ordering.strip()]
+        if any(ordering not in DownloadPlanner.ORDERINGS for ordering in orderings):
+            raise ValueError(_s)
+        # NULL is an empty string, which argparse parses like any string default, no orderings keep the configured ones.
+        return orderings or None
+    
+    def make_parser(self):
         parser = ArgumentParser(description="This is the cli interface for osu-map-downloader.")
         
         parser.add_argument("action", metavar='ACTION', type=str.upper, choices=self._actions, default=NULL, nargs='?', help="Action to do.")
         
         configs = parser.add_argument_group('Configurations')
         configs.add_argument('--download-directory', metavar='DIRECTORY', dest='config_download_directory', default=NULL, help="Sets download directory for api. Default='./Downloads'")
-        configs.add_argument('--download-chunk-size', metavar='CHUNK_SIZE', dest='config_download_chunk_size', type=int, default=self.config.download_chunk_size, help="Sets download chunk size for api. Default=512b")
+        configs.add_argument('--download-chunk-size', metavar='CHUNK_SIZE', dest='config_download_chunk_size', type=int, default=self.config.download_chunk_size, help="Sets the minimum download chunk size for api, chunks grow with the download size. Default=512b")
+        configs.add_argument('-w', '--download-workers', metavar='WORKERS', dest='config_download_workers', type=int, default=self.config.download_workers, help="Sets how many beatmapsets are downloaded in parallel. Default=1")
+        configs.add_argument('--no-reconcile', action='store_false', dest='config_reconcile_download_dir', default=NULL, help="Skips matching the download directory against the database before downloading.")
+        configs.add_argument('--unflag-missing', action='store_true', dest='config_reconcile_unflag_missing', default=NULL, help="Unflags downloaded beatmapsets missing from the download directory while reconciling, so they are downloaded again.")
+        configs.add_argument('-o', '--order', metavar='ORDERINGS', dest='config_download_order', type=self.parse_download_order, default=NULL, help="Sets the download order, comma separated orderings applied in turn: newest, favourites, smallest, failed-last. Default=failed-last")
+        configs.add_argument('--dry-run', action='store_true', dest='config_dry_run', default=NULL, help="Prints the planned beatmapsets and their estimated size without downloading them.")
         configs.add_argument('--record-beatmaps', action='store_true', dest='config_record_beatmaps', default=NULL, help="Whether to save beatmaps to database or not.")
         configs.add_argument('--lookup-in-database', action='store_true', dest='config_lookup_beatmaps_in_database', default=NULL, help="Whether to search for beatmaps to download from accumulated database.")
+        configs.add_argument('--until', metavar='DATETIME', dest='config_backfill_until', default=NULL, type=get_date_from_string, help="Sets the end of the BACKFILL date range, same formats as --since. Default=start of today")
+        configs.add_argument('--shards', metavar='SHARDS', dest='config_backfill_shards', type=int, default=self.config.backfill_shards, help="Sets how many date ranges BACKFILL is split into. Default=16")
+        configs.add_argument('--processes', metavar='PROCESSES', dest='config_backfill_processes', type=int, default=self.config.backfill_processes, help="Sets how many processes BACKFILL crawls shards with, sharing the api rate budget. Default=4")
+        configs.add_argument('--file', metavar='PATH', dest='config_transfer_file', default=NULL, help="Sets the NDJSON file for EXPORT and IMPORT, compressed when it ends with .gz, .bz2 or .xz. Default='./beatmaps.ndjson.gz'")
+        configs.add_argument('--on-conflict', metavar='POLICY', dest='config_import_conflict', choices=['replace', 'ignore'], default=NULL, help="Sets whether IMPORT replaces or ignores beatmaps already in the database. Default=replace")
+        configs.add_argument('--no-cache', action='store_false', dest='config_use_cache', default=NULL, help="Bypasses the api response cache.")
+        configs.add_argument('--refresh-cache', action='store_true', dest='config_refresh_cache', default=NULL, help="Fetches fresh api responses and stores them into the cache.")
+        configs.add_argument('--progress', metavar='MODE', dest='config_progress_mode', choices=['auto', 'bar', 'quiet'], default=NULL, help="Sets how download progress is shown: auto, bar or quiet. auto only draws progress on a terminal. Default=auto")
+        configs.add_argument('--metrics', metavar='PATH', dest='config_metrics_file', default=NULL, help="Writes runtime metrics to PATH periodically and at exit, as Prometheus text for .prom files and json otherwise.")
+        configs.add_argument('--profile', metavar='PATH', dest='config_profile_file', default=NULL, help="Runs the action under cProfile and writes the stats to PATH, readable with pstats. Only the main thread is profiled.")
         configs.add_argument('-d', '--debug', dest='config_debug', default=NULL, action='store_true', help="Sets debug in printer. Default=False")
         
         params = parser.add_argument_group('Get Beatmaps Params')
@@ -84,11 +163,16 @@ class Interface:
         download_params.add_argument('-nv', '--no-video', action='store_true', dest='download_params_noVideo', default=NULL, help="Whether to download beatmapset with video or not.")
         
         filters = parser.add_argument_group('Download Filters')
-        filters.add_argument('-a', '-q', '--approved', '--qualification', metavar='QUALIFICATION', action='append', dest='filters_approved', default=NULL, help="Adds beatmaps filter to specified approved. To add multiple qualifications, stack it like: '-q 0 -q 1 ...'. Qualifications: 4 = loved, 3 = qualified, 2 = approved, 1 = ranked, 0 = pending, -1 = WIP, -2 = graveyard")
+        filters.add_argument('-a', '-q', '--approved', '--qualification', metavar='QUALIFICATION', action='append', dest='filters_approved', default=None, help="Adds beatmaps filter to specified approved. To add multiple qualifications, stack it like: '-q 0 -q 1 ...'. Qualifications: 4 = loved, 3 = qualified, 2 = approved, 1 = ranked, 0 = pending, -1 = WIP, -2 = graveyard")
         filters.add_argument('--diff', '--difficulty', '--difficulty-rating', metavar='RATING', dest='filters_difficultyrating', default=NULL, help="Adds beatmaps filter for range or exact match on difficultyrating. Ratings will be converted to floats. Rating formats: [x.xx] or [x] and [x.xx-y.yy]")
         filters.add_argument('-f', '--favourite', dest='filters_favourite_count', metavar='FAVOURITE_COUNT', default=NULL, help="Adds beatmaps filter for minimum favourite count on the beatmapset.")
+        filters.add_argument('-t', '--query', metavar='TEXT', dest='filters_query', default=NULL, help="Adds beatmaps filter for every word of TEXT, as a word prefix in the artist, title, creator, source or tags, e.g. 'camellia ghost'.")
         filters.add_argument('-r', '--rating', dest='filters_rating', metavar='RATING', default=NULL, help="Adds beatmaps filter for minimum rating on the beatmapset.")
         
+        return parser
+    
+    def start(self, args: list = sys.argv[1:]):
+        parser = self.make_parser()
         namespace = parser.parse_args(args)
         self.parsed_args = ObjectifiedDict(vars(namespace))
         self.process_args()
@@ -99,40 +183,164 @@ class Interface:
                                   'Namespace': namespace, 'Filter Conditions': self.filters},
                                  header_prefix='|>|')
         
+        if self.config.metrics_file:
+            metrics.start_writer(self.config.metrics_file, self.config.metrics_interval)
+        if self.config.profile_file:
+            return self.profile(self._actions[namespace.action], self.config.profile_file)
         return self._actions[namespace.action]()
     
+    def profile(self, action, filename: str):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(action)
+        finally:
+            profiler.dump_stats(filename)
+            print("Profile written to {}, view it with: python -m pstats {}".format(filename, filename))
+    
+    def reconcile_download_dir(self):
+        indexer = DirectoryIndexer(self.db, self.config.download_dir, self.config.formattable_beatmap_filename)
+        with metrics.time('planning_seconds', stage='reconcile'):
+            reconciled = indexer.reconcile(unflag_missing=self.config.reconcile_unflag_missing)
+        print("Reconciled Download Directory: {} Beatmapsets found on disk, {} missing from disk ({} unflagged), {} unrecognized files.".format(
+              len(reconciled['flagged']), len(reconciled['missing']), len(reconciled['unflagged']), len(reconciled['unrecognized'])))
+        return reconciled
+    
     def cli_downloader(self):
         self._init()
+        if self.config.reconcile_download_dir:
+            self.reconcile_download_dir()
         
-        beatmaps = self.api.get_beatmaps(params=self.params)
-        print("Fetched {} Beatmaps from osu api.".format(len(beatmaps)))
+        # Streamed beatmaps are recorded and filtered chunk by chunk, while the rest of the response is still arriving.
+        beatmaps = self.api.get_beatmaps(params=self.params, stream=self.config.stream_api_responses) or []
+        fetched_count = 0
+        filtered_beatmaps = []
+        for beatmaps_chunk in iter_chunks(beatmaps, self.config.database_write_batch_size):
+            fetched_count += len(beatmaps_chunk)
+            if self.config.record_beatmaps:
+                self.db.add_beatmaps(beatmaps_chunk, replace=True)
+            with metrics.time('filter_seconds'):
+                filtered_beatmaps += self.filter_beatmaps(beatmaps_chunk)
+        print("Fetched {} Beatmaps from osu api.".format(fetched_count))
         if self.config.record_beatmaps:
-            self.db.add_beatmaps(beatmaps, replace=True)
-            print("Recorded {} Beatmaps into the database.".format(len(beatmaps)))
+            print("Recorded {} Beatmaps into the database.".format(fetched_count))
         if self.config.lookup_beatmaps_in_database:
-            beatmaps_in_db = self.db.get_all_beatmaps()
-            beatmaps+=beatmaps_in_db
-            print("Found {} Beatmaps in Database, For a Total of {} Beatmaps.".format(len(beatmaps_in_db), len(beatmaps)))
+            self.db.flush()
+            with metrics.time('planning_seconds', stage='database_lookup'):
+                beatmaps_in_db = self.lookup_beatmapsets()
+            if self.config.record_beatmaps:
+                # Fetched beatmaps were just recorded, so the database lookup already covers them.
+                filtered_beatmaps = []
+            filtered_beatmaps += beatmaps_in_db
+            print("Found {} Matching Beatmapsets in Database.".format(len(beatmaps_in_db)))
+        
+        with metrics.time('planning_seconds', stage='plan'):
+            filtered_beatmaps = [Beatmap(data) for data in filtered_beatmaps]
+            planner = DownloadPlanner(self.db, self.config.download_order, no_video=bool(self.download_params.get('noVideo')))
+            plan = planner.make_plan(filtered_beatmaps)
+        print("Filtered Beatmaps: {} Beatmaps and {} Unique Beatmapsets".format(len(filtered_beatmaps), len(plan)+plan.skipped))
+        print("Skipping {} Beatmapsets already found in database.".format(plan.skipped))
+        print("Planned {} Beatmapsets, about {} to download.".format(len(plan), metric_size_formatter(plan.estimated_bytes)))
         
-        filtered_beatmaps = [Beatmap(data) for data in self.filter_beatmaps(beatmaps)]
-        beatmapsets = remove_duplicate_in_list(filtered_beatmaps, 'beatmapset_id', lambda e:e['beatmap_id'])
-        print("Filtered Beatmaps: {} Beatmaps and {} Unique Beatmapsets".format(len(filtered_beatmaps), len(beatmapsets)))
+        if self.config.dry_run:
+            return self.print_plan(plan)
         
         print("Starting Download...\n")
         
+        if self.config.download_workers > 1:
+            return self.cli_concurrent_downloader(plan)
         
-        for i, beatmap in enumerate(filtered_beatmaps):
-            print("\nBeatmap #{}".format(i+1))
+        failed = 0
+        for i, beatmap in enumerate(plan):
+            print("\nBeatmapset #{}".format(i+1))
             print("Processing Beatmap: {}".format(str(beatmap)))
-            if self.db.check_exists_in_downloaded(beatmap):
-                print("Already downloaded, entry found in database.\n")
-                continue
             print("Downloading Beatmap...")
-            self.api.download_to_file(beatmap, params=self.download_params)
+            downloaded = self.api.download_to_file(beatmap, params=self.download_params)
+            if not downloaded:
+                failed += 1
+                print("Download Failed.\n")
+                self.db.record_download_failure(beatmap)
+                continue
             print("Beatmap Downloaded.\n")
-            self.db.flag_as_downloaded(beatmap)
+            self.db.flag_as_downloaded(downloaded, replace=True)
+        self.db.flush()
         
-        print("Finished Downloading.")
+        print("Finished Downloading. {} Downloaded, {} Failed.".format(len(plan)-failed, failed))
+    
+    def print_plan(self, plan: DownloadPlan):
+        print("Dry Run, ordered by {}:".format(', '.join(plan.order) or 'api order'))
+        for i, beatmap in enumerate(plan):
+            print("#{} {} (~{})".format(i+1, str(beatmap), metric_size_formatter(plan.estimated_sizes[int(beatmap['beatmapset_id'])])))
+        print("Total: {} Beatmapsets, about {}.".format(len(plan), metric_size_formatter(plan.estimated_bytes)))
+        return plan
+    
+    def cli_concurrent_downloader(self, plan: DownloadPlan):
+        print("Downloading {} Beatmapsets with {} workers...\n".format(len(plan), self.config.download_workers))
+        
+        downloader = ConcurrentDownloader(self.api, self.config.download_workers, params=self.download_params)
+        failed = 0
+        for i, (beatmap, downloaded) in enumerate(downloader.download_all(plan)):
+            if not downloaded:
+                failed += 1
+                downloader.reporter.log("#{} Failed: {}".format(i+1, str(beatmap)))
+                self.db.record_download_failure(beatmap)
+                continue
+            downloader.reporter.log("#{} Downloaded: {}".format(i+1, str(beatmap)))
+            self.db.flag_as_downloaded(downloaded, replace=True)
+        self.db.flush()
+        
+        print("Finished Downloading. {} Downloaded, {} Failed.".format(len(plan)-failed, failed))
+    
+    def cli_crawler(self):
+        self._init()
+        
+        # Watermarks are kept per game mode, as crawling one mode says nothing about the others.
+        state_key = 'get_beatmaps.since' + ('.m{}'.format(self.params['m']) if 'm' in self.params else '')
+        params = {key: val for key, val in self.params.items() if key != 'limit'}
+        stored_watermark = self.db.get_state(state_key)
+        if 'since' not in params and stored_watermark is not None:
+            params['since'] = stored_watermark
+        print("Crawling Beatmaps since {}...".format(params.get('since', 'the beginning')))
+        
+        total = 0
+        for page in self.api.iter_beatmap_pages(params):
+            self.db.add_beatmaps(page, replace=True)
+            total += len(page)
+            watermark = self.api.get_watermark(page)
+            if watermark is not None and (stored_watermark is None or watermark > stored_watermark):
+                self.db.set_state(state_key, watermark)
+                stored_watermark = watermark
+            print("Recorded {} Beatmaps into the database, up to {}.".format(total, watermark))
+        
+        self.db.flush()
+        print("Finished Crawling. {} Beatmaps Recorded.".format(total))
+    
+    def cli_backfiller(self):
+        self.db._init()
+        backfill = Backfill(self.db, self.api_key, self.credentials, self.config, self.params,
+                            shards=self.config.backfill_shards, processes=self.config.backfill_processes)
+        result = backfill.run(self.params.get('since'), self.config.backfill_until)
+        if result['failed']:
+            print("Run the same command again to resume the {} failed shards.".format(len(result['failed'])))
+    
+    def cli_reconciler(self):
+        self._init()
+        reconciled = self.reconcile_download_dir()
+        self.printer.print_debug('Reconcile Result', reconciled, header_prefix='|>|')
+    
+    def cli_exporter(self):
+        self.db._init()
+        self.db.flush()
+        start = time.perf_counter()
+        count = dump_ndjson(self.db.iter_beatmaps(self.config.transfer_batch_size), self.config.transfer_file)
+        print("Exported {} Beatmaps to {} in {:.2f}s.".format(count, self.config.transfer_file, time.perf_counter()-start))
+    
+    def cli_importer(self):
+        self.db._init()
+        start = time.perf_counter()
+        count = self.db.import_beatmaps(iter_ndjson(self.config.transfer_file), self.config.transfer_batch_size,
+                                        **{self.config.import_conflict: True})
+        self.db.flush()
+        print("Imported {} Beatmaps from {} in {:.2f}s.".format(count, self.config.transfer_file, time.perf_counter()-start))
     
     def cli_interactive(self):
         self._init()
@@ -145,18 +353,18 @@ class Interface:
                 params = inquire_params({'u':"Enter user identifier(name/id):", 'm':"Enter game mode(0 = osu!, 1 = Taiko, 2 = CtB, 3 = osu!mania):"})
                 users = self.api.get_users(params)
                 print("\nMatching Users: \n%s" % "\n".join(["#{}. {}".format(i+1, user) for i, user in enumerate(users)]))
-                filename = input("\nEnter filename to save to(json file):") or 'dump.json'
-                filename = filename if filename.endswith('.json') else ("%s.json" % filename)
-                dump_json(users, filename, indent=4)
+                filename = input("\nEnter filename to save to(ndjson file):") or 'dump.ndjson'
+                filename = filename if '.ndjson' in filename else ("%s.ndjson" % filename)
+                dump_ndjson(users, filename)
                 print("Dumped users data to {}.".format(filename))
             elif choice == 'b':
                 print("-- Download Beatmaps Info --\nAll params below is optional, you can press enter to skip.")
                 params = inquire_params({'since': "Since (format: yyyy-mm-dd):", 'm': "Specific Game Mode (0:Std, 1:Taiko, 2:CtB, 3:Mania):", 'limit': "Limit (result size limit):"})
                 beatmaps = self.api.get_beatmaps(params)
                 print("\nFetched Beatmaps: \n%s" % "\n".join(["#{}. {}".format(i+1, beatmap) for i, beatmap in enumerate(beatmaps)]))
-                filename = input("\nEnter filename to save to(json file):") or 'dump.json'
-                filename = filename if filename.endswith('.json') else ("%s.json" % filename)
-                dump_json(beatmaps, filename, indent=4)
+                filename = input("\nEnter filename to save to(ndjson file):") or 'dump.ndjson'
+                filename = filename if '.ndjson' in filename else ("%s.ndjson" % filename)
+                dump_ndjson((dict(beatmap) for beatmap in beatmaps), filename)
                 print("Dumped beatmaps data to {}.".format(filename))
             elif choice == 'd':
                 self.start(input("Args Input For CLI Downloader:").split())
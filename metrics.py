@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import atexit
+import threading
+import contextlib
+
+from typing import Any, Dict, List, Tuple
+
+
+__all__ = ['Metrics']
+
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """
+    Thread-safe counters, gauges and timers, each identified by a name and optional labels, e.g. api_requests_total{endpoint="get_beatmaps"}.
+    Timers keep the count, sum and max of their observations. Snapshots are written as json, or as Prometheus text for .prom files.
+    """
+    _DEFAULT_METRICS = None
+
+    @classmethod
+    def _get_default(cls):
+        if cls._DEFAULT_METRICS is None:
+            cls._DEFAULT_METRICS = cls()
+        return cls._DEFAULT_METRICS
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[LabelsKey, float]] = {}
+        self.gauges: Dict[str, Dict[LabelsKey, float]] = {}
+        self.timers: Dict[str, Dict[LabelsKey, List[float]]] = {} # labels: [count, sum, max]
+        self.started_at = time.time()
+        self._writer: threading.Thread = None
+        self._writer_stop = threading.Event()
+        self._writer_path: str = None
+
+    def __repr__(self):
+        return "<{} object counters={} gauges={} timers={}>".format(self.__class__.__name__, len(self.counters), len(self.gauges), len(self.timers))
+
+    @staticmethod
+    def make_labels_key(labels: Dict[str, Any]) -> LabelsKey:
+        return tuple(sorted((str(name), str(value)) for name, value in labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = self.make_labels_key(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0)+value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = self.make_labels_key(labels)
+        with self._lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self.make_labels_key(labels)
+        with self._lock:
+            timer = self.timers.setdefault(name, {}).setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += value
+            timer[2] = max(timer[2], value)
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels):
+        """Observes the seconds spent in the with block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter()-start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timers.clear()
+            self.started_at = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            make_series = lambda series, make_value: [dict(labels=dict(key), **make_value(value)) for key, value in series.items()]
+            return {'created_at': time.time(), 'started_at': self.started_at,
+                    'counters': {name: make_series(series, lambda value: {'value': value}) for name, series in self.counters.items()},
+                    'gauges': {name: make_series(series, lambda value: {'value': value}) for name, series in self.gauges.items()},
+                    'timers': {name: make_series(series, lambda value: {'count': value[0], 'sum': value[1], 'max': value[2]}) for name, series in self.timers.items()}}
+
+    @staticmethod
+    def format_prometheus_labels(labels: Dict[str, str], **extra_labels):
+        labels = dict(labels, **extra_labels)
+        if not labels:
+            return ''
+        escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{'+','.join('{}="{}"'.format(name, escape(str(value))) for name, value in labels.items())+'}'
+
+    def to_prometheus(self, snapshot: Dict[str, Any] = None) -> str:
+        """Prometheus text exposition of a snapshot, timers are exposed as summaries without quantiles plus a _max gauge."""
+        snapshot = snapshot or self.snapshot()
+        lines = []
+        for metric_type, section in [('counter', 'counters'), ('gauge', 'gauges')]:
+            for name, series in sorted(snapshot[section].items()):
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                lines += ["{}{} {}".format(name, self.format_prometheus_labels(entry['labels']), entry['value']) for entry in series]
+        for name, series in sorted(snapshot['timers'].items()):
+            lines.append("# TYPE {} summary".format(name))
+            for entry in series:
+                labels = self.format_prometheus_labels(entry['labels'])
+                lines += ["{}_count{} {}".format(name, labels, entry['count']), "{}_sum{} {}".format(name, labels, entry['sum'])]
+            lines.append("# TYPE {}_max gauge".format(name))
+            lines += ["{}_max{} {}".format(name, self.format_prometheus_labels(entry['labels']), entry['max']) for entry in series]
+        return "\n".join(lines)+"\n"
+
+    def write(self, path: str):
+        """Writes a snapshot to path, replacing the previous one at once so readers never see a partial file."""
+        snapshot = self.snapshot()
+        content = self.to_prometheus(snapshot) if path.endswith('.prom') else json.dumps(snapshot, indent=4)
+        temp_path = path+'.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.replace(temp_path, path)
+
+    def start_writer(self, path: str, interval: float = 60.0):
+        """Writes a snapshot to path every interval seconds from a daemon thread, and once more at exit."""
+        if self._writer is not None:
+            self._writer_path = path
+            return
+        self._writer_path = path
+        def run():
+            while not self._writer_stop.wait(interval):
+                self.write(self._writer_path)
+        self._writer = threading.Thread(target=run, name='Metrics Writer Thread', daemon=True)
+        self._writer.start()
+        atexit.register(self.stop_writer)
+
+    def stop_writer(self):
+        if self._writer is None:
+            return
+        self._writer_stop.set()
+        self._writer.join()
+        self._writer = None
+        self._writer_stop.clear()
+        self.write(self._writer_path)
@@ -0,0 +1,90 @@
+from DBManager import osuDB
+from WrappedObjects import Beatmap
+from utils import remove_duplicate_in_list
+
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+
+__all__ = ['DownloadPlan', 'DownloadPlanner']
+
+
+class DownloadPlan:
+    """Ordered beatmapsets to download, one beatmap standing for each, with their estimated sizes in bytes."""
+    def __init__(self, beatmapsets: List[Beatmap], estimated_sizes: Dict[int, int], skipped: int = 0, order: List[str] = []):
+        self.beatmapsets = beatmapsets
+        self.estimated_sizes = estimated_sizes
+        self.skipped = skipped
+        self.order = order
+
+    def __repr__(self):
+        return "<{} object beatmapsets={} skipped={} estimated_bytes={} order={}>".format(self.__class__.__name__, len(self.beatmapsets), self.skipped, self.estimated_bytes, self.order)
+
+    def __len__(self):
+        return len(self.beatmapsets)
+
+    def __iter__(self):
+        return iter(self.beatmapsets)
+
+    @property
+    def estimated_bytes(self):
+        return sum(self.estimated_sizes.values())
+
+
+class DownloadPlanner:
+    """
+    Turns filtered beatmaps into a DownloadPlan: one entry per beatmapset, without the ones already downloaded, in the requested order.
+    Orderings are applied like sort keys, the first one deciding most, e.g. ['failed-last', 'newest'].
+    Sizes are estimated from the beatmapset length, scaled by the bytes per second of previous downloads once there are enough of them.
+    """
+    # Bytes per second of total_length, without and with a video. Roughly a 192kbps mp3, and a video on top.
+    ESTIMATED_BYTES_PER_SECOND = {False: 24*1024, True: 24*1024+96*1024}
+    ESTIMATED_BASE_SIZE = 128*1024
+    CALIBRATION_MIN_SAMPLES = 20
+
+    def __init__(self, db: osuDB, order: Iterable[str] = (), *, no_video: bool = False):
+        self.db = db
+        self.order = [ordering for ordering in order if ordering]
+        self.no_video = no_video
+        unknown_orderings = [ordering for ordering in self.order if ordering not in self.ORDERINGS]
+        if unknown_orderings:
+            raise ValueError("Unknown download orderings: {}. Available: {}".format(', '.join(unknown_orderings), ', '.join(self.ORDERINGS)))
+        self.bytes_per_second = dict(self.ESTIMATED_BYTES_PER_SECOND)
+        self._failures: Dict[int, int] = None
+
+    def __repr__(self):
+        return "<{} object order={}>".format(self.__class__.__name__, self.order)
+
+    def calibrate(self):
+        """Replaces the default bytes per second with the ones of previous downloads, when there are enough of them."""
+        for row in self.db.get_downloaded_size_stats():
+            if row['count'] >= self.CALIBRATION_MIN_SAMPLES and row['total_length']:
+                self.bytes_per_second[bool(row['video'])] = max(row['size']-row['count']*self.ESTIMATED_BASE_SIZE, 0)/row['total_length']
+
+    def estimate_size(self, beatmap: Beatmap) -> int:
+        has_video = bool(beatmap['video']) and not self.no_video
+        return int(self.ESTIMATED_BASE_SIZE+self.bytes_per_second[has_video]*(beatmap['total_length'] or 0))
+
+    @property
+    def failures(self) -> Dict[int, int]:
+        if self._failures is None:
+            self._failures = self.db.get_download_failures()
+        return self._failures
+
+    # Each ordering is a sort key and whether it sorts descending. Missing values come last.
+    ORDERINGS: Dict[str, Tuple[Callable[['DownloadPlanner', Beatmap, int], Any], bool]] = {
+        'newest': (lambda self, beatmap, size: str(beatmap['approved_date'] or ''), True),
+        'favourites': (lambda self, beatmap, size: beatmap['favourite_count'] or 0, True),
+        'smallest': (lambda self, beatmap, size: size, False),
+        'failed-last': (lambda self, beatmap, size: self.failures.get(int(beatmap['beatmapset_id']), 0), False),
+    }
+
+    def make_plan(self, beatmaps: Iterable[Beatmap]) -> DownloadPlan:
+        beatmapsets = remove_duplicate_in_list(beatmaps, 'beatmapset_id', lambda beatmap: beatmap['beatmap_id'])
+        pending = self.db.get_missing_beatmapsets(beatmapsets)
+        self.calibrate()
+        estimated_sizes = {int(beatmap['beatmapset_id']): self.estimate_size(beatmap) for beatmap in pending}
+        # Sorted by the least significant ordering first, sorts are stable so the more significant ones keep their ties in order.
+        for ordering in reversed(self.order):
+            sort_key, descending = self.ORDERINGS[ordering]
+            pending.sort(key=lambda beatmap: sort_key(self, beatmap, estimated_sizes[int(beatmap['beatmapset_id'])]), reverse=descending)
+        return DownloadPlan(pending, estimated_sizes, skipped=len(beatmapsets)-len(pending), order=self.order)
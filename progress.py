@@ -0,0 +1,138 @@
+import sys
+import time
+from threading import Lock
+
+from utils import metric_size_formatter, make_progress_bar
+
+from typing import Any, Dict, List
+
+
+__all__ = ['ProgressReporter', 'BarProgressReporter', 'AggregateProgressReporter', 'make_progress_reporter']
+
+
+class ProgressReporter:
+    """
+    Quiet progress reporter, every other reporter implements the same methods.
+    Downloads are identified by a key, so one reporter can follow several downloads at once.
+    """
+    def __init__(self, pipe = sys.stdout, refresh_interval: float = 0.1, **kw):
+        self.pipe = pipe
+        self.refresh_interval = refresh_interval
+
+    def __repr__(self):
+        return "<{} object refresh_interval={}>".format(self.__class__.__name__, self.refresh_interval)
+
+    def start(self, key: Any, total: int, offset: int = 0):
+        pass
+
+    def update(self, key: Any, current: int):
+        pass
+
+    def finish(self, key: Any, success: bool = True):
+        pass
+
+    def log(self, message: str):
+        self.pipe.write(message+"\n")
+        self.pipe.flush()
+
+
+class BarProgressReporter(ProgressReporter):
+    """Draws a progress bar for one download at a time, redrawn at most once every refresh_interval seconds."""
+    def __init__(self, pipe = sys.stdout, refresh_interval: float = 0.1, bar_length: int = 20, **kw):
+        super().__init__(pipe, refresh_interval)
+        self.bar_length = bar_length
+        self._progress: List = [0, 0, 0] # current, total, offset
+        self._start_time = 0.0
+        self._next_draw_time = 0.0
+
+    def draw(self):
+        current, total, offset = self._progress
+        elapsed_time = time.monotonic()-self._start_time+0.001 # +1ms, prevent div by 0 error
+        suffix = " | {curr} of {max}    {speed} ({elapsed_time}s)"
+        suffix = suffix.format(curr=metric_size_formatter(current), max=metric_size_formatter(total),
+                               speed=metric_size_formatter(round((current-offset)/elapsed_time, 2), suffix='bps'), elapsed_time=round(elapsed_time,2))
+        self.pipe.write(make_progress_bar(current, length=self.bar_length, vmax=total, suffix=suffix)+' '*5)
+        self.pipe.flush()
+
+    def start(self, key: Any, total: int, offset: int = 0):
+        self._progress = [offset, total, offset]
+        self._start_time = time.monotonic()
+        self._next_draw_time = 0.0
+
+    def update(self, key: Any, current: int):
+        self._progress[0] = current
+        now = time.monotonic()
+        if now >= self._next_draw_time:
+            self._next_draw_time = now+self.refresh_interval
+            self.draw()
+
+    def finish(self, key: Any, success: bool = True):
+        self.draw()
+        self.log('\nDownloaded Beatmap.' if success else '\nDownload Failed.')
+
+
+class AggregateProgressReporter(ProgressReporter):
+    """Draws a single status line for every download running at once, safe to share between worker threads."""
+    def __init__(self, pipe = sys.stdout, refresh_interval: float = 0.5, **kw):
+        super().__init__(pipe, refresh_interval)
+        self._lock = Lock()
+        self._active: Dict[Any, List] = {} # key: [current, total, offset]
+        self._finished = {True: 0, False: 0}
+        self._finished_bytes = 0
+        self._start_time = time.monotonic()
+        self._next_draw_time = 0.0
+
+    def make_line(self):
+        active_progress = list(self._active.values())
+        downloaded = self._finished_bytes+sum(current-offset for current, _, offset in active_progress)
+        expected = sum(total for _, total, _ in active_progress)
+        current = sum(current for current, _, _ in active_progress)
+        elapsed_time = time.monotonic()-self._start_time+0.001 # +1ms, prevent div by 0 error
+        _s = "\r{active} active ({curr} of {max}) | {done} done, {failed} failed | {downloaded} in {elapsed_time}s, {speed}"
+        return _s.format(active=len(active_progress), curr=metric_size_formatter(current), max=metric_size_formatter(expected),
+                         done=self._finished[True], failed=self._finished[False], downloaded=metric_size_formatter(downloaded),
+                         elapsed_time=round(elapsed_time, 2), speed=metric_size_formatter(round(downloaded/elapsed_time, 2), suffix='bps'))
+
+    def draw(self):
+        self.pipe.write(self.make_line()+' '*5)
+        self.pipe.flush()
+
+    def start(self, key: Any, total: int, offset: int = 0):
+        with self._lock:
+            self._active[key] = [offset, total, offset]
+
+    def update(self, key: Any, current: int):
+        self._active[key][0] = current
+        now = time.monotonic()
+        # Checked outside the lock first, most updates only store their progress.
+        if now >= self._next_draw_time:
+            with self._lock:
+                if now >= self._next_draw_time:
+                    self._next_draw_time = now+self.refresh_interval
+                    self.draw()
+
+    def finish(self, key: Any, success: bool = True):
+        with self._lock:
+            current, _, offset = self._active.pop(key, [0, 0, 0])
+            self._finished_bytes += current-offset
+            self._finished[bool(success)] += 1
+
+    def log(self, message: str):
+        with self._lock:
+            # Clears the status line, prints the message above it and draws the line again.
+            self.pipe.write("\r\033[K"+message+"\n")
+            self.draw()
+
+
+def make_progress_reporter(mode: str = 'auto', concurrent: bool = False, pipe = sys.stdout, **kw) -> ProgressReporter:
+    """
+    Modes: 'bar' draws progress, 'quiet' draws nothing and 'auto' picks 'bar' only when pipe is a terminal.
+    Concurrent downloads get one aggregate line instead of a bar per download.
+    """
+    if mode == 'auto':
+        mode = 'bar' if getattr(pipe, 'isatty', lambda: False)() else 'quiet'
+    if mode == 'quiet':
+        return ProgressReporter(pipe, **kw)
+    if concurrent:
+        return AggregateProgressReporter(pipe, **kw)
+    return BarProgressReporter(pipe, **kw)
@@ -0,0 +1,91 @@
+import time
+import random
+from threading import Lock
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from typing import Dict, Optional, Tuple
+
+
+__all__ = ['TokenBucket', 'RateLimiter', 'backoff_delay', 'get_retry_after']
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0):
+    """Exponential backoff with full jitter, a random delay up to base*2^attempt, capped at cap seconds."""
+    return random.uniform(0, min(cap, base*(2**attempt)))
+
+
+def get_retry_after(resp: requests.Response) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given either as seconds or as a HTTP date. None if absent or unreadable."""
+    retry_after = resp.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp()-time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Allows `rate` acquisitions per second on average and up to `burst` at once.
+    Acquiring reserves a token even when the bucket is empty, so concurrent callers are served in order instead of racing for refills.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "<{} object rate={} burst={} tokens={:.2f}>".format(self.__class__.__name__, self.rate, self.burst, self._tokens)
+
+    def reserve(self, tokens: float = 1.0):
+        """Takes tokens and returns how many seconds the caller has to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens+(now-self._last_refill)*self.rate)
+            self._last_refill = now
+            self._tokens -= tokens
+            wait = -self._tokens/self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until-now)
+
+    def acquire(self, tokens: float = 1.0):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        """Holds every acquisition back for the given seconds, e.g. after a 429 response."""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now+seconds)
+            # Tokens are not refilled while paused, so callers do not burst right after it.
+            self._tokens = min(self._tokens, 0.0)
+            self._last_refill = max(self._last_refill, self._paused_until)
+
+
+class RateLimiter:
+    """Token buckets by category, e.g. {'api': (1.0, 60), 'download': (0.5, 5)} as (requests per second, burst)."""
+    def __init__(self, budgets: Dict[str, Tuple[float, int]]):
+        self.buckets = {category: TokenBucket(rate, burst) for category, (rate, burst) in budgets.items()}
+
+    def __repr__(self):
+        return "<{} object categories={}>".format(self.__class__.__name__, list(self.buckets))
+
+    def acquire(self, category: str):
+        bucket = self.buckets.get(category)
+        return bucket.acquire() if bucket is not None else 0.0
+
+    def pause(self, category: str, seconds: float):
+        bucket = self.buckets.get(category)
+        if bucket is not None:
+            bucket.pause(seconds)
@@ -0,0 +1,167 @@
+import time
+import threading
+from queue import Queue, Empty
+from urllib.parse import urlsplit
+
+from metrics import Metrics
+from constants import Url
+
+from typing import Any, Callable, Dict, List, Tuple
+
+
+__all__ = ['DownloadSource', 'DownloadSources']
+
+
+metrics = Metrics._get_default()
+
+
+class DownloadSource:
+    """
+    A place beatmapsets are downloaded from, as a url formatted with the beatmap, e.g. 'https://mirror.example/d/{0[beatmapset_id]}'.
+    Scored by an exponentially weighted moving average of its time to first byte and throughput, the lower the score the better.
+    """
+    EWMA_ALPHA = 0.3
+    # Priors of a source without observations, optimistic so every source gets tried.
+    PRIOR_FIRST_BYTE_SECONDS = 0.5
+    PRIOR_BYTES_PER_SECOND = 2*1024*1024
+    TYPICAL_SIZE = 10*1024*1024
+    FAILURE_PENALTY_SECONDS = 10.0
+
+    def __init__(self, name: str, formattable_url: str, *, category: str = None, formattable_referer: str = None):
+        self.name = name
+        self.formattable_url = formattable_url
+        self.category = category or name # Rate limiter category, see config.rate_limits
+        self.formattable_referer = formattable_referer
+        self.first_byte_seconds: float = None
+        self.bytes_per_second: float = None
+        self.consecutive_failures = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<{} object name='{}' score={:.2f} failures={}>".format(self.__class__.__name__, self.name, self.score, self.consecutive_failures)
+
+    @classmethod
+    def from_url(cls, formattable_url: str):
+        return cls(urlsplit(formattable_url).hostname or formattable_url, formattable_url)
+
+    def make_url(self, beatmap) -> str:
+        return self.formattable_url.format(beatmap)
+
+    def make_headers(self, beatmap) -> Dict[str, str]:
+        return {'referer': self.formattable_referer.format(beatmap)} if self.formattable_referer else {}
+
+    def update_average(self, average: float, value: float) -> float:
+        return value if average is None else average+self.EWMA_ALPHA*(value-average)
+
+    def record_first_byte(self, seconds: float):
+        with self._lock:
+            self.first_byte_seconds = self.update_average(self.first_byte_seconds, seconds)
+            self.consecutive_failures = 0
+        metrics.observe('download_source_first_byte_seconds', seconds, source=self.name)
+
+    def record_throughput(self, bytes_per_second: float):
+        with self._lock:
+            self.bytes_per_second = self.update_average(self.bytes_per_second, bytes_per_second)
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+        metrics.increment('download_source_failures_total', source=self.name)
+
+    @property
+    def score(self) -> float:
+        """Expected seconds to download a typical beatmapset, plus a penalty for every failure since the last success."""
+        first_byte_seconds = self.first_byte_seconds if self.first_byte_seconds is not None else self.PRIOR_FIRST_BYTE_SECONDS
+        bytes_per_second = self.bytes_per_second if self.bytes_per_second is not None else self.PRIOR_BYTES_PER_SECOND
+        return first_byte_seconds+self.TYPICAL_SIZE/max(bytes_per_second, 1.0)+self.consecutive_failures*self.FAILURE_PENALTY_SECONDS
+
+
+class DownloadSources:
+    """
+    The official download endpoint and the mirrors of config.download_mirrors, ranked by score for every download.
+    race tries them in turn: on a failure it fails over to the next one right away, and when the current one has not produced
+    a first byte within hedge_delay seconds it starts the next one alongside, keeping whichever answers first.
+    """
+    def __init__(self, sources: List[DownloadSource], hedge_delay: float = None):
+        self.sources = sources
+        self.hedge_delay = hedge_delay
+
+    def __repr__(self):
+        return "<{} object sources={} hedge_delay={}>".format(self.__class__.__name__, [source.name for source in self.sources], self.hedge_delay)
+
+    def __len__(self):
+        return len(self.sources)
+
+    @classmethod
+    def from_config(cls, config):
+        official = DownloadSource('official', Url.formattable_beatmapset_download, category='download', formattable_referer=Url.formattable_beatmapset)
+        return cls([official]+[DownloadSource.from_url(url) for url in config.download_mirrors or []], config.download_hedge_delay)
+
+    def rank(self, beatmap) -> List[DownloadSource]:
+        """Sources by score, ties kept in configured order. The official one is left out when osu! marks the beatmapset as unavailable."""
+        sources = [source for source in self.sources if not (source.name == 'official' and beatmap.get('download_unavailable') and len(self.sources) > 1)]
+        return sorted(sources, key=lambda source: source.score)
+
+    def race(self, sources: List[DownloadSource], attempt: Callable[[DownloadSource], Any], should_fail_over: Callable[[Any], bool],
+             discard: Callable[[Any], None]) -> Any:
+        """
+        Returns the outcome of the first attempt(source) that should not fail over, attempts raising count as failing over.
+        When every source fails over, returns the outcome of the best ranked one, or raises its exception.
+        Outcomes of attempts finishing after the winner are passed to discard.
+        """
+        if len(sources) == 1:
+            return attempt(sources[0])
+
+        results: Queue = Queue()
+        def run(source: DownloadSource):
+            start = time.perf_counter()
+            try:
+                outcome, raised = attempt(source), False
+            except Exception as exc:
+                outcome, raised = exc, True
+            results.put((source, outcome, raised, time.perf_counter()-start))
+
+        pending, running = list(sources), 0
+        failures: Dict[DownloadSource, Tuple[Any, bool]] = {}
+        def start_next():
+            nonlocal running
+            threading.Thread(target=run, args=(pending.pop(0),), name='Download Source Thread', daemon=True).start()
+            running += 1
+
+        start_next()
+        winner = None
+        while running:
+            try:
+                source, outcome, raised, elapsed = results.get(timeout=self.hedge_delay if pending and self.hedge_delay is not None else None)
+            except Empty:
+                metrics.increment('download_hedged_total')
+                start_next()
+                continue
+            running -= 1
+            if raised or should_fail_over(outcome):
+                source.record_failure()
+                failures[source] = (outcome, raised)
+                if pending:
+                    metrics.increment('download_failovers_total')
+                    start_next()
+                continue
+            source.record_first_byte(elapsed)
+            winner = outcome
+            break
+
+        if running:
+            # Attempts still in flight lose the race, their outcomes are discarded as they arrive.
+            def discard_losers(count: int):
+                for _ in range(count):
+                    _, outcome, raised, _ = results.get()
+                    if not raised:
+                        discard(outcome)
+            threading.Thread(target=discard_losers, args=(running,), name='Download Source Discard Thread', daemon=True).start()
+        if winner is None:
+            winner, raised = next(failures[source] for source in sources if source in failures)
+            if raised:
+                raise winner
+        for outcome, raised in failures.values():
+            if not raised and outcome is not winner:
+                discard(outcome)
+        return winner
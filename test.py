@@ -1,6 +1,8 @@
 
 
 def test_utils():
+    import json
+    import hashlib
     import utils
     
     # dict_updater test
@@ -31,6 +33,845 @@ def test_utils():
     flatten_dataset = [entry for _set in dataset for entry in _set]
     cleaned_dataset = utils.remove_duplicate_in_list(flatten_dataset, 'id', lambda entry:entry['sub_id'])
     assert cleaned_dataset == [{'id':_id+1, 'sub_id': max_sub_id} for _id in range(max_id)]
+    
+    # iter_json_array test
+    document = [{'beatmap_id': str(i), 'title': 'タイトル {}'.format(i), 'tags': '[] {} ,"'} for i in range(50)] + [12345, 1.5e3, None, [1, [2]], "]"]
+    encoded = json.dumps(document, ensure_ascii=False, indent=1).encode('utf-8')
+    for chunk_size in [1, 3, 7, 64, len(encoded)]:
+        chunks = [encoded[i:i+chunk_size] for i in range(0, len(encoded), chunk_size)]
+        assert list(utils.iter_json_array(chunks)) == document
+    assert list(utils.iter_json_array([b' [ ] '])) == []
+    for invalid_document in [b'{"error": "invalid"}', b'[1, 2', b'[{"a": 1}, {"b"']:
+        try:
+            list(utils.iter_json_array([invalid_document]))
+            assert False, "iter_json_array accepted {!r}".format(invalid_document)
+        except ValueError:
+            pass
+    
+    # iter_chunks test
+    assert list(utils.iter_chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    
+    # check_zip_structure test
+    import io
+    from fake_server import make_osz_payload
+    archive = make_osz_payload(10000)
+    assert utils.check_zip_structure(io.BytesIO(archive))
+    for damaged_archive in [archive[:-1], archive[:len(archive)//2], archive[:100]+archive[101:], b'<html></html>', b'']:
+        assert not utils.check_zip_structure(io.BytesIO(damaged_archive))
+    assert utils.make_file_hasher(io.BytesIO(archive), 100).hexdigest() == hashlib.sha256(archive[:100]).hexdigest()
 
 
 # TODO: make test cases for other modules
+
+
+def test_api_iter_beatmap_pages():
+    from api import osuAPI
+    from config import config
+    from WrappedObjects import Credential
+    
+    # 1234 beatmaps, approved 5 per second, served like the osu api does with approved_date > since.
+    approved_dates = ['2022-04-07 00:{:02d}:{:02d}'.format(*divmod(i//5, 60)) for i in range(1234)]
+    dataset = [{'beatmap_id': i, 'approved_date': approved_date} for i, approved_date in enumerate(approved_dates)]
+    api = osuAPI('', Credential(), config, initialize=False)
+    api.get_beatmaps = lambda params: [entry for entry in dataset if entry['approved_date'] > str(params.get('since', ''))][:params['limit']]
+    
+    pages = list(api.iter_beatmap_pages({}, page_size=500))
+    assert {entry['beatmap_id'] for page in pages for entry in page} == set(range(1234))
+    assert api.get_watermark(pages[-1]) == approved_dates[-1]
+
+
+def test_db_downloaded_index():
+    from DBManager import osuDB
+    
+    db = osuDB(':memory:')
+    db.bulk_flag_as_downloaded(list(range(0, 100, 2)))
+    assert db.check_exists_in_downloaded(2) and not db.check_exists_in_downloaded(3)
+    
+    db.flag_as_downloaded({'beatmapset_id': 3})
+    assert db.check_exists_in_downloaded({'beatmapset_id': 3})
+    assert db.get_missing_beatmapsets(range(10)) == [1, 5, 7, 9]
+    
+    # A fresh index loaded from the database matches the one kept in sync.
+    assert osuDB(':memory:').downloaded_index == set()
+    db._downloaded_index = None
+    assert db.get_missing_beatmapsets(range(10)) == [1, 5, 7, 9]
+
+
+def test_db_compiled_queries():
+    from DBManager import osuDB
+    from DBModels import Beatmap, DownloadedBeatmapset, Field, Model
+    
+    assert Beatmap.make_insert_query(ignore=True) is Beatmap.make_insert_query(ignore=True)
+    assert Beatmap.make_insert_query(ignore=True).startswith("INSERT OR IGNORE INTO beatmaps")
+    assert DownloadedBeatmapset.make_select_by_key_query() == "SELECT * FROM downloaded_beatmapsets WHERE beatmapset_id=?"
+    
+    db = osuDB(':memory:')
+    beatmap = make_test_beatmaps(1)[0]
+    beatmap['title'] = 'Quoted "Title" \'{}\''
+    db.add_beatmap(beatmap)
+    assert [row['beatmap_id'] for row in db.get_beatmaps(Beatmap({'title': beatmap['title'], 'mode': beatmap['mode']}))] == [int(beatmap['beatmap_id'])]
+    
+    db.add_beatmap(dict(beatmap, title='Ignored'), ignore=True)
+    assert db.get_beatmaps(int(beatmap['beatmap_id']))[0]['title'] == beatmap['title']
+    db.add_beatmap(dict(beatmap, title='Upserted'), upsert=True)
+    assert db.get_beatmaps(int(beatmap['beatmap_id']))[0]['title'] == 'Upserted'
+    
+    db.flag_as_downloaded(DownloadedBeatmapset({'beatmapset_id': 7, 'downloaded': True, 'size': 10}))
+    assert db.get_beatmapset_downloaded(7)['size'] == 10 and db.get_beatmapset_downloaded(8) is None
+    db.close()
+    
+    # Defaults are bound like any other value, and quoted as literals in table definitions.
+    class Labelled(Model):
+        __TABLE_NAME__ = 'labelled'
+        FIELDS = [Field('id', int, not_null=True, primary_key=True), Field('label', str, default="it's", not_null=True), Field('flag', bool, default=True, not_null=True)]
+    db = osuDB(':memory:')
+    db.cursor.execute(Labelled.make_query())
+    db.insert(Labelled({'id': 1}))
+    db.cursor.execute("INSERT INTO labelled(id) VALUES (3)")
+    db.cursor.execute("SELECT label, flag FROM labelled WHERE id IN (1, 3)")
+    assert db.cursor.fetchall() == [{'label': "it's", 'flag': 1}]*2
+    db.close()
+
+
+def test_db_full_text_search():
+    import os
+    import tempfile
+    from DBManager import osuDB
+    
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'test.db')
+        db = osuDB(database)
+        beatmaps = make_test_beatmaps(500)
+        db.add_beatmaps(beatmaps)
+        db.add_beatmaps([dict(beatmap, title='Rëplaced Title') for beatmap in beatmaps[:50]], replace=True)
+        db.add_beatmaps([dict(beatmap, artist='Upserted') for beatmap in beatmaps[50:60]], upsert=True)
+        db.write("DELETE FROM beatmaps WHERE beatmap_id % 9 = 0")
+        
+        def check(text):
+            expected = sorted(row['beatmap_id'] for row in db.get_all_beatmaps() if osuDB.match_beatmap_text(text, row))
+            assert sorted(db.search_beatmap_ids(text)) == expected
+            return expected
+        
+        assert len(check('replaced')) == 50-50//9
+        assert check('upsert')
+        assert check('title 1 tag')
+        assert not check('artist nothing')
+        
+        # The index is rebuilt from the beatmaps table when migrating to the version introducing it.
+        db.write('DROP TABLE "{}"'.format(db.FTS_TABLE))
+        db.write("DELETE FROM schema_version WHERE version >= 5")
+        db.close()
+        db = osuDB(database)
+        assert check('title 1 tag')
+        db.close()
+
+
+def test_db_group_commit():
+    import os
+    import tempfile
+    from DBManager import osuDB, MultiThreadedOsuDB
+    
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'test.db')
+        db = MultiThreadedOsuDB(database, batch_size=100, batch_interval=1.0)
+        for beatmapset_id in range(1000):
+            db.flag_as_downloaded(beatmapset_id)
+        db.set_state('key', 'value')
+        
+        # Reads after the barrier see every queued write, from any connection.
+        db.flush()
+        assert len(db.get_all_downloaded_beatmapsets()) == 1000
+        assert db.get_state('key') == 'value'
+        assert not db.cursor_proxy.errors
+        
+        # A flag whose write fails to commit is rolled back from the index, here a plain insert of an existing record.
+        db.record_download_failure(5000)
+        assert not db.check_exists_in_downloaded(5000)
+        db.flag_as_downloaded(5000)
+        assert db.check_exists_in_downloaded(5000)
+        # The writer thread only reports the failure, the index is rolled back on this thread by the next flush.
+        db.cursor_proxy.flush()
+        assert db.check_exists_in_downloaded(5000) and len(db.cursor_proxy.errors) == 1
+        db.flush()
+        assert not db.check_exists_in_downloaded(5000)
+        db.close()
+        reopened_db = osuDB(database)
+        assert len(reopened_db.get_all_downloaded_beatmapsets()) == 1000 and reopened_db.downloaded_index == set(range(1000))
+        reopened_db.close()
+
+
+def test_db_schema_migration():
+    import os
+    import sqlite3
+    import tempfile
+    from DBManager import osuDB
+    
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'test.db')
+        connection = sqlite3.connect(database)
+        connection.execute('CREATE TABLE "downloaded_beatmapsets"(beatmapset_id INTEGER NOT NULL PRIMARY KEY UNIQUE)')
+        connection.execute('INSERT INTO "downloaded_beatmapsets" VALUES (1)')
+        connection.commit()
+        connection.close()
+        
+        db = osuDB(database, profile={'journal_mode': 'WAL', 'synchronous': 'NORMAL'})
+        assert db.get_schema_version() == db.SCHEMA_VERSION
+        db.cursor.execute("PRAGMA table_info(downloaded_beatmapsets)")
+        assert [column['name'] for column in db.cursor.fetchall()] == [field.name for field in db.TABLES['downloaded'].FIELDS]
+        assert db.get_beatmapset_downloaded(1)['verified'] == 0
+        db.cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='beatmaps' AND name LIKE 'ix_%'")
+        assert len(db.cursor.fetchall()) == len(db.TABLES['beatmaps'].indexes)
+        db.cursor.execute("PRAGMA journal_mode")
+        assert db.cursor.fetchone()['journal_mode'] == 'wal'
+        db.close()
+
+
+def make_test_beatmaps(count: int, beatmaps_per_set: int = 4):
+    """Builds api-like beatmaps (every value a string) with varied filterable fields."""
+    from DBModels import Beatmap
+    
+    beatmaps = []
+    for beatmap_id in range(1, count+1):
+        beatmapset_id = (beatmap_id-1)//beatmaps_per_set+1
+        beatmap = {field.name: '0' for field in Beatmap.FIELDS}
+        beatmap.update({'beatmap_id': str(beatmap_id), 'beatmapset_id': str(beatmapset_id), 'approved': str(beatmapset_id%7-2),
+                        'mode': str(beatmapset_id%4), 'difficultyrating': str(round(beatmap_id%9+beatmap_id%7/7, 4)),
+                        'favourite_count': str(beatmapset_id*37%500), 'rating': str(round(beatmapset_id%10+beatmapset_id%3/3, 4)),
+                        'approved_date': '20{:02d}-01-01 00:00:00'.format(10+beatmapset_id%12), 'version': 'Diff {}'.format(beatmap_id),
+                        'artist': 'Artist {}'.format(beatmapset_id%50), 'title': 'Title {}'.format(beatmapset_id), 'creator': 'Mapper {}'.format(beatmapset_id%30),
+                        'tags': 'tag{} tag{}'.format(beatmapset_id%5, beatmapset_id%11), 'total_length': str(60+beatmapset_id%240), 'video': str(beatmapset_id%2)})
+        beatmaps.append(beatmap)
+    return beatmaps
+
+
+def test_interface_sql_filters():
+    import os
+    import tempfile
+    from config import config
+    from interface import Interface
+    from WrappedObjects import Config, Credential
+    from utils import remove_duplicate_in_list
+    
+    with tempfile.TemporaryDirectory() as directory:
+        interface = Interface(Config(config, database=os.path.join(directory, 'test.db')), '', Credential())
+        interface.db._init()
+        interface.db.add_beatmaps(make_test_beatmaps(2000))
+        interface.db.flush()
+        
+        for args in [[], ['-q', '1', '-q', '4'], ['--diff', '2.5-6'], ['-f', '100', '-r', '5.5'], ['-m', '2', '-s', '2016-01-01', '--diff', '4'], ['-t', 'artist 1'], ['-t', 'tag3 TITLE', '-q', '1'], ['-t', 'ti"tle* OR']]:
+            interface.params, interface.filters, interface.filter_specs = {}, {}, []
+            interface.parsed_args = vars(interface.make_parser().parse_args(args))
+            interface.process_args()
+            
+            expected = [beatmap for beatmap in interface.db.get_all_beatmaps() if interface.filter_beatmap(beatmap)]
+            if 'm' in interface.params:
+                expected = [beatmap for beatmap in expected if beatmap['mode'] == int(interface.params['m'])]
+            if 'since' in interface.params:
+                expected = [beatmap for beatmap in expected if beatmap['approved_date'] > str(interface.params['since'])]
+            expected = remove_duplicate_in_list(expected, 'beatmapset_id', lambda beatmap: beatmap['beatmap_id'])
+            assert sorted(interface.db.get_beatmapsets_where(interface.make_sql_filters()), key=lambda beatmap: beatmap['beatmap_id']) == sorted(expected, key=lambda beatmap: beatmap['beatmap_id'])
+        interface.db.close()
+
+
+def test_columnar_snapshot():
+    import os
+    import tempfile
+    import columnar
+    from config import config
+    from interface import Interface
+    from WrappedObjects import Config, Credential
+    
+    if not columnar.is_available():
+        return
+    
+    with tempfile.TemporaryDirectory() as directory:
+        interface = Interface(Config(config, database=os.path.join(directory, 'test.db')), '', Credential())
+        interface.db._init()
+        interface.db.add_beatmaps(make_test_beatmaps(2000))
+        interface.db.flush()
+        snapshot = columnar.ColumnarSnapshot(interface.db, os.path.join(directory, 'snapshot')).refresh()
+        assert len(snapshot) == 2000
+        
+        def check(args):
+            interface.params, interface.filters, interface.filter_specs = {}, {}, []
+            interface.parsed_args = vars(interface.make_parser().parse_args(args))
+            interface.process_args()
+            expected = sorted(beatmap['beatmap_id'] for beatmap in interface.db.get_beatmapsets_where(interface.make_sql_filters()))
+            assert sorted(snapshot.refresh().select_beatmapsets(interface.make_filter_specs())) == expected
+        
+        args_list = [[], ['-q', '1', '-q', '4'], ['--diff', '2.5-6'], ['-f', '100', '-r', '5.5'], ['-m', '2', '-s', '2016-01-01', '--diff', '4'], ['-t', 'artist 1'], ['-t', 'tag3 TITLE', '-q', '1'], ['-t', 'ti"tle* OR']]
+        for args in args_list:
+            check(args)
+        
+        # Inserted, updated and deleted beatmaps are picked up by an incremental refresh, also by a snapshot loaded from disk.
+        beatmaps = make_test_beatmaps(2400)
+        interface.db.add_beatmaps(beatmaps[2000:], replace=True)
+        for beatmap in beatmaps[:100]:
+            beatmap['approved'], beatmap['favourite_count'] = '4', '1000'
+        interface.db.add_beatmaps(beatmaps[:100], replace=True)
+        interface.db.write("DELETE FROM beatmaps WHERE beatmap_id % 7 = 0")
+        interface.db.flush()
+        snapshot = columnar.ColumnarSnapshot(interface.db, os.path.join(directory, 'snapshot'))
+        for args in args_list:
+            check(args)
+        interface.db.cursor.execute("SELECT COUNT(*) AS count FROM beatmaps")
+        assert len(snapshot) == interface.db.cursor.fetchone()['count']
+        interface.db.close()
+
+
+def test_ndjson_export_import():
+    import os
+    import tempfile
+    from DBManager import osuDB, MultiThreadedOsuDB
+    from utils import dump_ndjson, iter_ndjson
+    
+    with tempfile.TemporaryDirectory() as directory:
+        db = osuDB(os.path.join(directory, 'source.db'))
+        db.add_beatmaps(make_test_beatmaps(2000))
+        rows = db.get_all_beatmaps()
+        for extension in ['.ndjson', '.ndjson.gz', '.ndjson.bz2', '.ndjson.xz']:
+            filename = os.path.join(directory, 'beatmaps'+extension)
+            assert dump_ndjson(db.iter_beatmaps(batch_size=300), filename) == 2000
+            assert sorted(iter_ndjson(filename), key=lambda row: row['beatmap_id']) == sorted(rows, key=lambda row: row['beatmap_id'])
+        
+        target = osuDB(os.path.join(directory, 'target.db'))
+        changed = [dict(row, title='Changed') for row in rows[:10]]
+        target.add_beatmaps(changed)
+        assert target.import_beatmaps(iter_ndjson(filename), batch_size=300, ignore=True) == 2000
+        assert sorted(target.get_all_beatmaps(), key=lambda row: row['beatmap_id']) == sorted(changed+rows[10:], key=lambda row: row['beatmap_id'])
+        target.import_beatmaps(iter_ndjson(filename), batch_size=300, replace=True)
+        assert sorted(target.get_all_beatmaps(), key=lambda row: row['beatmap_id']) == sorted(rows, key=lambda row: row['beatmap_id'])
+        db.close()
+        target.close()
+        
+        # Through the group committing writer, the rows waiting for it stay within its queue size while the import outpaces it.
+        threaded_target = MultiThreadedOsuDB(os.path.join(directory, 'threaded.db'), batch_size=500, batch_interval=0.2, max_queue_size=1000)
+        queued_rows = []
+        def iter_rows():
+            for row in iter_ndjson(filename):
+                queued_rows.append(threaded_target.cursor_proxy.queued_rows)
+                yield row
+        assert threaded_target.import_beatmaps(iter_rows(), batch_size=300) == 2000
+        threaded_target.flush()
+        assert 0 < max(queued_rows) <= 1000 and threaded_target.cursor_proxy.queued_rows == 0
+        assert len(threaded_target.get_all_beatmaps()) == 2000
+        threaded_target.close()
+
+
+def test_wrapped_beatmap_record():
+    from DBManager import osuDB
+    from WrappedObjects import Beatmap
+    from constants import Url
+    from config import config
+    
+    entry = make_test_beatmaps(1)[0]
+    entry.update({'diff_overall': '8.5', 'approved_date': None, 'unknown_field': 'kept'})
+    beatmap = Beatmap(entry)
+    assert beatmap.beatmap_id == 1 and beatmap['diff_overall'] == 8.5 and beatmap.video is True and beatmap['approved_date'] is None
+    assert beatmap['unknown_field'] == 'kept' and 'max_combo' in beatmap and 'not_a_field' not in beatmap
+    assert Url.formattable_beatmapset.format(beatmap).endswith('/beatmapsets/1')
+    assert config.formattable_beatmap_filename.format(beatmap) == '1 Artist 1 - Title 1'
+    
+    db = osuDB(':memory:')
+    db.add_beatmap(beatmap)
+    row = db.get_all_beatmaps()[0]
+    assert Beatmap(row) == Beatmap({key: value for key, value in beatmap.items() if key != 'unknown_field'})
+
+
+def test_progress_reporters():
+    import io
+    from progress import make_progress_reporter, ProgressReporter, BarProgressReporter, AggregateProgressReporter
+    
+    assert type(make_progress_reporter('auto', pipe=io.StringIO())) is ProgressReporter
+    assert isinstance(make_progress_reporter('bar', concurrent=True, pipe=io.StringIO()), AggregateProgressReporter)
+    
+    # Updates are throttled to one draw per refresh interval, however many chunks arrive.
+    for reporter in [BarProgressReporter(io.StringIO(), refresh_interval=60), AggregateProgressReporter(io.StringIO(), refresh_interval=60)]:
+        reporter.start(1, 10000)
+        for position in range(10000):
+            reporter.update(1, position+1)
+        reporter.finish(1)
+        assert reporter.pipe.getvalue().count('%' if isinstance(reporter, BarProgressReporter) else 'active') <= 2
+
+
+def test_ratelimit():
+    import time
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    from ratelimit import TokenBucket, RateLimiter, backoff_delay, get_retry_after
+    
+    # 5 tokens are available at once, the other 20 arrive at 100 per second, however many threads share the bucket.
+    bucket = TokenBucket(rate=100, burst=5)
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda _: bucket.acquire(), range(25)))
+    assert 0.18 <= time.monotonic()-start_time < 0.5
+    
+    bucket.pause(0.1)
+    assert bucket.reserve() >= 0.09
+    assert RateLimiter({'api': (1, 1)}).acquire('unknown') == 0.0
+    assert all(0 <= backoff_delay(attempt, 1.0, 8.0) <= 8.0 for attempt in range(10))
+    
+    resp = requests.Response()
+    assert get_retry_after(resp) is None
+    resp.headers['Retry-After'] = '3'
+    assert get_retry_after(resp) == 3.0
+    resp.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    assert get_retry_after(resp) == 0.0
+
+
+def test_response_cache():
+    import os
+    import tempfile
+    import requests
+    from cache import ResponseCache
+    
+    def make_response(body: bytes):
+        resp = requests.Response()
+        resp.status_code, resp._content, resp._content_consumed = 200, body, True
+        resp.headers['Content-Type'] = 'application/json; charset=utf-8'
+        return resp
+    
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResponseCache(os.path.join(directory, 'cache.db'), ttls={'get_beatmaps': 60}, max_size=250)
+        cache.put('https://osu.ppy.sh/api/get_beatmaps', {'since': '2022-01-01', 'k': 'secret'}, make_response(b'[{"a": 1}]'))
+        # The api key is not part of the key, and param order does not matter.
+        resp = cache.get('https://osu.ppy.sh/api/get_beatmaps', {'k': 'other', 'since': '2022-01-01'})
+        assert resp.json() == [{'a': 1}] and list(resp.iter_content(2))[0] == b'[{' and resp.from_cache
+        assert cache.get('https://osu.ppy.sh/api/get_beatmaps', {'since': '2022-01-02'}) is None
+        
+        # Endpoints without a ttl are not cached.
+        cache.put('https://osu.ppy.sh/api/get_user', {'u': '1'}, make_response(b'[]'))
+        assert cache.get('https://osu.ppy.sh/api/get_user', {'u': '1'}) is None
+        
+        # Least recently used entries are evicted first.
+        for i in range(3):
+            cache.put('https://osu.ppy.sh/api/get_beatmaps', {'page': i}, make_response(b'x'*100))
+            cache.get('https://osu.ppy.sh/api/get_beatmaps', {'since': '2022-01-01'})
+        assert cache.size <= 250
+        assert cache.get('https://osu.ppy.sh/api/get_beatmaps', {'page': 0}) is None
+        assert cache.get('https://osu.ppy.sh/api/get_beatmaps', {'since': '2022-01-01'}) is not None
+        cache.close()
+        
+        # Streamed responses are stored once read to the end, unless they are larger than max_entry_size.
+        cache = ResponseCache(os.path.join(directory, 'tee.db'), ttls={'get_beatmaps': 60}, max_size=250, max_entry_size=20)
+        chunks = cache.tee('https://osu.ppy.sh/api/get_beatmaps', {'page': 0}, make_response(b'[1, 2, 3]')).iter_content(4)
+        assert next(chunks) == b'[1, ' and cache.get('https://osu.ppy.sh/api/get_beatmaps', {'page': 0}) is None
+        assert b''.join(chunks) == b'2, 3]' and cache.get('https://osu.ppy.sh/api/get_beatmaps', {'page': 0}).content == b'[1, 2, 3]'
+        assert b''.join(cache.tee('https://osu.ppy.sh/api/get_beatmaps', {'page': 1}, make_response(b'x'*30)).iter_content(4)) == b'x'*30
+        assert cache.get('https://osu.ppy.sh/api/get_beatmaps', {'page': 1}) is None
+        cache.close()
+
+
+def test_api_session_persistence():
+    import os
+    import stat
+    import tempfile
+    from api import osuAPI
+    from config import config
+    from utils import CSRF_TOKEN_REGEX
+    from WrappedObjects import Config, Credential
+    
+    with tempfile.TemporaryDirectory() as directory:
+        session_config = Config(config, session_file=os.path.join(directory, 'session.json'))
+        api = osuAPI('', Credential(username='user', password='pass'), session_config, initialize=False)
+        api.session.cookies.set('osu_session', 'abc', domain='osu.ppy.sh', path='/', expires=None)
+        api.save_session()
+        if os.name == 'posix':
+            assert stat.S_IMODE(os.stat(session_config.session_file).st_mode) == 0o600
+        
+        restored_api = osuAPI('', Credential(username='user', password='pass'), session_config, initialize=False)
+        assert restored_api.load_session() and restored_api.session.cookies.get('osu_session') == 'abc'
+        assert not osuAPI('', Credential(username='other'), session_config, initialize=False).load_session()
+    
+    homepage = '<html><head><meta charset="utf-8">\n<meta name="csrf-token" content="t0k3n">\n</head>'
+    assert CSRF_TOKEN_REGEX.search(homepage).group(1) == 't0k3n'
+
+
+def test_api_against_fake_server():
+    import os
+    import gzip
+    import hashlib
+    import zipfile
+    import tempfile
+    import requests
+    from api import osuAPI
+    from bench import make_bench_config
+    from fake_server import FakeOsuServer, make_fake_beatmaps
+    from WrappedObjects import Credential
+    
+    with tempfile.TemporaryDirectory() as directory, FakeOsuServer(make_fake_beatmaps(40), payload_size=20000, rate_limit_every=3) as server:
+        api = osuAPI('key', Credential(username='user', password='pass'), make_bench_config(directory, server.base_url, use_cache=False, retry_backoff_base=0.01))
+        assert api._logged_in
+        beatmaps = api.get_beatmaps({'limit': 8})
+        assert [beatmap['beatmap_id'] for beatmap in beatmaps] == list(range(1, 9))
+        downloaded = api.download_to_file(beatmaps[0])
+        assert downloaded.verified and downloaded.size == len(server.get_payload(1))
+        assert downloaded.sha256 == hashlib.sha256(server.get_payload(1)).hexdigest()
+        filepath = os.path.join(api.config.download_dir, os.listdir(api.config.download_dir)[0])
+        assert zipfile.is_zipfile(filepath) and os.path.getsize(filepath) == len(server.get_payload(1))
+        assert server.stats['rate_limited'] > 0
+        
+        # Downloads ask for the body as is, a server gzipping it for clients accepting gzip sends the bytes Content-Length counts.
+        gzipped = []
+        def route_gzip(handler, path):
+            if 'gzip' not in handler.headers.get('Accept-Encoding', ''):
+                return handler.route_download(path)
+            gzipped.append(path)
+            handler.send_body(200, gzip.compress(server.get_payload(2)), 'application/octet-stream', headers={'Content-Encoding': 'gzip'})
+        server.routes.insert(0, ('/beatmapsets/2/', route_gzip))
+        session = requests.Session() # Accepts gzip by default
+        session.cookies.update(api.session.cookies)
+        downloaded = api.download_to_file(beatmaps[4], session=session)
+        assert downloaded.verified and downloaded.sha256 == hashlib.sha256(server.get_payload(2)).hexdigest() and not gzipped
+
+
+def test_dry_run_cache_against_fake_server():
+    import tempfile
+    from bench import make_bench_config, silenced_stdout
+    from fake_server import FakeOsuServer, make_fake_beatmaps
+    from interface import Interface
+    from WrappedObjects import Credential
+    
+    # The streamed get_beatmaps response of the first dry run is cached, the second one does not use the api.
+    with tempfile.TemporaryDirectory() as directory, FakeOsuServer(make_fake_beatmaps(200)) as server:
+        for run in range(2):
+            interface = Interface(make_bench_config(directory, server.base_url), 'key', Credential(username='user', password='pass'))
+            assert interface.config.use_cache and interface.config.stream_api_responses
+            with silenced_stdout():
+                interface.start(['download', '--dry-run', '-l', '50'])
+            interface.db.close()
+            assert server.stats['paths']['/api/get_beatmaps'] == 1
+
+
+def test_download_resume_against_fake_server():
+    import os
+    import time
+    import tempfile
+    from api import osuAPI
+    from bench import make_bench_config
+    from constants import TEMPORARY_FILE_SUFFIX
+    from fake_server import FakeOsuServer, make_fake_beatmaps
+    from WrappedObjects import Beatmap, Credential
+    
+    beatmaps = [Beatmap(beatmap) for beatmap in make_fake_beatmaps(40)[::4]]
+    with tempfile.TemporaryDirectory() as directory, FakeOsuServer(payload_size=20000) as server:
+        api = osuAPI('key', Credential(username='user', password='pass'), make_bench_config(directory, server.base_url, use_cache=False))
+        payload = server.get_payload(1)
+        def write_partial(beatmap, data: bytes):
+            filepath = os.path.join(api.config.download_dir, '{0[beatmapset_id]} {0[artist]} - {0[title]}.osz'.format(beatmap)+TEMPORARY_FILE_SUFFIX)
+            with open(filepath, 'wb') as file:
+                file.write(data)
+            return os.path.basename(filepath)
+        def download_sent(beatmap):
+            bytes_sent = server.stats['bytes_sent']
+            assert api.download_to_file(beatmap)
+            with open(os.path.join(api.config.download_dir, '{0[beatmapset_id]} {0[artist]} - {0[title]}.osz'.format(beatmap)), 'rb') as file:
+                assert file.read() == payload
+            return server.stats['bytes_sent']-bytes_sent
+        
+        # 206: only the missing bytes are sent and appended.
+        write_partial(beatmaps[0], payload[:5000])
+        assert download_sent(beatmaps[0]) == len(payload)-5000
+        # 200: a server ignoring the range sends everything, rewritten from the start.
+        server.support_range = False
+        write_partial(beatmaps[1], b'x'*5000)
+        assert download_sent(beatmaps[1]) == len(payload)
+        server.support_range = True
+        # 416: a partial file longer than the beatmapset is truncated and downloaded again.
+        write_partial(beatmaps[2], payload+b'x')
+        assert download_sent(beatmaps[2]) == len(payload) and server.stats['paths']['/beatmapsets/3/download'] == 2
+        # 206 from another position than requested: restarted rather than spliced.
+        def route_misplaced(handler, path):
+            if handler.headers.get('Range'):
+                return handler.send_body(206, payload[1000:], headers={'Content-Range': 'bytes 1000-{0}/{1}'.format(len(payload)-1, len(payload))})
+            handler.send_body(200, payload)
+        server.routes.insert(0, ('/beatmapsets/4/', route_misplaced))
+        write_partial(beatmaps[3], payload[:5000])
+        assert download_sent(beatmaps[3]) == 2*len(payload)-1000
+        
+        # Partial downloads left by earlier runs: empty, completed and expired ones are removed, the others kept.
+        empty, completed, resumable = write_partial(beatmaps[4], b''), write_partial(beatmaps[0], payload[:100]), write_partial(beatmaps[5], payload[:100])
+        expired = write_partial(beatmaps[6], payload[:100])
+        os.utime(os.path.join(api.config.download_dir, expired), (time.time()-api.config.partial_download_max_age-60,)*2)
+        resolved = api.resolve_partial_downloads()
+        assert resolved['resumable'] == [resumable] and sorted(resolved['removed']) == sorted([empty, completed, expired])
+
+
+def test_concurrent_downloader_against_fake_server():
+    import time
+    import tempfile
+    from api import osuAPI
+    from bench import make_bench_config
+    from downloader import ConcurrentDownloader
+    from DBManager import osuDB
+    from fake_server import FakeOsuServer, make_fake_beatmaps
+    from WrappedObjects import Beatmap, Credential
+    
+    beatmaps = [Beatmap(beatmap) for beatmap in make_fake_beatmaps(28)[::4]]
+    # A beatmapset the server fails, one failing before its request and one with a malformed Content-Length, none stops the others.
+    beatmaps[3] = {key: value for key, value in beatmaps[3].items() if key != 'artist'}
+    def route_malformed(handler, path):
+        handler.send_response(200)
+        handler.send_header('Content-Length', 'unknown')
+        handler.end_headers()
+        handler.close_connection = True
+    with tempfile.TemporaryDirectory() as directory, FakeOsuServer(payload_size=20000, latency=0.2) as server:
+        server.routes.insert(0, ('/beatmapsets/2/', lambda handler, path: handler.send_body(503, b'Unavailable', 'text/plain')))
+        server.routes.insert(0, ('/beatmapsets/7/', route_malformed))
+        api = osuAPI('key', Credential(username='user', password='pass'), make_bench_config(directory, server.base_url, use_cache=False, max_retries=0))
+        db = osuDB(':memory:')
+        start = time.perf_counter()
+        downloader = ConcurrentDownloader(api, workers=3)
+        results = list(downloader.download_all(beatmaps))
+        assert time.perf_counter()-start < 0.2*len(beatmaps)
+        for beatmap, downloaded in results:
+            if downloaded:
+                db.flag_as_downloaded(beatmap)
+        
+        assert len(results) == len(beatmaps) and not downloader._sessions
+        assert {str(beatmap['beatmapset_id']) for beatmap, downloaded in results if not downloaded} == {'2', '4', '7'}
+        assert db.downloaded_index == {1, 3, 5, 6}
+
+
+def test_bench_compare_results():
+    from bench import compare_results, result
+    baseline = {'commit': 'a', 'options': {'latency': 0.005, 'rate_limit_every': 0}, 'results': {'downloader.w8.beatmapsets_per_second': result(100.0, 'beatmapsets/s')}}
+    current = {'commit': 'b', 'options': {'latency': 0.005, 'rate_limit_every': 10}, 'results': {'downloader.w8.beatmapsets_per_second': result(80.0, 'beatmapsets/s')}}
+    lines, regressions = compare_results(baseline, current)
+    assert regressions == 1
+    assert any('rate_limit_every' in line for line in lines) and not any('latency' in line for line in lines)
+
+
+def test_download_sources_against_fake_servers():
+    import time
+    import tempfile
+    from api import osuAPI
+    from bench import make_bench_config
+    from fake_server import FakeOsuServer, make_fake_beatmaps
+    from WrappedObjects import Beatmap, Credential
+    
+    beatmaps = [Beatmap(beatmap) for beatmap in make_fake_beatmaps(40)]
+    with tempfile.TemporaryDirectory() as directory, FakeOsuServer(beatmaps, payload_size=20000) as official, \
+         FakeOsuServer(beatmaps, payload_size=20000, require_login=False) as mirror:
+        config = make_bench_config(directory, official.base_url, use_cache=False, download_mirrors=[mirror.base_url+'/d/{0[beatmapset_id]}'], download_hedge_delay=0.2)
+        api = osuAPI('key', Credential(username='user', password='pass'), config)
+        official_source, mirror_source = api.sources.sources
+        
+        # Fails over on a 5xx, and ranks the failing source last afterwards.
+        official.download_status = 503
+        downloaded = api.download_to_file(beatmaps[0])
+        assert downloaded.verified and downloaded.size == len(mirror.get_payload(1))
+        assert official_source.consecutive_failures == 1 and api.sources.rank(beatmaps[4])[0] is mirror_source
+        
+        # A stalled source is hedged with the next one, which finishes first.
+        official.download_status, official_source.consecutive_failures = None, 0
+        mirror_source.first_byte_seconds, official.latency = 10.0, 2.0
+        assert api.sources.rank(beatmaps[4])[0] is official_source
+        start = time.perf_counter()
+        assert api.download_to_file(beatmaps[4]).verified
+        assert time.perf_counter()-start < 1.5 and mirror.stats['paths']['/d/2'] == 1
+        
+        # Beatmapsets osu! marks as unavailable only go to the mirrors.
+        official.latency = 0.0
+        assert api.download_to_file(Beatmap(beatmaps[8], download_unavailable='1')).verified
+        assert '/beatmapsets/3/download' not in official.stats['paths'] and mirror.stats['paths']['/d/3'] == 1
+
+
+def test_download_write_path_against_fake_server():
+    import os
+    import hashlib
+    import tempfile
+    from api import osuAPI
+    from bench import make_bench_config
+    from constants import TEMPORARY_FILE_SUFFIX
+    from fake_server import FakeOsuServer, make_fake_beatmaps
+    from progress import ProgressReporter
+    from WrappedObjects import Beatmap, Credential
+    
+    beatmaps = [Beatmap(beatmap) for beatmap in make_fake_beatmaps(40)]
+    with tempfile.TemporaryDirectory() as directory, FakeOsuServer(beatmaps, payload_size=300000, drop_downloads_after=100000) as server:
+        api = osuAPI('key', Credential(username='user', password='pass'), make_bench_config(directory, server.base_url, use_cache=False))
+        payload = server.get_payload(1)
+        
+        # A connection closed early leaves the received prefix, not the preallocated size, and the prefix is resumed.
+        assert api.download_to_file(beatmaps[0]) is None
+        partial = [entry for entry in os.scandir(api.config.download_dir) if entry.name.endswith(TEMPORARY_FILE_SUFFIX)]
+        assert len(partial) == 1 and partial[0].stat().st_size == 100000
+        server.drop_downloads_after = None
+        downloaded = api.download_to_file(beatmaps[0])
+        assert downloaded.verified and downloaded.size == len(payload) and downloaded.sha256 == hashlib.sha256(payload).hexdigest()
+        assert server.stats['paths']['/beatmapsets/1/download'] == 2
+        
+        # Interrupted, e.g. by a Ctrl-C, the preallocated bytes past the prefix are dropped all the same.
+        class InterruptingReporter(ProgressReporter):
+            def update(self, key, current):
+                if current >= 100000:
+                    raise KeyboardInterrupt
+        try:
+            api.download_to_file(beatmaps[4], reporter=InterruptingReporter())
+            assert False
+        except KeyboardInterrupt:
+            pass
+        partial_filepath = os.path.join(api.config.download_dir, '{0[beatmapset_id]} {0[artist]} - {0[title]}.osz'.format(beatmaps[4])+TEMPORARY_FILE_SUFFIX)
+        partial_size = os.path.getsize(partial_filepath)
+        assert 100000 <= partial_size < len(payload)
+        bytes_sent = server.stats['bytes_sent']
+        assert api.download_to_file(beatmaps[4]).sha256 == hashlib.sha256(payload).hexdigest()
+        assert server.stats['bytes_sent']-bytes_sent == len(payload)-partial_size
+        # Killed, the zeros left in the preallocated part are trimmed before resuming.
+        with open(partial_filepath, 'wb') as file:
+            file.write(payload[:5000].rstrip(b'\0')+bytes(len(payload)-5000))
+        bytes_sent = server.stats['bytes_sent']
+        assert api.download_to_file(beatmaps[4]).sha256 == hashlib.sha256(payload).hexdigest()
+        assert server.stats['bytes_sent']-bytes_sent == len(payload)-len(payload[:5000].rstrip(b'\0'))
+        
+        # Straight to the final filename with a large buffer, a failed download leaves nothing behind.
+        api.config.download_direct_to_file, api.config.download_buffer_size = True, 4*1024*1024
+        downloaded = api.download_to_file(beatmaps[4])
+        assert downloaded.verified and downloaded.sha256 == hashlib.sha256(payload).hexdigest()
+        server.drop_downloads_after = 100000
+        assert api.download_to_file(beatmaps[8]) is None
+        server.drop_downloads_after = None
+        try:
+            api.download_to_file(beatmaps[12], reporter=InterruptingReporter())
+            assert False
+        except KeyboardInterrupt:
+            pass
+        assert sorted(os.listdir(api.config.download_dir)) == sorted('{0[beatmapset_id]} {0[artist]} - {0[title]}.osz'.format(beatmap) for beatmap in beatmaps[:8:4])
+
+
+def test_backfill_against_fake_server():
+    import os
+    import tempfile
+    from datetime import datetime
+    from backfill import Backfill, make_shards
+    from bench import make_bench_config
+    from DBManager import MultiThreadedOsuDB
+    from fake_server import FakeOsuServer, make_fake_beatmaps
+    from interface import Interface
+    from WrappedObjects import Credential
+    
+    assert make_shards(datetime(2010, 1, 1), datetime(2010, 1, 5), 4)[1] == ('2010-01-02 00:00:00', '2010-01-03 00:00:00')
+    beatmaps = make_fake_beatmaps(2000)
+    since, until = datetime(2010, 1, 5), datetime(2010, 2, 15)
+    expected = sorted(int(beatmap['beatmap_id']) for beatmap in beatmaps if since.strftime('%Y-%m-%d %H:%M:%S') < beatmap['approved_date'] <= until.strftime('%Y-%m-%d %H:%M:%S'))
+    with tempfile.TemporaryDirectory() as directory, FakeOsuServer(beatmaps) as server:
+        config = make_bench_config(directory, server.base_url)
+        config.rate_limits = {'api': (1000.0, 8)}
+        db = MultiThreadedOsuDB(config.database)
+        backfill = Backfill(db, 'key', Credential(), config, {}, shards=5, processes=2)
+        assert backfill.make_worker_config().rate_limits == {'api': (500.0, 4)}
+        assert backfill.run(since, until) == {'done': [0, 1, 2, 3, 4], 'failed': []}
+        assert sorted(row['beatmap_id'] for row in db.get_all_beatmaps()) == expected
+        
+        # A shard killed halfway resumes from its checkpoint, done shards are not fetched again.
+        checkpoint = db.get_backfill_checkpoints(backfill.make_job(since, until))[2]
+        db.write("UPDATE backfill_checkpoints SET done=0, checkpoint=? WHERE shard_key=?", ('2010-01-22 00:00:00', checkpoint['shard_key']))
+        db.write("DELETE FROM beatmaps WHERE approved_date > ? AND approved_date <= ?", ('2010-01-22 00:00:00', checkpoint['until']))
+        requests_before = server.stats['requests']
+        assert Backfill(db, 'key', Credential(), config, {}, shards=5, processes=2).run(since, until)['done'] == [0, 1, 2, 3, 4]
+        assert server.stats['requests'] == requests_before+1
+        assert sorted(row['beatmap_id'] for row in db.get_all_beatmaps()) == expected
+        db.close()
+        
+        interface = Interface(config, 'key', Credential())
+        namespace = interface.make_parser().parse_args(['backfill', '--shards', '8'])
+        assert (namespace.config_backfill_shards, namespace.config_backfill_processes) == (8, config.backfill_processes)
+        interface.db.close()
+
+
+def test_metrics():
+    import os
+    import json
+    import tempfile
+    from metrics import Metrics
+    
+    metrics = Metrics()
+    metrics.increment('api_requests_total', endpoint='get_beatmaps', status=200)
+    metrics.increment('api_requests_total', 2, endpoint='get_beatmaps', status=200)
+    metrics.set_gauge('db_write_queue_depth', 7)
+    with metrics.time('filter_seconds'):
+        pass
+    metrics.observe('filter_seconds', 2.0)
+    
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['api_requests_total'] == [{'labels': {'endpoint': 'get_beatmaps', 'status': '200'}, 'value': 3}]
+    assert snapshot['timers']['filter_seconds'][0]['count'] == 2 and snapshot['timers']['filter_seconds'][0]['max'] == 2.0
+    prometheus = metrics.to_prometheus(snapshot)
+    assert 'api_requests_total{endpoint="get_beatmaps",status="200"} 3' in prometheus
+    assert 'db_write_queue_depth 7' in prometheus and 'filter_seconds_count 2' in prometheus
+    
+    with tempfile.TemporaryDirectory() as directory:
+        metrics.write(os.path.join(directory, 'metrics.json'))
+        metrics.write(os.path.join(directory, 'metrics.prom'))
+        with open(os.path.join(directory, 'metrics.json')) as file:
+            assert json.load(file)['gauges']['db_write_queue_depth'][0]['value'] == 7
+        with open(os.path.join(directory, 'metrics.prom')) as file:
+            assert file.read() == prometheus
+
+
+def test_directory_indexer():
+    import os
+    import tempfile
+    from DBManager import osuDB
+    from indexer import DirectoryIndexer, make_filename_regex
+    
+    regex = make_filename_regex("{0[beatmapset_id]} {0[artist]} - {0[title]}")
+    assert regex.match("123 Some: Artist - Title.osz".replace(':', '')).group('beatmapset_id') == '123'
+    assert regex.match("Artist - Title.osz") is None
+    assert make_filename_regex("{0[title]} [{0[beatmapset_id]}]").match("A [b] [42].osz").group('beatmapset_id') == '42'
+    
+    with tempfile.TemporaryDirectory() as directory:
+        download_dir = os.path.join(directory, 'Downloads')
+        os.makedirs(download_dir)
+        for filename in ['1 A - B.osz', '2 C - D.osz', 'notes.osz', '3 E - F.osz.beatmaptmp']:
+            with open(os.path.join(download_dir, filename), 'wb') as file:
+                file.write(b'PK')
+        db = osuDB(os.path.join(directory, 'test.db'))
+        db.bulk_flag_as_downloaded([2, 5])
+        indexer = DirectoryIndexer(db, download_dir, "{0[beatmapset_id]} {0[artist]} - {0[title]}")
+        
+        reconciled = indexer.reconcile()
+        assert reconciled == {'flagged': [1], 'missing': [5], 'unflagged': [], 'unrecognized': ['notes.osz']}
+        assert db.downloaded_index == {1, 2, 5}
+        assert db.get_beatmapset_downloaded(1)['size'] == 2
+        
+        os.remove(os.path.join(download_dir, '2 C - D.osz'))
+        # osu! deletes the files it imports, missing files are only unflagged when asked to.
+        assert indexer.reconcile()['missing'] == [2, 5] and db.downloaded_index == {1, 2, 5}
+        assert indexer.reconcile(unflag_missing=True)['unflagged'] == [2, 5] and db.downloaded_index == {1}
+        assert sorted(db.get_directory_entries()) == ['1 A - B.osz', 'notes.osz']
+        db.close()
+
+
+def test_download_planner():
+    import os
+    import tempfile
+    from DBManager import osuDB
+    from planner import DownloadPlanner
+    from WrappedObjects import Beatmap
+    
+    with tempfile.TemporaryDirectory() as directory:
+        db = osuDB(os.path.join(directory, 'test.db'))
+        beatmaps = [Beatmap(beatmap) for beatmap in make_test_beatmaps(40)]
+        db.bulk_flag_as_downloaded([1, 2])
+        db.record_download_failure(3)
+        db.record_download_failure(3)
+        assert db.get_download_failures() == {3: 2}
+        
+        plan = DownloadPlanner(db, ['failed-last', 'newest']).make_plan(beatmaps)
+        assert plan.skipped == 2 and len(plan) == 8
+        assert [beatmap['beatmapset_id'] for beatmap in plan] == [10, 9, 8, 7, 6, 5, 4, 3]
+        assert all(beatmap['beatmap_id'] == beatmap['beatmapset_id']*4 for beatmap in plan)
+        assert plan.estimated_bytes == sum(plan.estimated_sizes.values()) > 0
+        
+        smallest = DownloadPlanner(db, ['smallest']).make_plan(beatmaps)
+        sizes = [smallest.estimated_sizes[beatmap['beatmapset_id']] for beatmap in smallest]
+        assert sizes == sorted(sizes)
+        try:
+            DownloadPlanner(db, ['largest'])
+            assert False, "DownloadPlanner accepted an unknown ordering"
+        except ValueError:
+            pass
+        db.close()
@@ -1,16 +1,27 @@
+import os
 import sys
 import math
 import json
 import re
+import codecs
+import struct
+import hashlib
+import gzip
+import bz2
+import lzma
+import unicodedata
+from itertools import islice
 from datetime import datetime
 
-from typing import Dict, List, Tuple, Union, Any
+from typing import Dict, List, Tuple, Union, Any, Iterable, Iterator, Optional
 from types import FunctionType
 
 
-__all__ = ['CSRF_TOKEN_REGEX', 'dict_updater', 'remove_illegal_name_characters', 'NULL', 'load_json', 'dump_json', 'metric_size_formatter', 'make_progress_bar', 'get_date_from_string', 'inquire_params', 'remove_duplicate_in_list', 'PrettyPrinter']
+__all__ = ['CSRF_TOKEN_REGEX', 'CSRF_TOKEN_SCAN_LIMIT', 'dict_updater', 'remove_illegal_name_characters', 'NULL', 'load_json', 'dump_json', 'open_compressed', 'dump_ndjson', 'iter_ndjson', 'metric_size_formatter', 'make_progress_bar', 'get_date_from_string', 'inquire_params', 'remove_duplicate_in_list', 'iter_json_array', 'iter_chunks', 'tokenize_search_text', 'get_content_range_start', 'make_file_hasher', 'preallocate_file', 'trim_trailing_zeros', 'check_zip_structure', 'PrettyPrinter']
 
-CSRF_TOKEN_REGEX = re.compile(r".*?csrf-token.*?content=\"(.*?)\">", re.DOTALL)
+# Bounded to the meta tag, so a miss does not scan to the end of the page. Use with search().
+CSRF_TOKEN_REGEX = re.compile(r"csrf-token[^>]*?content=\"([^\"]*)\"")
+CSRF_TOKEN_SCAN_LIMIT = 64*1024
 
 remove_illegal_name_characters = lambda name: re.sub(r"[/\\:*?<>|\"]", '', name)
 dict_updater = lambda base,updater:(lambda dbase,dupdt:[dbase.update(dupdt), dbase][-1])(base.copy(), updater)
@@ -27,6 +38,34 @@ def dump_json(obj, filename, indent=4, open_kw: Dict = {}, json_dump_kw: Dict =
     with open(filename, 'w', encoding='utf-8', **open_kw) as file:
         json.dump(obj, file, indent=4, **json_dump_kw)
 
+COMPRESSED_FILE_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+def open_compressed(filename, mode='rt'):
+    """Opens filename as utf-8 text, compressed according to its extension (.gz, .bz2 or .xz) or plain otherwise."""
+    opener = COMPRESSED_FILE_OPENERS.get(os.path.splitext(filename)[1].lower(), open)
+    return opener(filename, mode, encoding='utf-8')
+
+def dump_ndjson(objs: Iterable, filename, json_dump_kw: Dict = {}):
+    """Writes one json document per line, consuming objs lazily. Returns the number of documents written."""
+    count = 0
+    with open_compressed(filename, 'wt') as file:
+        for obj in objs:
+            file.write(json.dumps(obj, separators=(',', ':'), **json_dump_kw))
+            file.write('\n')
+            count += 1
+    return count
+
+def iter_ndjson(filename, json_load_kw: Dict = {}) -> Iterator[Any]:
+    """Yields the json document of every non-empty line of filename, reading one line at a time."""
+    with open_compressed(filename, 'rt') as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line, **json_load_kw)
+            except ValueError as exc:
+                raise ValueError("Invalid json on line {} of {}: {}".format(line_number, filename, exc)) from None
+
 def metric_size_formatter(value: int, suffix: str = 'B', decimal_places: int = 2, divisor: Union[int, float] = 1024.0):
     formattable_str = "{%s:.%sf} {unit}{suffix}" % ('value', decimal_places)
     for unit in ['','K','M','G','T','P','E','Z']:
@@ -84,14 +123,169 @@ def inquire_params(keyPromptPair: Dict[str,str]):
 
 
 def remove_duplicate_in_list(_lst:List[Dict], grouper_key: str, eliminator_callable: FunctionType):
-    grouped_data = {}
+    """Keeps the entry with the highest eliminator_callable(entry) of every grouper_key value, in order of first appearance. Linear time."""
+    kept_entries = {}
     for entry in _lst:
         try:
-            grouped_data[entry[grouper_key]] = grouped_data.get(entry[grouper_key], []) + [entry]
+            group = entry[grouper_key]
         except KeyError:
             continue
+        score = eliminator_callable(entry)
+        if group not in kept_entries or score > kept_entries[group][0]:
+            kept_entries[group] = (score, entry)
+    
+    return [entry for _, entry in kept_entries.values()]
+
+
+def iter_json_array(chunks: Iterable[bytes], encoding: str = 'utf-8', decoder: json.JSONDecoder = json.JSONDecoder()) -> Iterator[Any]:
+    """
+    Incrementally decodes a top level json array from byte chunks, yielding every item as soon as it is complete.
+    Only the undecoded tail of the document is held in memory.
+    """
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = iter(chunks)
+    buffer, position = '', 0
+    started = finished = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError("Expected a json array, found {!r}.".format(buffer[position:position+20]))
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                # A number cut by the chunk boundary decodes too, so items only count once a delimiter follows them.
+                if (end < len(buffer) and buffer[end] in ' \t\r\n,]') or finished:
+                    yield item
+                    position = end
+                    continue
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+        if finished:
+            raise ValueError("Unterminated json array.")
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+            buffer = buffer[position:]+text_decoder.decode(b'', final=True)
+        else:
+            buffer = buffer[position:]+text_decoder.decode(chunk)
+        position = 0
+
+
+def tokenize_search_text(text: str) -> List[str]:
+    """Case and diacritic folded words of text, split like the unicode61 tokenizer of SQLite full-text search."""
+    text = ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+    return re.findall(r'[^\W_]+', text.casefold())
+
+def iter_chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    """Yields lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_content_range_start(content_range: str) -> Optional[int]:
+    """First byte position of a 'bytes start-end/size' Content-Range header, None if absent or unreadable."""
+    match = re.fullmatch(r'\s*bytes\s+(\d+)-\d+/(?:\d+|\*)\s*', content_range or '')
+    return int(match.group(1)) if match else None
+
+
+def make_file_hasher(file_handler, length: int, algorithm: str = 'sha256', block_size: int = 1024*1024):
+    """Returns a hashlib object fed with the first length bytes of file_handler, leaving the file positioned at length."""
+    hasher = hashlib.new(algorithm)
+    file_handler.seek(0)
+    remaining = length
+    while remaining > 0:
+        block = file_handler.read(min(block_size, remaining))
+        if not block:
+            break
+        hasher.update(block)
+        remaining -= len(block)
+    file_handler.seek(length)
+    return hasher
+
+
+ZIP_END_OF_CENTRAL_DIRECTORY = struct.Struct('<4s4H2LH')
+ZIP_END_OF_CENTRAL_DIRECTORY_SIGNATURE = b'PK\x05\x06'
+ZIP_CENTRAL_DIRECTORY_SIGNATURE = b'PK\x01\x02'
+ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR_SIGNATURE = b'PK\x06\x07'
+
+
+def preallocate_file(file_handler, offset: int, length: int) -> bool:
+    """
+    Reserves length bytes of file_handler from offset with posix_fallocate, so the file is not grown piecemeal as it is written.
+    Returns False where it is not supported, e.g. on Windows, for in-memory files or on file systems without fallocate.
+    """
+    if length <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(file_handler.fileno(), offset, length)
+    except (AttributeError, ValueError, OSError):
+        # io.UnsupportedOperation of files without a descriptor is both a ValueError and an OSError.
+        return False
+    return True
+
+
+def trim_trailing_zeros(file_handler, block_size: int = 1024*1024) -> int:
+    """
+    Truncates the zero bytes at the end of file_handler, e.g. the unwritten part of a preallocated file, and leaves it positioned at its new end.
+    Zeros that were written are cut too, which only costs reading them again. Returns the new size.
+    """
+    end = size = file_handler.seek(0, os.SEEK_END)
+    while size > 0:
+        start = max(size-block_size, 0)
+        file_handler.seek(start)
+        data = file_handler.read(size-start).rstrip(b'\0')
+        if data:
+            size = start+len(data)
+            break
+        size = start
+    if size != end:
+        file_handler.truncate(size)
+    file_handler.seek(size)
+    return size
+
+
+def check_zip_structure(file_handler) -> bool:
+    """
+    Cheap structural check of a zip archive, like an .osz, reading only the tail of the file and one central directory header.
+    The end of central directory record has to close the file, and the central directory it points to has to end right before it.
+    """
+    file_handler.seek(0, os.SEEK_END)
+    size = file_handler.tell()
+    tail_size = min(size, ZIP_END_OF_CENTRAL_DIRECTORY.size+0xFFFF) # The record ends with a comment of up to 64KB.
+    file_handler.seek(size-tail_size)
+    tail = file_handler.read(tail_size)
+    
+    position = tail.rfind(ZIP_END_OF_CENTRAL_DIRECTORY_SIGNATURE)
+    while position >= 0:
+        if len(tail)-position >= ZIP_END_OF_CENTRAL_DIRECTORY.size:
+            _, _, _, _, entries, directory_size, directory_offset, comment_length = ZIP_END_OF_CENTRAL_DIRECTORY.unpack_from(tail, position)
+            if position+ZIP_END_OF_CENTRAL_DIRECTORY.size+comment_length == len(tail):
+                break
+        position = tail.rfind(ZIP_END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, position)
+    else:
+        return False
     
-    return [max(entries, key=eliminator_callable) for entries in grouped_data.values()]
+    if entries == 0xFFFF or directory_offset == 0xFFFFFFFF:
+        # Zip64, the real values live in another record, only its locator is checked.
+        return tail[max(position-20, 0):position-16] == ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR_SIGNATURE
+    if directory_offset+directory_size != size-tail_size+position:
+        return False
+    if entries == 0:
+        return directory_size == 0
+    file_handler.seek(directory_offset)
+    return file_handler.read(len(ZIP_CENTRAL_DIRECTORY_SIGNATURE)) == ZIP_CENTRAL_DIRECTORY_SIGNATURE
 
 
 class PrettyPrinter: